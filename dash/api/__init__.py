@@ -1,10 +1,16 @@
 from __future__ import unicode_literals
+import email.utils
+import hashlib
 import json
 import logging
+from multiprocessing.pool import ThreadPool
+import random
 import time
 
+from redis.exceptions import LockError
 from redis_cache import get_redis_connection
 import requests
+import six
 from six.moves import urllib
 
 from django.conf import settings
@@ -12,6 +18,10 @@ from django.core.cache import cache
 from django.utils.encoding import force_text
 from django.utils.text import slugify
 
+from .circuit import OPEN, CircuitBreaker, CircuitOpenError
+from .stats import ERROR, FALLBACK, HIT, MISS, get_cache_specs, record_cache_read
+from .throttle import ThrottledError, throttled
+
 
 logger = logging.getLogger(__name__)
 
@@ -31,31 +41,117 @@ RESULT_CACHE_TIME = getattr(settings, 'API_RESULT_CACHE_TIME', 60 * 15)
 # fifteen minutes for flows cache
 FLOWS_CACHE_TIME = getattr(settings, 'API_FLOWS_CACHE_TIME', 60 * 15)
 
+# one minute between pulls of new flow messages
+FLOW_MESSAGES_CACHE_TIME = getattr(settings, 'API_FLOW_MESSAGES_CACHE_TIME', 60)
+
+# the number of messages kept for each flow, and how long they're kept after the flow was last viewed
+FLOW_MESSAGES_MAX = getattr(settings, 'API_FLOW_MESSAGES_MAX', 1000)
+FLOW_MESSAGES_STORE_TIME = getattr(settings, 'API_FLOW_MESSAGES_STORE_TIME', 60 * 60 * 24 * 7)
+
+# the number of messages in each page returned by get_flow_messages, independent of RapidPro's page size
+FLOW_MESSAGES_PAGE_SIZE = getattr(settings, 'API_FLOW_MESSAGES_PAGE_SIZE', 25)
+
+# the number of RapidPro pages pulled while serving a request, the rest are pulled by a background task
+FLOW_MESSAGES_SYNC_PAGES = getattr(settings, 'API_FLOW_MESSAGES_SYNC_PAGES', 1)
+
+# the stored messages of each flow by id, whether they've been pulled recently, and the unfinished part of the last
+# pull which is left to a background task
+FLOW_MESSAGES_KEY = 'flow_messages:%d:%s:%s'
+FLOW_MESSAGES_PULLED_KEY = 'flow_messages_pulled:%d:%s:%s'
+FLOW_MESSAGES_BACKFILL_KEY = 'flow_messages_backfill:%d:%s:%s'
+
+# the index of an org's flows and rulesets by id
+FLOWS_INDEX_KEY = 'flows_index:%d'
+
 # one hour to cache group results and breakdowns
 CONTACT_RESULT_CACHE_TIME = getattr(settings, 'API_CONTACT_RESULT_CACHE_TIME', 60 * 60)
 
 # five minutes to cache contacts and breakdowns
 CONTACT_CACHE_TIME = getattr(settings, 'API_CONTACTS_CACHE_TIME', 60 * 5)
 
+# the maximum number of results fetched at once when getting results for many rulesets
+RESULTS_FETCH_CONCURRENCY = getattr(settings, 'API_RESULTS_FETCH_CONCURRENCY', 5)
+
+# how long a choropleth which is no longer requested keeps being refreshed in the background
+CHOROPLETH_REFRESH_AGE = getattr(settings, 'API_CHOROPLETH_REFRESH_AGE', 60 * 60 * 24)
+
+# the choropleths requested for each org, scored by when they were last requested
+CHOROPLETHS_KEY = 'choropleths:%d'
+
+# seconds to wait for RapidPro to accept a connection and then to send a response
+REQUEST_TIMEOUT = (getattr(settings, 'API_CONNECT_TIMEOUT', 5), getattr(settings, 'API_READ_TIMEOUT', 30))
+
+# the number of times a failed page is retried, and the backoff before the first and any retry
+RETRY_ATTEMPTS = getattr(settings, 'API_RETRY_ATTEMPTS', 3)
+RETRY_BACKOFF = getattr(settings, 'API_RETRY_BACKOFF', 1)
+RETRY_MAX_DELAY = getattr(settings, 'API_RETRY_MAX_DELAY', 30)
+
+# the most seconds spent getting a page, including retries, while serving a request and in background tasks
+RETRY_BUDGET = getattr(settings, 'API_RETRY_BUDGET', 3)
+RETRY_BACKGROUND_BUDGET = getattr(settings, 'API_RETRY_BACKGROUND_BUDGET', 120)
+
+# how long the pages fetched before a failing page are kept for the next fetch to resume from
+FETCH_PROGRESS_TIME = getattr(settings, 'API_FETCH_PROGRESS_TIME', 60 * 15)
+FETCH_PROGRESS_KEY = 'fetch_progress:%d:%s'
+
+# the families of values which are warmed, boundaries are warmed by the org
+WARM_FAMILIES = getattr(settings, 'API_WARM_FAMILIES', ('flows', 'rs', 'cf', 'group', 'boundaries'))
+
+# values which would expire within this many seconds are refreshed, so warming should run more often than this
+WARM_AHEAD_TIME = getattr(settings, 'API_WARM_AHEAD_TIME', 60 * 5)
+
+# the maximum number of values refreshed for each org each time, and the maximum refreshed at once
+WARM_BUDGET = getattr(settings, 'API_WARM_BUDGET', 20)
+WARM_CONCURRENCY = getattr(settings, 'API_WARM_CONCURRENCY', 4)
+
+# the longest we wait for somebody else to calculate a value we have no fallback for before calculating it ourselves
+LOCK_WAIT_TIME = getattr(settings, 'API_LOCK_WAIT_TIME', 30)
+
+# the generation of each org's result keys, incrementing it invalidates all of the org's cached results
+RESULTS_GENERATION_KEY = 'results_generation:%d'
+
+
+def get_segment_digest(segment):
+    """
+    Returns a compact digest of a canonical serialization of the given segment, so that equal segments always have
+    the same digest regardless of key order
+    """
+    canonical = json.dumps(segment, sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
+
+def parse_retry_after(value):
+    """
+    Parses the value of a Retry-After header, which is either a number of seconds or an HTTP date, into a number of
+    seconds. Returns None if there's no valid value.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        return max(0, email.utils.mktime_tz(parsed) - time.time()) if parsed else None
+
 
 class API(object):
 
-    def __init__(self, org):
+    def __init__(self, org, background=False):
         self.org = org
+        self.background = background
 
     def get_group(self, name):
         """
         Returns the attributes for a group
         """
-        key = 'group:%d:%s' % (self.org.id, slugify(name))
-        return self._get_from_cache(key, GROUP_CACHE_TIME, lambda: self._fetch_group(name))
+        return self._get_warmable('group', name)
 
     def get_contacts(self, group=None):
         """
         Returns the contacts within a particular group
         """
-        key = 'contacts:%d:%s' % (self.org.id, slugify(group))
-        return self._get_from_cache(key, CONTACT_CACHE_TIME, lambda: self._fetch_contacts(group))
+        return self._get_warmable('contacts', group)
 
     def get_country_geojson(self):
         """
@@ -77,83 +173,427 @@ class API(object):
         """
         Returns the results summary for a flow ruleset.
         """
-        key = 'rs:%s:%d' % (self.org.id, ruleset_id)
-        if segment:
-            location = segment.get('location', None)
-            if location == 'State':
-                segment['location'] = self.org.get_config('state_label')
-            elif location == 'District':
-                segment['location'] = self.org.get_config('district_label')
+        return self._get_warmable('rs', ruleset_id, self._normalize_segment(segment))
 
-            key += ":" + slugify(force_text(json.dumps(segment)))
+    def get_ruleset_results_many(self, ruleset_ids, segment=None):
+        """
+        Returns the results summaries for many flow rulesets as a dict of ruleset ids to results. Cached results are
+        fetched together, and missing results are fetched concurrently.
+        """
+        segment = self._normalize_segment(segment)
 
-        return self._get_from_cache(
-            key, RESULT_CACHE_TIME,
-            lambda: self._fetch_ruleset_results(ruleset_id, segment))
+        keys = {r_id: self._get_results_key('rs', '%d' % r_id, segment) for r_id in ruleset_ids}
+        fallback_keys = {r_id: self._get_results_fallback_key('rs', '%d' % r_id, segment) for r_id in ruleset_ids}
+        specs = {r_id: ['rs', [r_id, segment]] for r_id in ruleset_ids}
+
+        return self._get_many_from_cache(
+            keys, fallback_keys, RESULT_CACHE_TIME,
+            lambda ruleset_id: self._fetch_ruleset_results(ruleset_id, segment), specs=specs)
 
     def get_contact_field_results(self, contact_field_label, segment=None):
         """
         Returns the results summary for a contact field.
         """
-        key = 'cf:%d:%s' % (self.org.id, slugify(contact_field_label))
-        if segment:
-            location = segment.get('location', None)
-            if location == 'State':
-                segment['location'] = self.org.get_config('state_label')
-            elif location == 'District':
-                segment['location'] = self.org.get_config('district_label')
+        return self._get_warmable('cf', contact_field_label, self._normalize_segment(segment))
+
+    def get_ruleset_choropleth(self, ruleset_id, level=STATE, parent=None):
+        """
+        Returns the results for a flow ruleset segmented by the boundaries at the given level (the districts of the
+        given parent for DISTRICT), joined to the org's boundary index. This is a dict of the category labels, the
+        boundary ids in index order and each boundary's set and unset counts, and category counts and percentages in
+        the same order as the labels.
+        """
+        identifier = self._get_choropleth_identifier(ruleset_id, level, parent)
 
-            key += ":" + slugify(force_text(json.dumps(segment)))
+        # remember it was requested so it's kept fresh by refresh_choropleths
+        r = get_redis_connection()
+        r.zadd(CHOROPLETHS_KEY % self.org.id, time.time(), identifier)
 
+        key = self._get_results_key('choropleth', identifier, None)
         return self._get_from_cache(
-            key, CONTACT_RESULT_CACHE_TIME,
-            lambda: self._fetch_contact_field_results(contact_field_label, segment))
+            key, RESULT_CACHE_TIME,
+            lambda: self._build_ruleset_choropleth(ruleset_id, level, parent),
+            fallback_key=self._get_results_fallback_key('choropleth', identifier, None))
+
+    def refresh_ruleset_choropleth(self, ruleset_id, level=STATE, parent=None):
+        """
+        Recalculates the choropleth for a flow ruleset from freshly fetched results and caches it
+        """
+        segment = self._get_choropleth_segment(level, parent)
+        results = self._fetch_ruleset_results(ruleset_id, segment)
+
+        key = self._get_results_key('rs', '%d' % ruleset_id, segment)
+        cache.set(key, results, RESULT_CACHE_TIME)
+        cache.set(self._get_results_fallback_key('rs', '%d' % ruleset_id, segment), results, timeout=None)
+
+        identifier = self._get_choropleth_identifier(ruleset_id, level, parent)
+        choropleth = self._join_choropleth(results, level, parent)
+
+        cache.set(self._get_results_key('choropleth', identifier, None), choropleth, RESULT_CACHE_TIME)
+        cache.set(self._get_results_fallback_key('choropleth', identifier, None), choropleth, timeout=None)
+
+        return choropleth
+
+    def refresh_choropleths(self):
+        """
+        Refreshes every choropleth of this org which has been requested recently, forgetting those which haven't
+        """
+        r = get_redis_connection()
+        key = CHOROPLETHS_KEY % self.org.id
+        r.zremrangebyscore(key, 0, time.time() - CHOROPLETH_REFRESH_AGE)
+
+        for identifier in r.zrange(key, 0, -1):
+            ruleset_id, level, parent = force_text(identifier).split(':', 2)
+            try:
+                self.refresh_ruleset_choropleth(int(ruleset_id), int(level), parent or None)
+            except Exception:
+                logger.exception("Error refreshing choropleth %s for org %d" % (identifier, self.org.id))
+
+    def _get_choropleth_identifier(self, ruleset_id, level, parent):
+        return '%d:%d:%s' % (ruleset_id, level, parent or '')
+
+    def _get_choropleth_segment(self, level, parent):
+        if level == DISTRICT:
+            return self._normalize_segment(dict(location='District', parent=parent))
+
+        return self._normalize_segment(dict(location='State'))
+
+    def _build_ruleset_choropleth(self, ruleset_id, level, parent):
+        results = self.get_ruleset_results(ruleset_id, self._get_choropleth_segment(level, parent))
+        if results is None:
+            raise ValueError("No results for ruleset %d" % ruleset_id)
+
+        return self._join_choropleth(results, level, parent)
+
+    def _join_choropleth(self, results, level, parent):
+        """
+        Joins segmented results to the boundary index for the given level. Boundaries without results have zero
+        counts and results for boundaries which aren't in the index are dropped.
+        """
+        geojson = self.org.get_state_geojson(parent) if level == DISTRICT else self.org.get_country_geojson()
+        if not geojson:
+            raise ValueError("No boundaries for org %d" % self.org.id)
+
+        boundary_ids = [feature['properties']['id'] for feature in geojson['features']]
+
+        categories = []
+        for result in results:
+            for category in result['categories']:
+                if category['label'] not in categories:
+                    categories.append(category['label'])
+
+        by_boundary = {result['boundary']: result for result in results}
+
+        boundaries = dict()
+        for boundary_id in boundary_ids:
+            result = by_boundary.get(boundary_id, None)
+            counts = dict()
+            if result:
+                counts = {category['label']: category['count'] for category in result['categories']}
+
+            counts = [counts.get(label, 0) for label in categories]
+            responded = sum(counts)
+            percentages = [int(round(count * 100.0 / responded)) if responded else 0 for count in counts]
+
+            boundaries[boundary_id] = dict(set=result['set'] if result else 0,
+                                           unset=result['unset'] if result else 0,
+                                           counts=counts, percentages=percentages)
+
+        return dict(categories=categories, boundary_ids=boundary_ids, boundaries=boundaries)
+
+    def invalidate_results(self):
+        """
+        Invalidates all of this org's cached ruleset and contact field results by moving on to the next generation of
+        result keys. Fallback values are kept so they can still be served while results are recalculated.
+        """
+        key = RESULTS_GENERATION_KEY % self.org.id
+        cache.add(key, 0, timeout=None)
+        self._results_generation = cache.incr(key)
+
+    def _get_results_generation(self):
+        # only looked up once per instance, which lives for a request or task
+        if getattr(self, '_results_generation', None) is None:
+            self._results_generation = cache.get(RESULTS_GENERATION_KEY % self.org.id, 0)
+
+        return self._results_generation
+
+    def _normalize_segment(self, segment):
+        """
+        Returns a copy of the given segment with generic location names replaced by the org's boundary labels
+        """
+        if not segment:
+            return segment
+
+        segment = dict(segment)
+        location = segment.get('location', None)
+        if location == 'State':
+            segment['location'] = self.org.get_config('state_label')
+        elif location == 'District':
+            segment['location'] = self.org.get_config('district_label')
+
+        return segment
+
+    def _get_results_key(self, prefix, identifier, segment):
+        key = '%s:%d:g%d:%s' % (prefix, self.org.id, self._get_results_generation(), identifier)
+        return key + ':' + get_segment_digest(segment) if segment else key
+
+    def _get_results_fallback_key(self, prefix, identifier, segment):
+        key = 'fallback:%s:%d:%s' % (prefix, self.org.id, identifier)
+        return key + ':' + get_segment_digest(segment) if segment else key
 
     def get_flow(self, flow_id):
         """
         Returns the attributes on a flow.
         """
-        start = time.time()
+        index = self._get_flows_index()
+        return index['flows'].get(flow_id, None) if index else None
 
-        flow = None
-        flows = self.get_flows("flow=%d" % flow_id)
-        if flows:
-            flow = flows[0]
+    def get_ruleset(self, ruleset_id):
+        """
+        Returns the flow containing a ruleset and the ruleset itself, or (None, None) if there is no such ruleset.
+        """
+        index = self._get_flows_index()
+        entry = index['rulesets'].get(ruleset_id, None) if index else None
+        return (entry['flow'], entry['ruleset']) if entry else (None, None)
 
-        logger.debug("- got flow %d in %f" % (flow_id, time.time() - start))
+    def get_flow_messages(self, flow, page=0, direction=None):
+        """
+        Returns a page of the most recent messages for a given flow, newest first. Pages have FLOW_MESSAGES_PAGE_SIZE
+        messages (25 by default) regardless of RapidPro's page size. Messages are kept in a bounded local store per
+        flow which is only topped up with messages newer than those already in it, at most once every
+        FLOW_MESSAGES_CACHE_TIME. Only FLOW_MESSAGES_SYNC_PAGES pages are pulled while serving the request, and if
+        there are more new messages than that, the rest are pulled in the background. A background pull which failed
+        or was lost is queued again by the next pull.
+        """
+        r = get_redis_connection()
+        key = FLOW_MESSAGES_KEY % (self.org.id, flow, direction or '')
 
-        return flow
+        if cache.add(FLOW_MESSAGES_PULLED_KEY % (self.org.id, flow, direction or ''), True, FLOW_MESSAGES_CACHE_TIME):
+            lock = r.lock('lock:%s' % key, 240)
 
-    def get_flow_messages(self, flow, page=0, direction=None):
+            # if somebody else is already pulling, what's stored now is good enough
+            if lock.acquire(blocking=False):
+                try:
+                    self._pull_flow_messages(r, flow, direction, max_pages=FLOW_MESSAGES_SYNC_PAGES)
+                except Exception:
+                    logger.exception("Error pulling messages for flow %s" % flow)
+                finally:
+                    lock.release()
+
+                if r.exists(FLOW_MESSAGES_BACKFILL_KEY % (self.org.id, flow, direction or '')):
+                    from dash.orgs.tasks import backfill_flow_messages
+                    backfill_flow_messages.delay(self.org.id, flow, direction)
+
+        start = page * FLOW_MESSAGES_PAGE_SIZE
+        return [json.loads(force_text(m)) for m in r.zrevrange(key, start, start + FLOW_MESSAGES_PAGE_SIZE - 1)]
+
+    def backfill_flow_messages(self, flow, direction):
         """
-        Returns the most recent messages for a given flow.
+        Pulls the rest of the new messages for a flow which get_flow_messages left unfinished
         """
+        r = get_redis_connection()
+        key = FLOW_MESSAGES_KEY % (self.org.id, flow, direction or '')
+
+        # if we can't get the lock, the unfinished pull is kept and queued again by the next pull
+        lock = r.lock('lock:%s' % key, 240)
+        if not lock.acquire(blocking_timeout=LOCK_WAIT_TIME):
+            logger.warning("Not backfilling messages for flow %s which is locked" % flow)
+            return
+
         try:
-            url = '%s/api/v1/messages.json' % settings.API_ENDPOINT
-            params = dict(flow=flow)
+            self._pull_flow_messages(r, flow, direction, resume=True)
+        finally:
+            lock.release()
+
+    def _pull_flow_messages(self, r, flow, direction, max_pages=None, resume=False):
+        """
+        Pulls messages newer than the newest stored message into the store for a flow, stopping at the first page
+        which reaches messages we already have. If that would take more than max_pages pages, where it got to is saved
+        so the rest can be pulled by resuming.
+
+        While part of a pull is unfinished, the stored messages aren't all the messages newer than the oldest of them,
+        so new pulls stop at the messages the unfinished pull stops at rather than the newest stored. This way the gap
+        is filled by the next pull even if the unfinished part is never resumed.
+        """
+        key = FLOW_MESSAGES_KEY % (self.org.id, flow, direction or '')
+        backfill_key = FLOW_MESSAGES_BACKFILL_KEY % (self.org.id, flow, direction or '')
+        backfill = r.get(backfill_key)
+        backfill = json.loads(force_text(backfill)) if backfill else None
+
+        if resume:
+            if not backfill:
+                return
+
+            # page URLs already include our params
+            next, params = backfill['url'], None
+            last_id, count = backfill['last_id'], backfill['count']
+        else:
+            next, params = '%s/api/v1/messages.json' % settings.API_ENDPOINT, dict(flow=flow)
             if direction:
                 params['direction'] = direction
 
-            response = requests.get(url,
-                                    params=params,
-                                    headers={'Content-type': 'application/json',
-                                             'Accept': 'application/json',
-                                             'Authorization': 'Token %s' % self.org.api_token})
+            if backfill:
+                last_id = backfill['last_id']
+            else:
+                newest = r.zrevrange(key, 0, 0, withscores=True)
+                last_id = int(newest[0][1]) if newest else 0
+            count = 0
+
+        messages = []
+        pages = 0
+        unfinished = None
+
+        while next and count + len(messages) < FLOW_MESSAGES_MAX:
+            if max_pages is not None and pages >= max_pages:
+                unfinished = dict(url=next, last_id=last_id, count=count + len(messages))
+                break
+
+            result = self._get_page('messages', next, params)
+            pages += 1
+
+            new_messages = [m for m in result['results'] if m['id'] > last_id]
+            messages += new_messages
+
+            # messages come newest first, so once we see one we have there's nothing new after it
+            if len(new_messages) < len(result['results']):
+                break
 
-            result = response.json()
-            return result['results']
+            next = result.get('next', None)
+            params = None
 
-        except Exception as e:
-            raise e
+        pipe = r.pipeline()
+        if messages:
+            pairs = []
+            for message in messages[:FLOW_MESSAGES_MAX - count]:
+                pairs += [message['id'], json.dumps(message)]
+
+            pipe.zadd(key, *pairs)
+            pipe.zremrangebyrank(key, 0, -FLOW_MESSAGES_MAX - 1)
+
+        if unfinished:
+            pipe.set(backfill_key, json.dumps(unfinished), ex=FLOW_MESSAGES_STORE_TIME)
+        else:
+            pipe.delete(backfill_key)
+
+        # flows nobody looks at any more are eventually forgotten
+        pipe.expire(key, FLOW_MESSAGES_STORE_TIME)
+        pipe.execute()
 
     def get_flows(self, filter=None):
-        key = 'flows:%d' % self.org.id
-        if filter:
-            key += ":" + filter
+        return self._get_warmable('flows', filter)
+
+    def _get_warmable_spec(self, family, args):
+        """
+        Returns the key, timeout, fetch method and fallback key (or None for the default) of a cached value which can
+        be refreshed by warm_cache, identified by its family and the arguments of its getter
+        """
+        if family == 'group':
+            name, = args
+            return ('group:%d:%s' % (self.org.id, slugify(name)), GROUP_CACHE_TIME,
+                    lambda: self._fetch_group(name), None)
+
+        elif family == 'contacts':
+            group, = args
+            return ('contacts:%d:%s' % (self.org.id, slugify(group)), CONTACT_CACHE_TIME,
+                    lambda: self._fetch_contacts(group), None)
+
+        elif family == 'rs':
+            ruleset_id, segment = args
+            return (self._get_results_key('rs', '%d' % ruleset_id, segment), RESULT_CACHE_TIME,
+                    lambda: self._fetch_ruleset_results(ruleset_id, segment),
+                    self._get_results_fallback_key('rs', '%d' % ruleset_id, segment))
+
+        elif family == 'cf':
+            label, segment = args
+            return (self._get_results_key('cf', slugify(label), segment), CONTACT_RESULT_CACHE_TIME,
+                    lambda: self._fetch_contact_field_results(label, segment),
+                    self._get_results_fallback_key('cf', slugify(label), segment))
+
+        elif family == 'flows':
+            filter, = args
+            return ('flows:%d' % self.org.id + (':' + filter if filter else ''), FLOWS_CACHE_TIME,
+                    lambda: self._fetch_flows(filter), None)
+
+        raise ValueError("Unknown cache family: %s" % family)
+
+    def _get_warmable(self, family, *args):
+        key, timeout, fetch_method, fallback_key = self._get_warmable_spec(family, args)
+        return self._get_from_cache(key, timeout, fetch_method, fallback_key=fallback_key, spec=[family, list(args)])
+
+    def warm_cache(self, budget=None, concurrency=None):
+        """
+        Refreshes this org's most read cached values which are missing or will expire within WARM_AHEAD_TIME, most
+        read first, at most budget of them and concurrency at a time. Read counts are the sampled counts of the cache
+        stats, so values which are no longer read are forgotten once they're no longer among the most read keys or
+        their counts expire. Returns the number of values refreshed.
+        """
+        budget = WARM_BUDGET if budget is None else budget
+        concurrency = WARM_CONCURRENCY if concurrency is None else concurrency
+
+        r = get_redis_connection()
+
+        due = []
+        for key, (family, args) in get_cache_specs(self.org.id):
+            if len(due) >= budget:
+                break
 
-        return self._get_from_cache(key, FLOWS_CACHE_TIME, lambda: self._fetch_flows(filter))
+            if family not in WARM_FAMILIES:
+                continue
+
+            spec = self._get_warmable_spec(family, args)
+            ttl = cache.ttl(spec[0])
+            if ttl is not None and ttl < WARM_AHEAD_TIME:
+                due.append(spec)
+
+        def refresh(spec):
+            cache_key, timeout, fetch_method, fallback_key = spec
+
+            # don't compete with a request which is already calculating it
+            lock = r.lock('lock:%s' % cache_key, 240, thread_local=False)
+            if not lock.acquire(blocking=False):
+                return False
+
+            try:
+                value = fetch_method()
+                cache.set(cache_key, value, timeout)
+                cache.set(fallback_key or 'fallback:%s' % cache_key, value, timeout=None)
+                return True
+            except Exception:
+                logger.exception("Error warming %s" % cache_key)
+                return False
+            finally:
+                lock.release()
+
+        refreshed = 0
+        if due:
+            pool = ThreadPool(min(len(due), concurrency))
+            try:
+                refreshed = sum(pool.map(refresh, due))
+            finally:
+                pool.close()
+                pool.join()
 
-    def _get_from_cache(self, key, timeout, fetch_method):
+        return refreshed
+
+    def _get_flows_index(self):
+        """
+        Returns the index of flows by id and rulesets by id, which is written whenever the full flow list is fetched so
+        single flows and rulesets never need their own requests
+        """
+        key = FLOWS_INDEX_KEY % self.org.id
+        return self._get_from_cache(key, FLOWS_CACHE_TIME, lambda: self._build_flows_index(self._fetch_flows()))
+
+    def _build_flows_index(self, flows):
+        index = dict(flows=dict(), rulesets=dict())
+        for flow in flows:
+            index['flows'][flow['flow']] = flow
+
+            for ruleset in flow['rulesets']:
+                index['rulesets'][ruleset['id']] = dict(flow=flow, ruleset=ruleset)
+
+        return index
+
+    def _get_from_cache(self, key, timeout, fetch_method, fallback_key=None, spec=None):
         """
         Takes care of performing the following logic:
             1) check whether we have a recent version of the cached value, if
@@ -165,19 +605,23 @@ class API(object):
 
         The above keeps us from having a stampeding herd of clients hammering
         the API for an expensive calculating at the cost of us serving a stale
-        value once in a while.
+        value once in a while. The fallback key defaults to the key prefixed
+        with 'fallback:'. The spec of a warmable value is recorded with its
+        reads so that warm_cache can refresh it.
         """
         # 1) try to get it from our cache
         cached_value = cache.get(key)
 
         # if we found it, yay, hand it back to the client
         if cached_value is not None:
+            record_cache_read(self.org.id, key, HIT, spec=spec)
             return cached_value
 
         r = get_redis_connection()
 
         lock_key = 'lock:%s' % key
-        fallback_key = 'fallback:%s' % key
+        if not fallback_key:
+            fallback_key = 'fallback:%s' % key
 
         # 2) didn't find it, somebody is already calculating it, return the fallback
         if r.exists(lock_key):
@@ -186,6 +630,7 @@ class API(object):
 
             # use our fallback, that's good enough
             if fallback_value is not None:
+                record_cache_read(self.org.id, key, FALLBACK, spec=spec)
                 return fallback_value
 
         # 3) acquire our lock and calculate our value
@@ -193,27 +638,35 @@ class API(object):
             # check for a cached value again, it's possible we were waiting in line
             cached_value = cache.get(key)
             if cached_value is not None:
+                record_cache_read(self.org.id, key, HIT, spec=spec)
                 return cached_value
 
             # no such luck, let's go calculate it
             # fetch_methods are expected to raise exception if we aren't
             # getting something valid looking
+            start = time.time()
             try:
                 calculated = fetch_method()
-            except:
-                # log our error
-                import traceback
-                traceback.print_exc()
+            except Exception as e:
+                # an open circuit or throttling is expected while RapidPro is failing, so isn't logged as an error
+                if isinstance(e, (CircuitOpenError, ThrottledError)):
+                    logger.debug("Not fetching value for %s: %s" % (key, e))
+                else:
+                    logger.exception("Error fetching value for %s" % key)
 
                 # can we fall back?
                 fallback_value = cache.get(fallback_key)
                 if fallback_value is not None:
+                    record_cache_read(self.org.id, key, FALLBACK, spec=spec)
                     return fallback_value
 
                 # oh well, return None, we tried
                 else:
+                    record_cache_read(self.org.id, key, ERROR, spec=spec)
                     return None
 
+            record_cache_read(self.org.id, key, MISS, time.time() - start, spec=spec)
+
             # populate our value as well as our fallback
             cache.set(key, calculated, timeout)
 
@@ -223,13 +676,198 @@ class API(object):
             # return our calculated value
             return calculated
 
+    def _get_many_from_cache(self, keys, fallback_keys, timeout, fetch_method, specs=None):
+        """
+        Performs the same logic as _get_from_cache for many values at once. Takes dicts of ids to keys and fallback
+        keys, a fetch_method which takes an id, and optionally a dict of ids to warmable specs. Cached values are read
+        with one get_many, then missing values are calculated concurrently, each under its own lock which is released
+        as soon as its value is written, so no thread ever holds more than one lock. Waiting for a lock held elsewhere
+        is bounded by LOCK_WAIT_TIME, after which the value is calculated anyway.
+        """
+        specs = specs or {}
+        cached = cache.get_many(list(keys.values()))
+        values = {id_: cached[key] for id_, key in six.iteritems(keys) if cached.get(key) is not None}
+
+        for id_ in values:
+            record_cache_read(self.org.id, keys[id_], HIT, spec=specs.get(id_))
+
+        misses = sorted(id_ for id_ in keys if id_ not in values)
+        if not misses:
+            return values
+
+        r = get_redis_connection()
+
+        def get_value(id_):
+            lock = r.lock('lock:%s' % keys[id_], 240)
+
+            # somebody is already calculating it, return the fallback if we have one, otherwise wait a while for them
+            if not lock.acquire(blocking=False):
+                fallback_value = cache.get(fallback_keys[id_])
+                if fallback_value is not None:
+                    record_cache_read(self.org.id, keys[id_], FALLBACK, spec=specs.get(id_))
+                    return fallback_value
+
+                if not lock.acquire(blocking_timeout=LOCK_WAIT_TIME):
+                    lock = None
+
+            try:
+                # check for a cached value again, it's possible we were waiting in line
+                cached_value = cache.get(keys[id_])
+                if cached_value is not None:
+                    record_cache_read(self.org.id, keys[id_], HIT, spec=specs.get(id_))
+                    return cached_value
+
+                start = time.time()
+                try:
+                    calculated = fetch_method(id_)
+                except Exception as e:
+                    if isinstance(e, (CircuitOpenError, ThrottledError)):
+                        logger.debug("Not fetching value for %s: %s" % (keys[id_], e))
+                    else:
+                        logger.exception("Error fetching value for %s" % keys[id_])
+
+                    fallback_value = cache.get(fallback_keys[id_])
+                    record_cache_read(self.org.id, keys[id_], ERROR if fallback_value is None else FALLBACK,
+                                      spec=specs.get(id_))
+                    return fallback_value
+
+                record_cache_read(self.org.id, keys[id_], MISS, time.time() - start, spec=specs.get(id_))
+
+                cache.set(keys[id_], calculated, timeout)
+
+                # fallback never expires
+                cache.set(fallback_keys[id_], calculated, timeout=None)
+
+                return calculated
+            finally:
+                if lock:
+                    try:
+                        lock.release()
+                    except LockError:
+                        logger.warning("Lock for %s expired before it was released" % keys[id_])
+
+        pool = ThreadPool(min(len(misses), RESULTS_FETCH_CONCURRENCY))
+        try:
+            values.update(zip(misses, pool.map(get_value, misses)))
+        finally:
+            pool.close()
+            pool.join()
+
+        return values
+
+    def _get(self, endpoint, url, params=None):
+        """
+        Makes a GET request to the given RapidPro endpoint through the org's circuit breaker for that endpoint, which
+        raises CircuitOpenError instead if the endpoint has been failing, and throttled to the limits of the org's
+        API token
+        """
+        breaker = CircuitBreaker(self.org.id, endpoint)
+        breaker.before_request()
+
+        try:
+            response = self._request(url, params)
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        return response
+
+    def _request(self, url, params=None):
+        kwargs = dict(headers={'Content-type': 'application/json',
+                               'Accept': 'application/json',
+                               'Authorization': 'Token %s' % self.org.api_token},
+                      timeout=REQUEST_TIMEOUT)
+        if params is not None:
+            kwargs['params'] = params
+
+        with throttled(self.org.api_token):
+            return requests.get(url, **kwargs)
+
+    def _get_page(self, endpoint, url, params=None):
+        """
+        Gets a page from a paginated RapidPro endpoint, retrying connection errors, server errors and throttling with
+        exponential backoff and jitter, or after as long as RapidPro asks if it sends a Retry-After header. Retries
+        stop once the page has taken longer than the retry budget (much shorter for requests made while serving a
+        page than in the background) or the endpoint's circuit has been opened by other requests. A page which fails
+        after retrying counts as a single failure towards opening the circuit.
+        """
+        breaker = CircuitBreaker(self.org.id, endpoint)
+        breaker.before_request()
+
+        budget = RETRY_BACKGROUND_BUDGET if self.background else RETRY_BUDGET
+        start = time.time()
+
+        for attempt in range(RETRY_ATTEMPTS + 1):
+            response, error, retry_after = None, None, None
+
+            try:
+                response = self._request(url, params)
+            except requests.RequestException as e:
+                error, failed = e, True
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    breaker.record_success()
+                    response.raise_for_status()
+                    return response.json()
+
+                failed = response.status_code >= 500
+                retry_after = parse_retry_after(response.headers.get('Retry-After', None))
+
+            if retry_after is None:
+                retry_after = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BACKOFF * 2 ** attempt))
+
+            # give up if we're out of attempts or time, or others have found the endpoint is failing
+            if (attempt == RETRY_ATTEMPTS or retry_after > RETRY_MAX_DELAY or
+                    time.time() - start + retry_after > budget or breaker.get_state() == OPEN):
+                if failed:
+                    breaker.record_failure()
+                if error is not None:
+                    raise error
+                response.raise_for_status()
+
+            logger.debug("- retrying %s in %fs" % (url, retry_after))
+            time.sleep(retry_after)
+
+    def _get_all_results(self, endpoint, url, params=None):
+        """
+        Returns the results from every page of a paginated RapidPro endpoint. If a page still fails after retrying,
+        the results so far are kept for FETCH_PROGRESS_TIME so the next fetch resumes from the failing page.
+        """
+        fetch = json.dumps([endpoint, url, params], sort_keys=True)
+        progress_key = FETCH_PROGRESS_KEY % (self.org.id, hashlib.md5(fetch.encode('utf-8')).hexdigest())
+
+        progress = cache.get(progress_key)
+        if progress:
+            # next page URLs already include our params
+            results, next, params = progress['results'], progress['next'], None
+        else:
+            results, next = [], url
+
+        while next:
+            try:
+                page = self._get_page(endpoint, next, params)
+            except Exception:
+                if results:
+                    cache.set(progress_key, dict(results=results, next=next), FETCH_PROGRESS_TIME)
+                raise
+
+            results += page['results']
+            next = page.get('next', None)
+            params = None
+
+        if progress:
+            cache.delete(progress_key)
+
+        return results
+
     def _fetch_group(self, name):
         start = time.time()
-        response = requests.get('%s/api/v1/groups.json' % settings.API_ENDPOINT,
-                                params={'name': name},
-                                headers={'Content-type': 'application/json',
-                                         'Accept': 'application/json',
-                                         'Authorization': 'Token %s' % self.org.api_token})
+        response = self._get('groups', '%s/api/v1/groups.json' % settings.API_ENDPOINT, params={'name': name})
 
         response.raise_for_status()
 
@@ -241,24 +879,8 @@ class API(object):
         return group
 
     def _fetch_contacts(self, group=None):
-        next = '%s/api/v1/contacts.json' % settings.API_ENDPOINT
-        contacts = []
-
-        while next:
-            response = requests.get(next,
-                                    params={'group': group},
-                                    headers={'Content-type': 'application/json',
-                                             'Accept': 'application/json',
-                                             'Authorization': 'Token %s' % self.org.api_token})
-
-            response.raise_for_status()
-            result = response.json()
-            for contact in result['results']:
-                contacts.append(contact)
-
-            next = result['next']
-
-        return contacts
+        return self._get_all_results('contacts', '%s/api/v1/contacts.json' % settings.API_ENDPOINT,
+                                     params={'group': group})
 
     def _fetch_country_geojson(self):
         boundaries = self._build_boundaries()
@@ -271,24 +893,7 @@ class API(object):
     def _build_boundaries(self):
         start = time.time()
 
-        next = '%s/api/v1/boundaries.json' % settings.API_ENDPOINT
-        boundaries = []
-
-        while next:
-            response = requests.get(next,
-                                    headers={'Content-type': 'application/json',
-                                             'Accept': 'application/json',
-                                             'Authorization': 'Token %s' % self.org.api_token})
-            response.raise_for_status()
-            response_json = response.json()
-
-            for boundary in response_json['results']:
-                boundaries.append(boundary)
-
-            if 'next' in response_json:
-                next = response_json['next']
-            else:
-                next = None
+        boundaries = self._get_all_results('boundaries', '%s/api/v1/boundaries.json' % settings.API_ENDPOINT)
 
         # we now build our cached versions of level 1 (all states) and level 2
         # (all districts for each state) geojson
@@ -339,14 +944,11 @@ class API(object):
 
         url = '%s/api/v1/results.json?ruleset=%d&segment=%s' % (
             settings.API_ENDPOINT, ruleset_id,
-            urllib.parse.quote(force_text(json.dumps(segment)).encode('utf8')))
+            urllib.parse.quote(force_text(json.dumps(segment, sort_keys=True)).encode('utf8')))
 
         logger.debug(url)
 
-        response = requests.get(url,
-                                headers={'Content-type': 'application/json',
-                                         'Accept': 'application/json',
-                                         'Authorization': 'Token %s' % self.org.api_token})
+        response = self._get('results', url)
 
         response.raise_for_status()
         response_json = response.json()
@@ -363,13 +965,10 @@ class API(object):
         url = '%s/api/v1/results.json?contact_field=%s&segment=%s' % (
             settings.API_ENDPOINT,
             contact_field_label,
-            urllib.parse.quote(force_text(json.dumps(segment)).encode('utf8')))
+            urllib.parse.quote(force_text(json.dumps(segment, sort_keys=True)).encode('utf8')))
         logger.debug(url)
 
-        response = requests.get(url,
-                                headers={'Content-type': 'application/json',
-                                         'Accept': 'application/json',
-                                         'Authorization': 'Token %s' % self.org.api_token})
+        response = self._get('results', url)
 
         response.raise_for_status()
         response_json = response.json()
@@ -387,27 +986,22 @@ class API(object):
         if filter:
             next += "?" + filter
 
-        flows = []
-        while next:
-            response = requests.get(next,
-                                    headers={'Content-type': 'application/json',
-                                             'Accept': 'application/json',
-                                             'Authorization': 'Token %s' % self.org.api_token})
-
-            response.raise_for_status()
-            result = response.json()
-
-            # we only include flows that have one or more rules
-            for flow in result['results']:
-                if len(flow['rulesets']) > 0:
-                    flows.append(flow)
-
-            if 'next' in result:
-                next = result['next']
-            else:
-                next = None
+        # we only include flows that have one or more rules
+        flows = [flow for flow in self._get_all_results('flows', next) if len(flow['rulesets']) > 0]
 
         if flows:
             logger.debug("- got flows in %f" % (time.time() - start))
 
+        # the index is written from the full list as it's fetched, rather than built from a cached copy of it later
+        if not filter:
+            key = FLOWS_INDEX_KEY % self.org.id
+            try:
+                index = self._build_flows_index(flows)
+                cache.set(key, index, FLOWS_CACHE_TIME)
+                cache.set('fallback:%s' % key, index, timeout=None)
+            except Exception:
+                # the flow list is still good without an index, but don't leave an outdated one
+                logger.exception("Error indexing flows for org %d" % self.org.id)
+                cache.delete(key)
+
         return flows
@@ -0,0 +1,90 @@
+from __future__ import unicode_literals
+import time
+
+from redis_cache import get_redis_connection
+
+from django.conf import settings
+
+
+# the number of failed requests to an endpoint within the failure window which opens its circuit
+CIRCUIT_FAILURE_THRESHOLD = getattr(settings, 'API_CIRCUIT_FAILURE_THRESHOLD', 5)
+CIRCUIT_FAILURE_WINDOW = getattr(settings, 'API_CIRCUIT_FAILURE_WINDOW', 60)
+
+# how long requests aren't made once a circuit is open, after which a single probe request is let through to test
+# whether the endpoint has recovered
+CIRCUIT_COOL_DOWN = getattr(settings, 'API_CIRCUIT_COOL_DOWN', 30)
+CIRCUIT_PROBE_TIME = getattr(settings, 'API_CIRCUIT_PROBE_TIME', 60)
+
+# the recent failures of each org's endpoints, when their circuits were opened, and whether they're being probed
+CIRCUIT_FAILURES_KEY = 'circuit_failures:%d:%s'
+CIRCUIT_OPENED_KEY = 'circuit_opened:%d:%s'
+CIRCUIT_PROBE_KEY = 'circuit_probe:%d:%s'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request to an endpoint whose circuit is open
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for the requests an org makes to a RapidPro endpoint, shared by all processes through redis. After
+    CIRCUIT_FAILURE_THRESHOLD failures within CIRCUIT_FAILURE_WINDOW the circuit opens and requests fail immediately
+    for CIRCUIT_COOL_DOWN. Then it's half open, and one request at a time is let through until one succeeds, which
+    closes it again, or fails, which re-opens it.
+    """
+    def __init__(self, org_id, endpoint):
+        self.failures_key = CIRCUIT_FAILURES_KEY % (org_id, endpoint)
+        self.opened_key = CIRCUIT_OPENED_KEY % (org_id, endpoint)
+        self.probe_key = CIRCUIT_PROBE_KEY % (org_id, endpoint)
+        self.endpoint = endpoint
+        self.state = None
+
+    def get_state(self):
+        r = get_redis_connection()
+        opened_on = r.get(self.opened_key)
+
+        if opened_on is None:
+            return CLOSED
+
+        return OPEN if time.time() < float(opened_on) + CIRCUIT_COOL_DOWN else HALF_OPEN
+
+    def before_request(self):
+        """
+        Checks that a request can be made, raising CircuitOpenError if not
+        """
+        self.state = self.get_state()
+
+        if self.state == OPEN:
+            raise CircuitOpenError("Circuit for %s is open" % self.endpoint)
+
+        # only one request is let through to probe a half open circuit
+        if self.state == HALF_OPEN:
+            r = get_redis_connection()
+            if not r.set(self.probe_key, 1, ex=CIRCUIT_PROBE_TIME, nx=True):
+                raise CircuitOpenError("Circuit for %s is being probed" % self.endpoint)
+
+    def record_success(self):
+        r = get_redis_connection()
+
+        if self.state == CLOSED:
+            r.delete(self.failures_key)
+        else:
+            r.delete(self.failures_key, self.opened_key, self.probe_key)
+
+    def record_failure(self):
+        r = get_redis_connection()
+
+        if self.state == HALF_OPEN:
+            r.pipeline().set(self.opened_key, time.time()).delete(self.probe_key).execute()
+            return
+
+        failures = r.pipeline().incr(self.failures_key).expire(self.failures_key, CIRCUIT_FAILURE_WINDOW).execute()[0]
+        if failures >= CIRCUIT_FAILURE_THRESHOLD:
+            r.set(self.opened_key, time.time())
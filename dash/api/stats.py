@@ -0,0 +1,169 @@
+from __future__ import unicode_literals
+from collections import defaultdict
+import json
+import random
+import threading
+import time
+
+from redis_cache import get_redis_connection
+import six
+
+from django.conf import settings
+
+
+# the fraction of cache reads which are counted
+STATS_SAMPLE_RATE = getattr(settings, 'API_STATS_SAMPLE_RATE', 0.05)
+
+# counts are buffered in each process and written to redis once this many have been recorded, or this many seconds
+# after the last write
+STATS_FLUSH_SIZE = getattr(settings, 'API_STATS_FLUSH_SIZE', 100)
+STATS_FLUSH_INTERVAL = getattr(settings, 'API_STATS_FLUSH_INTERVAL', 60)
+
+# the number of most read keys kept for each org, and how long counts are kept after they were last written
+STATS_MAX_KEYS = getattr(settings, 'API_STATS_MAX_KEYS', 1000)
+STATS_TIME = getattr(settings, 'API_STATS_TIME', 60 * 60 * 24 * 7)
+
+# the outcomes of a read of a cached value
+HIT = 'hit'
+MISS = 'miss'
+FALLBACK = 'fallback'
+ERROR = 'error'
+
+OUTCOMES = (HIT, MISS, FALLBACK, ERROR)
+
+# the counts of each org's key family, its families, the read counts of its keys and the specs of its warmable keys
+STATS_FAMILY_KEY = 'cache_stats:%d:%s'
+STATS_FAMILIES_KEY = 'cache_stats_families:%d'
+STATS_KEYS_KEY = 'cache_stats_keys:%d'
+STATS_SPECS_KEY = 'cache_stats_specs:%d'
+
+_lock = threading.Lock()
+_pending = dict(counts=defaultdict(int), keys=defaultdict(int), times=defaultdict(float), specs={}, recorded=0)
+_last_flush = [time.time()]
+
+
+def get_key_family(key):
+    """
+    Returns the family of a cache key, e.g. 'rs' for 'rs:1:g3:101'
+    """
+    return key.split(':', 1)[0]
+
+
+def record_cache_read(org_id, key, outcome, cost=None, spec=None):
+    """
+    Records a sample of cache reads, each with its outcome and for misses how many seconds the value took to
+    calculate. Counts are buffered and written in batches. Values which can be warmed pass their spec, the family and
+    arguments needed to calculate them again, which is kept for the most read keys.
+    """
+    if random.random() >= STATS_SAMPLE_RATE:
+        return
+
+    family = get_key_family(key)
+
+    with _lock:
+        _pending['counts'][(org_id, family, outcome)] += 1
+        _pending['keys'][(org_id, key)] += 1
+        if cost is not None:
+            _pending['times'][(org_id, family)] += cost
+        if spec is not None:
+            _pending['specs'][(org_id, key)] = spec
+
+        _pending['recorded'] += 1
+        due = _pending['recorded'] >= STATS_FLUSH_SIZE or time.time() - _last_flush[0] >= STATS_FLUSH_INTERVAL
+
+    if due:
+        flush_cache_stats()
+
+
+def flush_cache_stats():
+    """
+    Writes the buffered counts of this process to redis
+    """
+    with _lock:
+        counts, keys, times, specs = _pending['counts'], _pending['keys'], _pending['times'], _pending['specs']
+        _pending.update(counts=defaultdict(int), keys=defaultdict(int), times=defaultdict(float), specs={},
+                        recorded=0)
+        _last_flush[0] = time.time()
+
+    if not counts:
+        return
+
+    r = get_redis_connection()
+    pipe = r.pipeline()
+    org_ids = set()
+
+    for (org_id, family, outcome), count in six.iteritems(counts):
+        pipe.hincrby(STATS_FAMILY_KEY % (org_id, family), outcome, count)
+        pipe.sadd(STATS_FAMILIES_KEY % org_id, family)
+        org_ids.add(org_id)
+
+    for (org_id, family), cost in six.iteritems(times):
+        pipe.hincrbyfloat(STATS_FAMILY_KEY % (org_id, family), 'cost', cost)
+
+    for (org_id, key), count in six.iteritems(keys):
+        pipe.zincrby(STATS_KEYS_KEY % org_id, key, count)
+
+    for (org_id, key), spec in six.iteritems(specs):
+        pipe.hset(STATS_SPECS_KEY % org_id, key, json.dumps(spec, sort_keys=True))
+
+    for org_id in org_ids:
+        pipe.expire(STATS_FAMILIES_KEY % org_id, STATS_TIME)
+        pipe.expire(STATS_KEYS_KEY % org_id, STATS_TIME)
+        pipe.expire(STATS_SPECS_KEY % org_id, STATS_TIME)
+
+    for (org_id, family) in set((org_id, family) for org_id, family, outcome in counts):
+        pipe.expire(STATS_FAMILY_KEY % (org_id, family), STATS_TIME)
+
+    pipe.execute()
+
+    # only the most read keys, and the specs of those, are kept
+    for org_id in org_ids:
+        trimmed = r.zrange(STATS_KEYS_KEY % org_id, 0, -STATS_MAX_KEYS - 1)
+        if trimmed:
+            r.pipeline().zrem(STATS_KEYS_KEY % org_id, *trimmed).hdel(STATS_SPECS_KEY % org_id, *trimmed).execute()
+
+
+def get_cache_stats(org_id, num_keys=10):
+    """
+    Returns the sampled read counts of an org's cached values as a dict of each key family's counts of every
+    outcome, hit ratio and average seconds to calculate a value, and the most read keys with their counts
+    """
+    r = get_redis_connection()
+
+    families = dict()
+    for family in sorted(r.smembers(STATS_FAMILIES_KEY % org_id)):
+        family = family.decode('utf-8')
+        values = r.hgetall(STATS_FAMILY_KEY % (org_id, family))
+        values = {k.decode('utf-8'): v for k, v in six.iteritems(values)}
+
+        stats = {outcome: int(values.get(outcome, 0)) for outcome in OUTCOMES}
+        reads = sum(stats.values())
+        stats['hit_ratio'] = float(stats[HIT]) / reads if reads else None
+        stats['average_cost'] = float(values.get('cost', 0)) / stats[MISS] if stats[MISS] else None
+        families[family] = stats
+
+    top_keys = [(key.decode('utf-8'), int(count))
+                for key, count in r.zrevrange(STATS_KEYS_KEY % org_id, 0, num_keys - 1, withscores=True)]
+
+    return dict(families=families, top_keys=top_keys)
+
+
+def get_cache_specs(org_id):
+    """
+    Returns the specs of an org's warmable cached values as (key, spec) tuples, most read first
+    """
+    r = get_redis_connection()
+    keys = r.zrevrange(STATS_KEYS_KEY % org_id, 0, -1)
+    specs = r.hmget(STATS_SPECS_KEY % org_id, keys) if keys else []
+
+    return [(key.decode('utf-8'), json.loads(spec.decode('utf-8'))) for key, spec in zip(keys, specs) if spec]
+
+
+def clear_cache_stats(org_id):
+    """
+    Clears the counts of an org's cached values
+    """
+    r = get_redis_connection()
+    families = r.smembers(STATS_FAMILIES_KEY % org_id)
+    r.delete(STATS_FAMILIES_KEY % org_id, STATS_KEYS_KEY % org_id, STATS_SPECS_KEY % org_id,
+             *[STATS_FAMILY_KEY % (org_id, family.decode('utf-8')) for family in families])
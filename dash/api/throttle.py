@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import hashlib
+import time
+import uuid
+
+from redis_cache import get_redis_connection
+import six
+from temba_client.client import TembaClient
+
+from django.conf import settings
+
+
+# the requests per second made to RapidPro with each API token, and how many can be made at once after a quiet spell,
+# None for no limit
+THROTTLE_RATE = getattr(settings, 'API_THROTTLE_RATE', 10)
+THROTTLE_BURST = getattr(settings, 'API_THROTTLE_BURST', 20)
+
+# the maximum number of requests in progress at once with each API token, None for no limit
+THROTTLE_CONCURRENCY = getattr(settings, 'API_THROTTLE_CONCURRENCY', 5)
+
+# the longest a request waits to be made before giving up with ThrottledError
+THROTTLE_MAX_WAIT = getattr(settings, 'API_THROTTLE_MAX_WAIT', 30)
+
+# how long a request can hold a concurrency slot for, so slots held by crashed processes are reclaimed
+THROTTLE_HOLD_TIME = getattr(settings, 'API_THROTTLE_HOLD_TIME', 60)
+
+THROTTLE_POLL_INTERVAL = 0.05
+
+# the token bucket, holders of concurrency slots and wait statistics of each API token
+THROTTLE_BUCKET_KEY = 'throttle_bucket:%s'
+THROTTLE_SLOTS_KEY = 'throttle_slots:%s'
+THROTTLE_STATS_KEY = 'throttle_stats:%s'
+
+# takes a token from a bucket which refills at ARGV[1] tokens per second up to ARGV[2], letting it go into debt so
+# requests are spaced out in the order they arrive. Returns how long to wait before the token can be used, or -1 if
+# that's longer than ARGV[4], in which case nothing is taken.
+TAKE_TOKEN_SCRIPT = """
+local rate, burst, now, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / rate
+end
+if wait > max_wait then
+    return '-1'
+end
+
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('expire', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+return tostring(wait)
+"""
+
+# takes one of ARGV[1] slots for holder ARGV[4], first reclaiming slots taken before ARGV[2] - ARGV[3]. Returns 1 if a
+# slot was taken, otherwise 0.
+TAKE_SLOT_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[1], 0, tonumber(ARGV[2]) - tonumber(ARGV[3]))
+if redis.call('zcard', KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call('zadd', KEYS[1], ARGV[2], ARGV[4])
+    redis.call('expire', KEYS[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class ThrottledError(Exception):
+    """
+    Raised instead of making a request which would have to wait longer than THROTTLE_MAX_WAIT
+    """
+    pass
+
+
+def get_token_digest(api_token):
+    """
+    Returns a digest of an API token so tokens themselves aren't used in keys
+    """
+    return hashlib.md5(six.text_type(api_token).encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def throttled(api_token):
+    """
+    Context manager which waits until a request can be made with the given API token without exceeding its rate or
+    concurrency limits, and holds one of its concurrency slots until it exits
+    """
+    r = get_redis_connection()
+    digest = get_token_digest(api_token)
+    start = time.time()
+
+    if THROTTLE_RATE:
+        wait = float(r.eval(TAKE_TOKEN_SCRIPT, 1, THROTTLE_BUCKET_KEY % digest,
+                            THROTTLE_RATE, THROTTLE_BURST, start, THROTTLE_MAX_WAIT))
+        if wait < 0:
+            _record_wait(r, digest, time.time() - start, rejected=True)
+            raise ThrottledError("Request rate limit reached")
+        if wait:
+            time.sleep(wait)
+
+    holder = None
+    if THROTTLE_CONCURRENCY:
+        holder = uuid.uuid4().hex
+        while not r.eval(TAKE_SLOT_SCRIPT, 1, THROTTLE_SLOTS_KEY % digest,
+                         THROTTLE_CONCURRENCY, time.time(), THROTTLE_HOLD_TIME, holder):
+            if time.time() - start > THROTTLE_MAX_WAIT:
+                _record_wait(r, digest, time.time() - start, rejected=True)
+                raise ThrottledError("Concurrent request limit reached")
+
+            time.sleep(THROTTLE_POLL_INTERVAL)
+
+    _record_wait(r, digest, time.time() - start)
+
+    try:
+        yield
+    finally:
+        if holder:
+            r.zrem(THROTTLE_SLOTS_KEY % digest, holder)
+
+
+def _record_wait(r, digest, wait, rejected=False):
+    key = THROTTLE_STATS_KEY % digest
+    pipe = r.pipeline()
+    pipe.hincrby(key, 'rejected' if rejected else 'requests', 1)
+    pipe.hincrbyfloat(key, 'wait_time', wait)
+    pipe.execute()
+
+
+def get_throttle_stats(api_token):
+    """
+    Returns the number of requests made and rejected with the given API token, and their average wait in seconds
+    """
+    r = get_redis_connection()
+    values = r.hgetall(THROTTLE_STATS_KEY % get_token_digest(api_token))
+    values = {k.decode('utf-8'): v for k, v in six.iteritems(values)}
+
+    requests, rejected = int(values.get('requests', 0)), int(values.get('rejected', 0))
+    average_wait = float(values.get('wait_time', 0)) / (requests + rejected) if requests or rejected else None
+
+    return dict(requests=requests, rejected=rejected, average_wait=average_wait)
+
+
+def clear_throttle_stats(api_token):
+    r = get_redis_connection()
+    r.delete(THROTTLE_STATS_KEY % get_token_digest(api_token))
+
+
+class ThrottledTembaClient(TembaClient):
+    """
+    Temba client whose requests are throttled the same way as those made by dash.api.API
+    """
+    def __init__(self, host, token, user_agent=None):
+        super(ThrottledTembaClient, self).__init__(host, token, user_agent=user_agent)
+        self.throttle_token = token
+
+    def _request(self, method, url, body=None, params=None):
+        with throttled(self.throttle_token):
+            return super(ThrottledTembaClient, self)._request(method, url, body=body, params=params)
@@ -1,16 +1,28 @@
 from __future__ import unicode_literals
 
+import six
 from smartmin.models import SmartModel
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
 from dash.orgs.models import Org
+from dash.utils.images import ImageVariantsMixin
+
+
+CATEGORY_FIRST_IMAGE_KEY = 'category:%d:first_image'
+
+# a day, though the cached value is cleared whenever a category image changes
+CATEGORY_FIRST_IMAGE_CACHE_TIME = getattr(settings, 'CATEGORY_FIRST_IMAGE_CACHE_TIME', 60 * 60 * 24)
 
 
 @python_2_unicode_compatible
-class Category(SmartModel):
+class Category(ImageVariantsMixin, SmartModel):
     """
     Every organization can choose to categorize their polls or stories
     according to their needs.
@@ -25,9 +37,39 @@ class Category(SmartModel):
                             help_text=_("The organization this category applies to"))
 
     def get_first_image(self):
-        cat_images = self.images.filter(is_active=True).exclude(image='')
-        if cat_images and cat_images.first().image:
-            return cat_images.first().image
+        return Category.get_first_images([self])[self.pk]
+
+    @classmethod
+    def get_first_images(cls, categories):
+        """
+        Gets the first active image of each of the given categories, as a dict of category id to image (or None),
+        using a single cache lookup and at most one query
+        """
+        category_ids = set([category.pk for category in categories])
+        keys = {CATEGORY_FIRST_IMAGE_KEY % category_id: category_id for category_id in category_ids}
+
+        image_names = {keys[key]: name for key, name in six.iteritems(cache.get_many(keys.keys()))}
+
+        missing_ids = category_ids.difference(image_names.keys())
+        if missing_ids:
+            cat_images = CategoryImage.objects.filter(category_id__in=missing_ids, is_active=True).exclude(image='')
+            cat_images = cat_images.order_by('category', 'pk').values_list('category', 'image')
+
+            fetched = {category_id: '' for category_id in missing_ids}  # empty name means no image
+            for category_id, image_name in cat_images:
+                if not fetched[category_id]:
+                    fetched[category_id] = image_name
+
+            cache.set_many({CATEGORY_FIRST_IMAGE_KEY % category_id: name
+                            for category_id, name in six.iteritems(fetched)}, CATEGORY_FIRST_IMAGE_CACHE_TIME)
+            image_names.update(fetched)
+
+        return {category_id: CategoryImage(image=name).image if name else None
+                for category_id, name in six.iteritems(image_names)}
+
+    @classmethod
+    def clear_first_image(cls, category_id):
+        cache.delete(CATEGORY_FIRST_IMAGE_KEY % category_id)
 
     def __str__(self):
         return "%s - %s" % (self.org, self.name)
@@ -38,7 +80,7 @@ class Category(SmartModel):
 
 
 @python_2_unicode_compatible
-class CategoryImage(SmartModel):
+class CategoryImage(ImageVariantsMixin, SmartModel):
     name = models.CharField(max_length=64,
                             help_text=_("The name to describe this image"))
 
@@ -48,5 +90,29 @@ class CategoryImage(SmartModel):
     image = models.ImageField(upload_to='categories',
                               help_text=_("The image file to use"))
 
+    def __init__(self, *args, **kwargs):
+        super(CategoryImage, self).__init__(*args, **kwargs)
+
+        # remember which category we were loaded with so moving to another category clears the old one's first image
+        self._original_category_id = self.category_id
+
+    def save(self, *args, **kwargs):
+        super(CategoryImage, self).save(*args, **kwargs)
+        Category.clear_first_image(self.category_id)
+
+        if self._original_category_id and self._original_category_id != self.category_id:
+            Category.clear_first_image(self._original_category_id)
+        self._original_category_id = self.category_id
+
     def __str__(self):
         return "%s - %s" % (self.category.name, self.name)
+
+
+@receiver(post_delete, sender=CategoryImage)
+def clear_deleted_first_image(sender, instance, **kwargs):
+    """
+    Clears the first image of the category of a deleted image, including images deleted by querysets or cascades
+    which don't call CategoryImage.delete. Queryset updates can't be caught, so their changes are only seen once the
+    cached value expires.
+    """
+    Category.clear_first_image(instance.category_id)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from dash.utils.search import add_search_vector
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashblocks', '0006_auto_20140922_1514'),
+    ]
+
+    operations = [
+        add_search_vector('dashblocks_dashblock', ('title', 'summary', 'content', 'tags'), trigram_column='title'),
+    ]
@@ -7,6 +7,7 @@ from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
 from dash.orgs.models import Org
+from dash.utils.images import ImageVariantsMixin
 
 
 @python_2_unicode_compatible
@@ -62,7 +63,7 @@ class DashBlockType(SmartModel):
 
 
 @python_2_unicode_compatible
-class DashBlock(SmartModel):
+class DashBlock(ImageVariantsMixin, SmartModel):
     """
     A DashBlock is just a block of content, organized by type and priority.
     All fields are optional letting you use them for different things.
@@ -147,7 +148,7 @@ class DashBlock(SmartModel):
 
 
 @python_2_unicode_compatible
-class DashBlockImage(SmartModel):
+class DashBlockImage(ImageVariantsMixin, SmartModel):
     dashblock = models.ForeignKey(DashBlock, related_name='images')
     image = models.ImageField(
         upload_to='dashblock_images/', width_field="width",
@@ -5,6 +5,7 @@ from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
 from dash.orgs.views import OrgObjPermsMixin, OrgPermsMixin
+from dash.utils.search import FullTextSearchMixin
 
 from .models import DashBlockType, DashBlock, DashBlockImage
 
@@ -91,12 +92,13 @@ class DashBlockCRUDL(SmartCRUDL):
     permissions = True
     actions = ('create', 'update', 'list')
 
-    class List(OrgPermsMixin, SmartListView):
+    class List(OrgPermsMixin, FullTextSearchMixin, SmartListView):
         fields = ('title', 'priority', 'dashblock_type', 'tags')
         link_fields = ('title',)
         default_order = '-modified_on'
         search_fields = (
             'title__icontains', 'content__icontains', 'summary__icontains')
+        search_trigram_field = 'title'
 
         def derive_fields(self):
             fields = super(DashBlockCRUDL.List, self).derive_fields()
@@ -0,0 +1,66 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dash.api.stats import STATS_SAMPLE_RATE, clear_cache_stats, flush_cache_stats, get_cache_stats
+from dash.api.throttle import clear_throttle_stats, get_throttle_stats
+from dash.orgs.models import Org
+
+
+class Command(BaseCommand):
+    """
+    Reports the sampled reads of each org's cached API values: the outcomes of reads in each key family, hit ratios,
+    fallback serves and how long values took to calculate, and the most read keys. Also reports how long requests
+    with each org's API token waited to be made.
+    """
+    help = "Reports how each org's cached API values are being read"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, dest='org_id', help="The org to report on, defaults to all active orgs")
+        parser.add_argument('--keys', type=int, default=10, help="The number of most read keys to report")
+        parser.add_argument('--clear', action='store_true', help="Clear the counts after reporting them")
+
+    def handle(self, *args, **options):
+        orgs = Org.objects.filter(is_active=True).order_by('pk')
+        if options['org_id']:
+            orgs = orgs.filter(pk=options['org_id'])
+            if not orgs:
+                raise CommandError("No such active org: %d" % options['org_id'])
+
+        # include whatever this process hasn't written yet
+        flush_cache_stats()
+
+        self.stdout.write("Counts are of a %d%% sample of reads" % (STATS_SAMPLE_RATE * 100))
+
+        for org in orgs:
+            stats = get_cache_stats(org.pk, options['keys'])
+
+            self.stdout.write("")
+            self.stdout.write("%s (#%d)" % (org.name, org.pk))
+
+            throttle_stats = get_throttle_stats(org.api_token)
+            if throttle_stats['requests'] or throttle_stats['rejected']:
+                self.stdout.write(" * RapidPro requests: %d made, %d rejected, average wait %.3fs" % (
+                    throttle_stats['requests'], throttle_stats['rejected'], throttle_stats['average_wait']))
+
+            if options['clear']:
+                clear_throttle_stats(org.api_token)
+
+            if not stats['families']:
+                self.stdout.write(" * no reads recorded")
+                continue
+
+            for family, counts in sorted(stats['families'].items()):
+                hit_ratio = '%.1f%%' % (counts['hit_ratio'] * 100) if counts['hit_ratio'] is not None else '-'
+                average_cost = '%.3fs' % counts['average_cost'] if counts['average_cost'] is not None else '-'
+
+                self.stdout.write(" * %s: %d hits, %d misses, %d fallbacks, %d errors, hit ratio %s, "
+                                  "average recompute %s" % (family, counts['hit'], counts['miss'], counts['fallback'],
+                                                            counts['error'], hit_ratio, average_cost))
+
+            self.stdout.write(" * most read keys:")
+            for key, count in stats['top_keys']:
+                self.stdout.write("   %6d %s" % (count, key))
+
+            if options['clear']:
+                clear_cache_stats(org.pk)
@@ -0,0 +1,34 @@
+from __future__ import absolute_import, unicode_literals
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dash.api import WARM_BUDGET, WARM_CONCURRENCY
+from dash.orgs.models import Org
+
+
+class Command(BaseCommand):
+    """
+    Refreshes the boundaries and most read API values of active orgs which are missing or about to expire, the same
+    as the orgs.warm_caches task but optionally for a single org and with a different budget.
+    """
+    help = "Refreshes the cached values of active orgs before they expire"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, dest='org_id', help="The org to warm, defaults to all active orgs")
+        parser.add_argument('--budget', type=int, default=WARM_BUDGET, help="The most values to refresh per org")
+        parser.add_argument('--concurrency', type=int, default=WARM_CONCURRENCY,
+                            help="The most values to refresh at once")
+
+    def handle(self, *args, **options):
+        orgs = Org.objects.filter(is_active=True).order_by('pk')
+        if options['org_id']:
+            orgs = orgs.filter(pk=options['org_id'])
+            if not orgs:
+                raise CommandError("No such active org: %d" % options['org_id'])
+
+        for org in orgs:
+            start = time.time()
+            refreshed = org.warm_caches(options['budget'], options['concurrency'])
+
+            self.stdout.write("%s: refreshed %d values in %.2fs" % (org.name, refreshed, time.time() - start))
@@ -5,7 +5,6 @@ import random
 
 import pytz
 from smartmin.models import SmartModel
-from temba_client.client import TembaClient
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group
@@ -15,9 +14,11 @@ from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import force_text, python_2_unicode_compatible
 
-from dash.api import API
+from dash.api import API, WARM_AHEAD_TIME, WARM_BUDGET, WARM_FAMILIES
+from dash.api.throttle import ThrottledTembaClient
 from dash.dash_email import send_dash_email
 from dash.utils import datetime_to_ms
+from dash.utils.images import ImageVariantsMixin
 
 
 STATE = 1
@@ -32,7 +33,7 @@ BOUNDARY_LEVEL_2_KEY = 'geojson:%d:%s'
 
 
 @python_2_unicode_compatible
-class Org(SmartModel):
+class Org(ImageVariantsMixin, SmartModel):
     name = models.CharField(
         verbose_name=_("Name"), max_length=128,
         help_text=_("The name of this organization"))
@@ -81,6 +82,8 @@ class Org(SmartModel):
         help_text=_("JSON blob used to store configuration information "
                     "associated with this organization"))
 
+    image_variant_fields = ('logo',)
+
     def set_timezone(self, timezone):
         self.timezone = timezone
         self._tzinfo = None
@@ -159,10 +162,10 @@ class Org(SmartModel):
         if not host:
             host = '%s/api/v1' % settings.API_ENDPOINT  # UReport sites use this
 
-        return TembaClient(host, self.api_token, user_agent=agent)
+        return ThrottledTembaClient(host, self.api_token, user_agent=agent)
 
-    def get_api(self):
-        return API(self)
+    def get_api(self, background=False):
+        return API(self, background=background)
 
     def build_host_link(self, user_authenticated=False):
         host_tld = getattr(settings, "HOSTNAME", 'locahost')
@@ -247,6 +250,22 @@ class Org(SmartModel):
             key = BOUNDARY_LEVEL_2_KEY % (self.id, state_id)
             return boundaries.get(key, None)
 
+    def warm_caches(self, budget=None, concurrency=None):
+        """
+        Refreshes this org's boundaries and its most read API values before they expire, returning the number of
+        values refreshed
+        """
+        budget = WARM_BUDGET if budget is None else budget
+        refreshed = 0
+
+        if 'boundaries' in WARM_FAMILIES and budget > 0:
+            ttl = cache.ttl(BOUNDARY_CACHE_KEY % self.pk)
+            if ttl is not None and ttl < WARM_AHEAD_TIME:
+                self.build_boundaries()
+                refreshed += 1
+
+        return refreshed + self.get_api(background=True).warm_cache(budget - refreshed, concurrency)
+
     def get_top_level_geojson_ids(self):
         org_country_boundaries = self.get_country_geojson()
         return [elt['properties']['id'] for elt in org_country_boundaries['features']]
@@ -368,7 +387,7 @@ BACKGROUND_TYPES = (('B', _("Banner")),
                     ('P', _("Pattern")))
 
 
-class OrgBackground(SmartModel):
+class OrgBackground(ImageVariantsMixin, SmartModel):
     org = models.ForeignKey(
         Org, verbose_name=_("Org"), related_name="backgrounds",
         help_text=_("The organization in which the image will be used"))
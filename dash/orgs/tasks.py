@@ -40,3 +40,41 @@ def rebuild_org_boundaries(org_id):
         org.build_boundaries()
     except Exception as e:
         logger.exception("Error building org boundaries refresh: %s" % str(e))
+
+
+@shared_task(name='orgs.refresh_choropleths')
+def refresh_choropleths():
+    start = time.time()
+    r = get_redis_connection()
+
+    key = 'refresh_choropleths'
+    if not r.get(key):
+        with r.lock(key, timeout=900):
+            active_orgs = Org.objects.filter(is_active=True)
+            for org in active_orgs:
+                org.get_api(background=True).refresh_choropleths()
+    logger.debug("Task: refresh_choropleths took %ss" % (time.time() - start))
+
+
+@shared_task(name='orgs.backfill_flow_messages')
+def backfill_flow_messages(org_id, flow, direction):
+    org = Org.objects.get(pk=org_id)
+    org.get_api(background=True).backfill_flow_messages(flow, direction)
+
+
+@shared_task(name='orgs.warm_caches')
+def warm_caches():
+    start = time.time()
+    r = get_redis_connection()
+
+    key = 'warm_caches'
+    if not r.get(key):
+        with r.lock(key, timeout=900):
+            active_orgs = Org.objects.filter(is_active=True)
+            for org in active_orgs:
+                try:
+                    refreshed = org.warm_caches()
+                    logger.debug("- warmed %d values for org %d" % (refreshed, org.pk))
+                except Exception as e:
+                    logger.exception("Error warming caches for org %d: %s" % (org.pk, str(e)))
+    logger.debug("Task: warm_caches took %ss" % (time.time() - start))
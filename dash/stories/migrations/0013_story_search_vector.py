@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from dash.utils.search import add_search_vector
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0012_story_written_by'),
+    ]
+
+    operations = [
+        add_search_vector('stories_story', ('title', 'summary', 'content', 'tags'), trigram_column='title'),
+    ]
@@ -7,6 +7,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from dash.categories.models import Category
 from dash.orgs.models import Org
+from dash.utils.images import ImageVariantsMixin
 
 
 class Story(SmartModel):
@@ -126,7 +127,7 @@ class Story(SmartModel):
         verbose_name_plural = _("Stories")
 
 
-class StoryImage(SmartModel):
+class StoryImage(ImageVariantsMixin, SmartModel):
     name = models.CharField(max_length=64,
                             help_text=_("The name to describe this image"))
 
@@ -1,10 +1,13 @@
 from smartmin.views import SmartCRUDL, SmartCreateView, SmartListView, SmartUpdateView
 
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
 from django.core.urlresolvers import reverse
+from django.db.models import Count
 from django.utils.translation import ugettext_lazy as _
 
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
+from dash.utils.search import FullTextSearchMixin
 
 from .models import Category, Story, StoryImage
 
@@ -46,9 +49,10 @@ class StoryCRUDL(SmartCRUDL):
             kwargs['org'] = self.request.org
             return kwargs
 
-    class List(OrgPermsMixin, SmartListView):
+    class List(OrgPermsMixin, FullTextSearchMixin, SmartListView):
         fields = ('title', 'images', 'featured', 'created_on')
         search_fields = ('title__icontains',)
+        search_trigram_field = 'title'
         link_fields = ('title', 'images',)
         default_order = ('-created_on',)
 
@@ -64,12 +68,15 @@ class StoryCRUDL(SmartCRUDL):
                 return super(StoryCRUDL.List, self).lookup_field_link(context, field, obj)
 
         def get_images(self, obj):
-            return obj.images.count()
+            return obj.image_count
 
         def get_queryset(self, **kwargs):
             queryset = super(StoryCRUDL.List, self).get_queryset(**kwargs)
             queryset = queryset.filter(org=self.derive_org())
 
+            # count images in the same query rather than once per row
+            queryset = queryset.annotate(image_count=Count('images'))
+
             return queryset
 
     class Images(OrgObjPermsMixin, SmartUpdateView):
@@ -103,18 +110,28 @@ class StoryCRUDL(SmartCRUDL):
         def post_save(self, obj):
             obj = super(StoryCRUDL.Images, self).post_save(obj)
 
-            # remove our existing images
-            self.object.images.all().delete()
+            existing_images = list(self.object.images.all().order_by('pk'))
 
-            # overwrite our new ones
-            # TODO: this could probably be done more elegantly
-            for idx in range(1, 4):
+            # only touch the slots which have changed, so unchanged files aren't re-saved and keep their thumbnails
+            for idx in range(1, max(len(existing_images), 3) + 1):
+                existing = existing_images[idx - 1] if idx <= len(existing_images) else None
                 image = self.form.cleaned_data.get('image_%d' % idx, None)
 
-                if image:
-                    StoryImage.objects.create(
-                        story=self.object, image=image,
-                        created_by=self.request.user, modified_by=self.request.user)
+                if not image:
+                    # slot was cleared or never filled
+                    if existing:
+                        existing.delete()
+
+                elif isinstance(image, UploadedFile):
+                    # slot has a new upload, either replacing an existing image or adding a new one
+                    if existing:
+                        existing.image = image
+                        existing.modified_by = self.request.user
+                        existing.save()
+                    else:
+                        StoryImage.objects.create(
+                            story=self.object, image=image,
+                            created_by=self.request.user, modified_by=self.request.user)
 
             return obj
 
@@ -2,6 +2,7 @@ from __future__ import absolute_import, unicode_literals
 import calendar
 from collections import OrderedDict
 import datetime
+import itertools
 import json
 import random
 
@@ -34,14 +35,8 @@ def union(*args):
     """
     Return the union of lists, ordering by first seen in any list
     """
-    if not args:
-        return []
-
-    base = args[0]
-    for other in args[1:]:
-        base.extend(other)
-
-    return list(OrderedDict.fromkeys(base))  # remove duplicates whilst preserving order
+    # remove duplicates whilst preserving order, without modifying any of the given lists
+    return list(OrderedDict.fromkeys(itertools.chain(*args)))
 
 
 def random_string(length):
@@ -125,6 +120,32 @@ def chunks(data, size):
         yield data[i:(i + size)]
 
 
+def bulk_update(objs, fields):
+    """
+    Updates the given fields of the given model instances with a single query, using a CASE expression per field
+    """
+    if not objs:
+        return
+
+    model = type(objs[0])
+
+    try:
+        from django.db.models import Case, Value, When
+    except ImportError:  # pragma: no cover
+        # Django 1.7 doesn't have conditional expressions so save each instance's fields instead
+        for obj in objs:
+            obj.save(update_fields=fields)
+        return
+
+    updates = {}
+    for field_name in fields:
+        field = model._meta.get_field(field_name)
+        whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in objs]
+        updates[field.name] = Case(*whens, output_field=field)
+
+    model._default_manager.filter(pk__in=[obj.pk for obj in objs]).update(**updates)
+
+
 def temba_client_flow_results_serializer(client_results):
     if not client_results:
         return client_results
@@ -0,0 +1,131 @@
+from __future__ import absolute_import, unicode_literals
+from datetime import timedelta
+import random
+
+from temba_client.base import TembaPager
+from temba_client.types import Contact as TembaContact
+
+from django.utils import timezone
+
+
+class FakeTembaClient(object):
+    """
+    Fake Temba client which serves a number of synthetic contacts through the same get_contacts paging interface as
+    the real client, for testing and benchmarking contact syncing. Contacts are generated on demand so the client
+    itself uses little memory however many contacts it has. A fraction of contacts start blocked, and apply_changes
+    modifies and deletes fractions of them to simulate activity between syncs.
+    """
+    def __init__(self, num_contacts, page_size=250, changed_ratio=0.1, deleted_ratio=0.01, blocked_ratio=0.01,
+                 num_groups=10, uuid_prefix='C-', seed=None):
+        self.num_contacts = num_contacts
+        self.page_size = page_size
+        self.changed_ratio = changed_ratio
+        self.deleted_ratio = deleted_ratio
+        self.num_groups = num_groups
+        self.uuid_prefix = uuid_prefix
+        self.random = random.Random(seed)
+
+        # contacts are created a second apart, ending a day ago
+        self.created_on = timezone.now() - timedelta(days=1, seconds=num_contacts)
+
+        self.blocked = set(self._sample(range(num_contacts), blocked_ratio))
+        self.modified = {}  # index -> (version, modified_on) of changed contacts
+        self.deleted = {}  # index -> deleted_on of deleted contacts
+        self._sequences = {}
+
+    def apply_changes(self, now=None):
+        """
+        Changes and deletes the configured fractions of the remaining contacts, returning the indexes of each
+        """
+        now = now or timezone.now()
+        remaining = [i for i in range(self.num_contacts) if i not in self.deleted]
+
+        changed = self._sample(remaining, self.changed_ratio)
+        for index in changed:
+            version = self.modified.get(index, (0, None))[0] + 1
+            self.modified[index] = (version, now)
+
+        deleted = self._sample([i for i in remaining if i not in self.modified], self.deleted_ratio)
+        for index in deleted:
+            self.deleted[index] = now
+
+        self._sequences = {}
+        return changed, deleted
+
+    def count_contacts(self, after=None, before=None, deleted=False):
+        """
+        Counts the contacts which get_contacts will return for the given filters
+        """
+        return len(self._get_sequence(after, before, deleted))
+
+    def pager(self, start_page=1):
+        return TembaPager(start_page)
+
+    def get_contact(self, uuid):
+        return self.get_contact_by_index(self._index_from_uuid(uuid))
+
+    def get_contacts(self, uuids=None, urns=None, groups=None, before=None, after=None, deleted=None, pager=None):
+        if uuids is not None:
+            indexes = [self._index_from_uuid(uuid) for uuid in uuids]
+            return [self.get_contact_by_index(i) for i in indexes if i not in self.deleted]
+
+        sequence = self._get_sequence(after, before, bool(deleted))
+        build = self.get_deleted_contact_by_index if deleted else self.get_contact_by_index
+
+        if not pager:
+            return [build(i) for i in sequence]
+
+        page_num = int(pager.next_url) if pager.next_url else pager.start_page
+        start = (page_num - 1) * self.page_size
+        has_next = start + self.page_size < len(sequence)
+        pager.update(dict(count=len(sequence), next=str(page_num + 1) if has_next else None))
+
+        return [build(i) for i in sequence[start:start + self.page_size]]
+
+    def get_contact_by_index(self, index):
+        version, modified_on = self.modified.get(index, (0, self._created_on(index)))
+        name = "Contact %d" % index if not version else "Contact %d v%d" % (index, version)
+
+        return TembaContact.create(uuid=self._uuid(index), name=name, urns=['tel:+1%010d' % index],
+                                   groups=['G-%03d' % (index % self.num_groups)],
+                                   fields=dict(index=str(index), version=str(version)), language='eng',
+                                   blocked=index in self.blocked, failed=False, modified_on=modified_on)
+
+    def get_deleted_contact_by_index(self, index):
+        return TembaContact.create(uuid=self._uuid(index), name=None, urns=[], groups=[], fields={},
+                                   modified_on=self.deleted[index])
+
+    def _get_sequence(self, after, before, deleted):
+        """
+        Gets the indexes of the contacts matching the given filters, newest first as returned by the API
+        """
+        key = (after, before, deleted)
+        if key not in self._sequences:
+            if deleted:
+                times = self.deleted
+                candidates = self.deleted.keys()
+            else:
+                times = {i: modified_on for i, (v, modified_on) in self.modified.items()}
+                candidates = (i for i in range(self.num_contacts) if i not in self.deleted)
+
+            def get_time(index):
+                return times[index] if index in times else self._created_on(index)
+
+            matches = [i for i in candidates if (not after or get_time(i) >= after)
+                       and (not before or get_time(i) <= before)]
+            self._sequences[key] = sorted(matches, key=lambda i: (get_time(i), i), reverse=True)
+
+        return self._sequences[key]
+
+    def _created_on(self, index):
+        return self.created_on + timedelta(seconds=index)
+
+    def _uuid(self, index):
+        return '%s%08d' % (self.uuid_prefix, index)
+
+    def _index_from_uuid(self, uuid):
+        return int(uuid[len(self.uuid_prefix):])
+
+    def _sample(self, population, ratio):
+        population = list(population)
+        return self.random.sample(population, int(len(population) * ratio))
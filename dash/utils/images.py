@@ -0,0 +1,87 @@
+from __future__ import absolute_import, unicode_literals
+
+from sorl.thumbnail import get_thumbnail
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# the widths of the responsive variants generated for every uploaded image
+IMAGE_VARIANT_WIDTHS = getattr(settings, 'DASH_IMAGE_VARIANT_WIDTHS', (320, 640, 1280))
+
+# the formats each width is generated in
+IMAGE_VARIANT_FORMATS = getattr(settings, 'DASH_IMAGE_VARIANT_FORMATS', ('WEBP', 'JPEG'))
+
+IMAGE_VARIANT_QUALITY = getattr(settings, 'DASH_IMAGE_VARIANT_QUALITY', 85)
+
+IMAGE_VARIANTS_KEY = 'image_variants:%s'
+
+# how long to wait before queueing generation again for an image whose variants are missing
+IMAGE_VARIANTS_QUEUED_KEY = 'image_variants_queued:%s'
+IMAGE_VARIANTS_QUEUED_TIME = 60 * 60
+
+
+def generate_image_variants(name):
+    """
+    Generates every configured variant of the stored image with the given name, records their URLs and dimensions
+    and returns them. Thumbnails are generated through sorl so {% thumbnail %} tags with the same options are also
+    warmed.
+    """
+    variants = []
+    for image_format in IMAGE_VARIANT_FORMATS:
+        for width in IMAGE_VARIANT_WIDTHS:
+            thumbnail = get_thumbnail(name, '%d' % width, format=image_format, quality=IMAGE_VARIANT_QUALITY,
+                                      upscale=False)
+
+            variants.append(dict(url=thumbnail.url, width=thumbnail.width, height=thumbnail.height,
+                                 format=image_format))
+
+    # dimensions are recorded so variant data never expires
+    cache.set(IMAGE_VARIANTS_KEY % name, variants, timeout=None)
+    cache.delete(IMAGE_VARIANTS_QUEUED_KEY % name)
+
+    return variants
+
+
+def queue_image_variants(name):
+    """
+    Queues generation of the variants of the stored image with the given name
+    """
+    from .tasks import generate_image_variants_task
+    generate_image_variants_task.delay(name)
+
+
+def get_image_variants(image):
+    """
+    Gets the generated variants of the given image file, or an empty list if they haven't been generated yet, in
+    which case generation is queued. This never resizes images itself so is safe to use on public pages.
+    """
+    if not image:
+        return []
+
+    variants = cache.get(IMAGE_VARIANTS_KEY % image.name)
+    if variants is not None:
+        return variants
+
+    # only queue once in a while for the same image, it may just be waiting its turn in the queue
+    if cache.add(IMAGE_VARIANTS_QUEUED_KEY % image.name, True, IMAGE_VARIANTS_QUEUED_TIME):
+        queue_image_variants(image.name)
+
+    return []
+
+
+class ImageVariantsMixin(object):
+    """
+    Mixin for models with image fields which queues variant generation whenever a new file is uploaded to one of
+    the fields named in image_variant_fields
+    """
+    image_variant_fields = ('image',)
+
+    def save(self, *args, **kwargs):
+        uploaded = [field for field in self.image_variant_fields
+                    if getattr(self, field) and not getattr(self, field)._committed]
+
+        super(ImageVariantsMixin, self).save(*args, **kwargs)
+
+        for field in uploaded:
+            queue_image_variants(getattr(self, field).name)
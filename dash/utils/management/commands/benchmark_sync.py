@@ -0,0 +1,164 @@
+from __future__ import absolute_import, unicode_literals
+from contextlib import contextmanager
+import random
+import resource
+import time
+import timeit
+
+from temba_client.types import Contact as TembaContact
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+
+from dash.orgs.models import Org
+from dash.utils import random_string
+from dash.utils.fake import FakeTembaClient
+from dash.utils.sync import SYNC_BATCH_SIZE, SYNC_PREFETCH_PAGES, get_sync_status, set_sync_status, sync_pull_contacts
+from dash.utils.sync import temba_compare_contacts, temba_merge_contacts
+
+
+# synthetic contacts get UUIDs which can't clash with those of real contacts
+BENCHMARK_UUID_PREFIX = 'bench-'
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks a full and then an incremental contact pull from a fake RapidPro with synthetic contacts, reporting
+    throughput, queries, peak memory and where the time went, and then merging and comparing contacts with many
+    groups. Contacts are pulled into a throwaway org which is deleted afterwards along with its contacts and sync
+    status, so real orgs are never touched.
+    """
+    help = "Benchmarks pulling synthetic contacts into the given contact class (e.g. contacts.Contact)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('contact_class', help="The contact model to pull into, as app_label.ModelName")
+        parser.add_argument('--contacts', type=int, default=10000, help="The number of remote contacts")
+        parser.add_argument('--changed', type=float, default=0.1, help="The fraction changed before the 2nd pull")
+        parser.add_argument('--deleted', type=float, default=0.01, help="The fraction deleted before the 2nd pull")
+        parser.add_argument('--blocked', type=float, default=0.01, help="The fraction of contacts that are blocked")
+        parser.add_argument('--page-size', type=int, default=250)
+        parser.add_argument('--batch-size', type=int, default=SYNC_BATCH_SIZE)
+        parser.add_argument('--prefetch', type=int, default=SYNC_PREFETCH_PAGES)
+        parser.add_argument('--keep', action='store_true', help="Don't delete the org and its contacts afterwards")
+
+    def handle(self, *args, **options):
+        try:
+            contact_class = apps.get_model(options['contact_class'])
+        except (LookupError, ValueError):
+            raise CommandError("No such contact class: %s" % options['contact_class'])
+
+        user = User.objects.filter(is_superuser=True).order_by('pk').first()
+        if not user:
+            raise CommandError("No superuser to create the benchmark org as")
+
+        org = Org.objects.create(name="Sync benchmark", subdomain='sync-benchmark-%s' % random_string(8).lower(),
+                                 timezone='UTC', api_token=random_string(32), created_by=user, modified_by=user)
+
+        client = FakeTembaClient(options['contacts'], page_size=options['page_size'],
+                                 changed_ratio=options['changed'], deleted_ratio=options['deleted'],
+                                 blocked_ratio=options['blocked'], uuid_prefix=BENCHMARK_UUID_PREFIX, seed=1)
+
+        # pulls use the fake client instead of a real one
+        org.get_temba_client = lambda: client
+
+        try:
+            last_time = self.benchmark('Full', org, contact_class, client, None, options)
+
+            client.apply_changes()
+
+            self.benchmark('Incremental', org, contact_class, client, last_time, options)
+        finally:
+            if not options['keep']:
+                set_sync_status(org, contact_class, None)
+                contact_class.objects.filter(org=org).delete()
+                org.delete()
+
+        self.benchmark_merge()
+
+    def benchmark(self, name, org, contact_class, client, last_time, options):
+        """
+        Runs one pull and reports on it, returning the time it started which is the last_time for the next one
+        """
+        num_contacts = client.count_contacts(after=last_time) + client.count_contacts(after=last_time, deleted=True)
+
+        counter = dict(queries=0)
+        start = time.time()
+
+        with count_queries(counter):
+            counts = sync_pull_contacts(org, contact_class, last_time=last_time, delete_blocked=True,
+                                        counts_only=True, batch_size=options['batch_size'], resume=False,
+                                        prefetch=options['prefetch'])
+
+        elapsed = time.time() - start
+        status = get_sync_status(org, contact_class)
+        timings = status['timings']
+
+        # ru_maxrss is the peak of the whole process so far (in kilobytes on Linux), so after the first pull it's only
+        # a bound on the memory used by later ones
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+        self.stdout.write("%s pull: %d contacts in %.2fs (%d contacts/sec), %d queries, process peak RSS so far "
+                          "%.1f MB" % (name, num_contacts, elapsed, num_contacts / elapsed if elapsed else 0,
+                                       counter['queries'], peak_rss))
+        self.stdout.write(" * timings: fetch %.2fs, process %.2fs, wait %.2fs" % (
+            timings['fetch'], timings['process'], timings['wait']))
+        self.stdout.write(" * created %d, updated %d, deleted %d, failed %d" % counts)
+
+        return status['started_on']
+
+    def benchmark_merge(self):
+        """
+        Times merging and comparing contacts with hundreds of groups, many of which are in mutually exclusive sets
+        """
+        groups = ['G-%03d' % g for g in range(600)]
+        first = TembaContact.create(uuid='C-001', name="Ann", urns=['tel:1'], fields={}, groups=groups[:400])
+        second = TembaContact.create(uuid='C-001', name="Ann", urns=['tel:2'], fields={}, groups=groups[200:])
+        group_sets = [groups[g:g + 5] for g in range(0, 500, 5)]
+
+        # syncing mostly compares contacts which are the same
+        same_groups = groups[:400]
+        random.Random(1234).shuffle(same_groups)
+        same = TembaContact.create(uuid='C-001', name="Ann", urns=['tel:1'], fields={}, groups=same_groups)
+
+        def best_time(func, number=100):
+            return min(timeit.repeat(func, repeat=5, number=number)) / number
+
+        merge_time = best_time(lambda: temba_merge_contacts(first, second, group_sets))
+        compare_time = best_time(lambda: temba_compare_contacts(first, same))
+
+        self.stdout.write("Contacts with %d groups: merge %.1fus, compare %.1fus" % (
+            len(first.groups), merge_time * 1000000, compare_time * 1000000))
+
+
+class QueryCountingCursor(CursorWrapper):
+    """
+    Cursor which counts the queries it executes without recording them, so counting doesn't affect memory use
+    """
+    def __init__(self, cursor, db, counter):
+        super(QueryCountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter['queries'] += 1
+        return super(QueryCountingCursor, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter['queries'] += 1
+        return super(QueryCountingCursor, self).executemany(sql, param_list)
+
+
+@contextmanager
+def count_queries(counter):
+    def make_cursor(cursor):
+        return QueryCountingCursor(cursor, connection, counter)
+
+    connection.make_cursor = make_cursor
+    connection.make_debug_cursor = make_cursor
+    try:
+        yield
+    finally:
+        del connection.make_cursor
+        del connection.make_debug_cursor
@@ -0,0 +1,150 @@
+from __future__ import absolute_import, unicode_literals
+import re
+
+from django.conf import settings
+from django.db import connection, migrations
+
+
+# the text search configuration used to build and query search vectors, 'simple' doesn't stem so works the same
+# for every org language
+SEARCH_CONFIG = getattr(settings, 'DASH_SEARCH_CONFIG', 'simple')
+
+# whether to fall back to trigram similarity on titles when full text search finds nothing (requires pg_trgm)
+SEARCH_TRIGRAM = getattr(settings, 'DASH_SEARCH_TRIGRAM', False)
+
+# minimum title similarity for a trigram match
+SEARCH_TRIGRAM_THRESHOLD = getattr(settings, 'DASH_SEARCH_TRIGRAM_THRESHOLD', 0.3)
+
+SEARCH_WEIGHTS = ('A', 'B', 'C', 'D')
+
+
+def is_search_supported():
+    """
+    Returns whether full text search is available on the current database
+    """
+    return connection.vendor == 'postgresql'
+
+
+def prefix_tsquery(text):
+    """
+    Converts free text into a tsquery expression where every term must match as a prefix, e.g. "Heal care" becomes
+    "heal:* & care:*". Returns None if there are no searchable terms.
+    """
+    terms = re.sub(r'\W+', ' ', text, flags=re.UNICODE).split()
+    if not terms:
+        return None
+
+    return ' & '.join(['%s:*' % term.lower() for term in terms])
+
+
+def full_text_search(queryset, text, trigram_field=None):
+    """
+    Filters the given queryset to rows whose search vector matches the given text, ordering by rank. If nothing
+    matches and trigram search is enabled, falls back to rows whose trigram_field is similar to the text.
+    """
+    query = prefix_tsquery(text)
+    if not query:
+        return queryset
+
+    table = queryset.model._meta.db_table
+    vector = '"%s"."search_vector"' % table
+
+    matches = queryset.extra(
+        select={'search_rank': "ts_rank(%s, to_tsquery('%s', %%s))" % (vector, SEARCH_CONFIG)},
+        select_params=(query,),
+        where=["%s @@ to_tsquery('%s', %%s)" % (vector, SEARCH_CONFIG)],
+        params=(query,),
+        order_by=('-search_rank',))
+
+    if not (SEARCH_TRIGRAM and trigram_field) or matches.exists():
+        return matches
+
+    column = '"%s"."%s"' % (table, queryset.model._meta.get_field(trigram_field).column)
+
+    return queryset.extra(
+        select={'search_rank': "similarity(%s, %%s)" % column},
+        select_params=(text,),
+        where=["similarity(%s, %%s) > %%s" % column],
+        params=(text, SEARCH_TRIGRAM_THRESHOLD),
+        order_by=('-search_rank',))
+
+
+def add_search_vector(table, weighted_columns, trigram_column=None):
+    """
+    Returns a migration operation which adds a weighted search_vector column to the given table, along with the
+    trigger which keeps it up to date on save and its GIN index. Columns are weighted in the order given. This is a
+    no-op on databases other than Postgres.
+    """
+    function = '%s_search_vector_update' % table
+
+    def vector_sql(prefix):
+        return ' || '.join(["setweight(to_tsvector('%s', coalesce(%s%s, '')), '%s')" % (SEARCH_CONFIG, prefix, c, w)
+                            for c, w in zip(weighted_columns, SEARCH_WEIGHTS)])
+
+    def forwards(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+
+        schema_editor.execute('ALTER TABLE %s ADD COLUMN search_vector tsvector' % table)
+        schema_editor.execute(
+            'CREATE FUNCTION %s() RETURNS trigger AS $$ '
+            'BEGIN NEW.search_vector := %s; RETURN NEW; END '
+            '$$ LANGUAGE plpgsql' % (function, vector_sql('NEW.')))
+        schema_editor.execute(
+            'CREATE TRIGGER %s_search_vector_trigger BEFORE INSERT OR UPDATE OF %s ON %s '
+            'FOR EACH ROW EXECUTE PROCEDURE %s()' % (table, ', '.join(weighted_columns), table, function))
+        schema_editor.execute('UPDATE %s SET search_vector = %s' % (table, vector_sql('')))
+        schema_editor.execute('CREATE INDEX %s_search_vector_idx ON %s USING gin(search_vector)' % (table, table))
+
+        # the trigram index is only created if the extension has been installed (which needs superuser access)
+        if trigram_column:
+            cursor = schema_editor.connection.cursor()
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone():
+                schema_editor.execute('CREATE INDEX %s_%s_trgm_idx ON %s USING gin(%s gin_trgm_ops)'
+                                      % (table, trigram_column, table, trigram_column))
+
+    def backwards(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+
+        if trigram_column:
+            schema_editor.execute('DROP INDEX IF EXISTS %s_%s_trgm_idx' % (table, trigram_column))
+
+        schema_editor.execute('DROP TRIGGER %s_search_vector_trigger ON %s' % (table, table))
+        schema_editor.execute('DROP FUNCTION %s()' % function)
+        schema_editor.execute('ALTER TABLE %s DROP COLUMN search_vector' % table)
+
+    return migrations.RunPython(forwards, backwards)
+
+
+class FullTextSearchMixin(object):
+    """
+    Mixin for list views which replaces smartmin's icontains search with a ranked full text search on Postgres. Other
+    databases continue to use the view's search_fields.
+    """
+    search_trigram_field = None
+
+    def is_full_text_search(self):
+        return is_search_supported() and bool(self.request.GET.get('search', '').strip())
+
+    def derive_search_fields(self):
+        if self.is_full_text_search():
+            return None
+
+        return super(FullTextSearchMixin, self).derive_search_fields()
+
+    def derive_queryset(self, **kwargs):
+        queryset = super(FullTextSearchMixin, self).derive_queryset(**kwargs)
+
+        if self.is_full_text_search():
+            queryset = full_text_search(queryset, self.request.GET['search'], self.search_trigram_field)
+
+        return queryset
+
+    def order_queryset(self, queryset):
+        # keep results ordered by rank unless an explicit ordering has been requested
+        if self.is_full_text_search() and '_order' not in self.request.GET:
+            return queryset
+
+        return super(FullTextSearchMixin, self).order_queryset(queryset)
@@ -1,15 +1,91 @@
 from __future__ import absolute_import, unicode_literals
+from collections import defaultdict, OrderedDict
+import hashlib
+import json
 import logging
+import sys
+import threading
+import time
 
 from enum import Enum
 import six
+from six.moves import queue
 from temba_client.types import Contact as TembaContact
 
-from . import union, intersection, filter_dict
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django_redis import get_redis_connection
+
+from . import union, intersection, filter_dict, bulk_update, chunks, datetime_to_ms, ms_to_datetime
 
 
 logger = logging.getLogger(__name__)
 
+# the number of contacts written to the database in each batch and transaction
+SYNC_BATCH_SIZE = getattr(settings, 'DASH_SYNC_BATCH_SIZE', 500)
+
+# the number of contacts deactivated in each chunk and transaction
+SYNC_DELETE_CHUNK_SIZE = getattr(settings, 'DASH_SYNC_DELETE_CHUNK_SIZE', 500)
+
+# on Postgres, chunks at least this large are deactivated by joining against a VALUES list rather than using IN
+SYNC_DELETE_VALUES_THRESHOLD = getattr(settings, 'DASH_SYNC_DELETE_VALUES_THRESHOLD', 100)
+
+# the number of remote pages to fetch ahead in a separate thread while batches are written, 0 to not prefetch
+SYNC_PREFETCH_PAGES = getattr(settings, 'DASH_SYNC_PREFETCH_PAGES', 0)
+
+# the optional contact class field used to store the fingerprint of the remote contact it was last synced with, which
+# is cleared when the contact is saved or queued to be pushed, since it may then differ from the remote contact
+FINGERPRINT_FIELD = 'sync_fingerprint'
+
+# the number of shards a sharded pull is split into
+SYNC_SHARDS = getattr(settings, 'DASH_SYNC_SHARDS', 4)
+
+# the status of the last or current pull for each org and contact class, including the checkpoint it can resume from
+SYNC_STATUS_KEY = 'sync:%d:%s:status'
+
+# the merged counts and shard states of the last or current sharded pull for each org and contact class
+SYNC_SHARDS_KEY = 'sync:%d:%s:shards'
+
+SYNC_SHARD_LOCK_KEY = 'lock:sync:%d:%s:shard:%d'
+SYNC_SHARD_LOCK_TIME = 60 * 60 * 2
+
+# held while a sharded pull is started or its incomplete shards are queued again
+SYNC_SHARDS_LOCK_KEY = 'lock:sync:%d:%s:shards'
+SYNC_SHARDS_LOCK_TIME = 60
+
+# how long local changes wait in the push outbox before being flushed, so that rapid edits are pushed together
+SYNC_PUSH_DELAY = getattr(settings, 'DASH_SYNC_PUSH_DELAY', 10)
+
+# the number of queued changes pushed by each flush
+SYNC_PUSH_BATCH_SIZE = getattr(settings, 'DASH_SYNC_PUSH_BATCH_SIZE', 100)
+
+# failed pushes are retried after this many seconds, doubling with each attempt, until the attempts run out
+SYNC_PUSH_RETRY_DELAY = getattr(settings, 'DASH_SYNC_PUSH_RETRY_DELAY', 60)
+SYNC_PUSH_MAX_ATTEMPTS = getattr(settings, 'DASH_SYNC_PUSH_MAX_ATTEMPTS', 5)
+
+# changes taken by a flush which haven't been pushed or queued again after this many seconds are assumed lost and are
+# queued again
+SYNC_PUSH_INFLIGHT_TIME = getattr(settings, 'DASH_SYNC_PUSH_INFLIGHT_TIME', 60 * 15)
+
+# the outbox of queued changes for each org and contact class, and when each change is next due to be pushed
+SYNC_OUTBOX_KEY = 'sync:%d:%s:outbox'
+SYNC_OUTBOX_DUE_KEY = 'sync:%d:%s:outbox:due'
+SYNC_OUTBOX_FLUSH_QUEUED_KEY = 'sync:%d:%s:outbox:queued'
+
+# the changes taken from each outbox by a flush which are being pushed, and when they were taken
+SYNC_OUTBOX_INFLIGHT_KEY = 'sync:%d:%s:outbox:inflight'
+SYNC_OUTBOX_TAKEN_KEY = 'sync:%d:%s:outbox:inflight:taken'
+
+# every org and contact class which has had changes queued, for sweep_push_outboxes
+SYNC_OUTBOXES_KEY = 'sync:outboxes'
+
 
 class ChangeType(Enum):
     created = 1
@@ -38,61 +114,773 @@ def sync_push_contact(org, contact, change_type, mutex_group_sets):
     elif change_type == ChangeType.updated:
         # fetch contact so that we can merge with its URNs, fields and groups
         remote_contact = client.get_contact(contact.uuid)
-        local_contact = contact.as_temba()
+        _push_merged_contact(client, contact.as_temba(), remote_contact, mutex_group_sets)
 
-        if temba_compare_contacts(remote_contact, local_contact):
-            merged_contact = temba_merge_contacts(
-                local_contact, remote_contact, mutex_group_sets)
+    elif change_type == ChangeType.deleted:
+        client.delete_contact(contact.uuid)
 
-            # fetched contacts may have fields with null values but we can't
-            # push these so we remove them
-            merged_contact.fields = {k: v
-                                     for k, v in six.iteritems(merged_contact.fields)
-                                     if v is not None}
 
-            client.update_contact(merged_contact.uuid,
-                                  merged_contact.name,
-                                  merged_contact.urns,
-                                  merged_contact.fields,
-                                  merged_contact.groups)
+def _push_merged_contact(client, local_contact, remote_contact, mutex_group_sets):
+    """
+    Merges a local contact with its remote version and pushes the result if it differs from the remote version
+    """
+    if temba_compare_contacts(remote_contact, local_contact):
+        merged_contact = temba_merge_contacts(
+            local_contact, remote_contact, mutex_group_sets)
 
-    elif change_type == ChangeType.deleted:
-        client.delete_contact(contact.uuid)
+        # fetched contacts may have fields with null values but we can't
+        # push these so we remove them
+        merged_contact.fields = {k: v
+                                 for k, v in six.iteritems(merged_contact.fields)
+                                 if v is not None}
+
+        client.update_contact(merged_contact.uuid,
+                              merged_contact.name,
+                              merged_contact.urns,
+                              merged_contact.fields,
+                              merged_contact.groups)
+
+
+def queue_push_contact(org, contact, change_type, mutex_group_sets=None):
+    """
+    Queues a local change to a contact to be pushed later by flush_push_contacts, so that it returns immediately.
+    Changes are coalesced so a contact which is changed many times before the outbox is flushed is only pushed once,
+    with its state at the time of the flush.
+    """
+    keys = _outbox_keys(org, type(contact))
+
+    # group sets are queued as sorted lists since sets can't be serialized
+    if mutex_group_sets is not None:
+        mutex_group_sets = [sorted(group_set) for group_set in mutex_group_sets]
+
+    change = dict(change_type=change_type.value, uuid=contact.uuid, mutex_group_sets=mutex_group_sets, attempts=0)
+
+    # the next pull shouldn't skip this contact even if the remote contact hasn't changed
+    if _has_fingerprint(type(contact)) and getattr(contact, FINGERPRINT_FIELD) is not None:
+        type(contact).objects.filter(pk=contact.pk).update(**{FINGERPRINT_FIELD: None})
+        setattr(contact, FINGERPRINT_FIELD, None)
+
+    _queue_outbox_change(keys, contact.pk, change, time.time() + SYNC_PUSH_DELAY)
+    _queue_outbox_flush(org, type(contact), SYNC_PUSH_DELAY)
+
+    get_redis_connection().sadd(SYNC_OUTBOXES_KEY, '%d:%s' % (org.pk, _contact_class_label(type(contact))))
+
+
+def flush_push_contacts(org, contact_class, batch_size=SYNC_PUSH_BATCH_SIZE):
+    """
+    Pushes a batch of the queued changes which are due for the given org and contact class. Remote versions of updated
+    contacts are fetched together and merged before being pushed. Failed pushes are queued again to be retried with
+    exponential backoff. Changes are kept in flight until they've been pushed or queued again, and changes left in
+    flight by a flush which failed are queued again by the next. Returns the number of changes pushed.
+    """
+    keys = _outbox_keys(org, contact_class)
+    r = get_redis_connection()
+
+    # allow another flush to be queued by changes made from now on
+    cache.delete(SYNC_OUTBOX_FLUSH_QUEUED_KEY % (org.pk, _contact_class_label(contact_class)))
+
+    _recover_outbox_changes(keys)
+
+    # take due changes off the outbox, any changes made while we push them will be queued separately
+    contact_ids = [int(i) for i in r.zrangebyscore(keys['due'], 0, time.time(), start=0, num=batch_size)]
+    if not contact_ids:
+        return 0
+
+    taken, changes = _take_outbox_changes(keys, contact_ids)
+    contacts = contact_class.objects.in_bulk(list(changes.keys()))
+    client = org.get_temba_client()
+    failed = []
+
+    def is_change(contact_id, change_type):
+        return changes[contact_id]['change_type'] == change_type.value and contact_id in contacts
+
+    # fetch the remote versions of all updated contacts with one request
+    updated_uuids = [contacts[c_id].uuid for c_id in changes if is_change(c_id, ChangeType.updated)]
+    try:
+        remote_contacts = client.get_contacts(uuids=updated_uuids) if updated_uuids else []
+        remote_by_uuid = {remote.uuid: remote for remote in remote_contacts}
+    except Exception:
+        logger.exception("Error fetching contacts to push for org #%d" % org.pk)
+        remote_by_uuid = None
+
+    for contact_id, change in six.iteritems(changes):
+        change_type = ChangeType(change['change_type'])
+        try:
+            if change_type == ChangeType.deleted:
+                # contact may have been given a UUID by a create pushed after the delete was queued
+                uuid = contacts[contact_id].uuid if contact_id in contacts else change['uuid']
+                if uuid:
+                    client.delete_contact(uuid)
+
+            elif contact_id not in contacts:
+                continue  # contact has been removed locally since the change was queued
+
+            elif change_type == ChangeType.created:
+                temba_contact = contacts[contact_id].as_temba()
+                temba_contact = client.create_contact(temba_contact.name,
+                                                      temba_contact.urns,
+                                                      temba_contact.fields,
+                                                      temba_contact.groups)
+
+                # update our contact with the new UUID from RapidPro without triggering save hooks
+                contact_class.objects.filter(pk=contact_id).update(uuid=temba_contact.uuid)
+
+            elif remote_by_uuid is None:
+                raise ValueError("Unable to fetch remote contact")
+
+            else:
+                local_contact = contacts[contact_id].as_temba()
+                remote_contact = remote_by_uuid.get(local_contact.uuid)
+                if remote_contact:
+                    mutex_group_sets = [set(group_set) for group_set in change['mutex_group_sets'] or []]
+                    _push_merged_contact(client, local_contact, remote_contact, mutex_group_sets)
+
+        except Exception:
+            logger.exception("Error pushing %s contact #%d for org #%d" % (change_type.name, contact_id, org.pk))
+            failed.append(contact_id)
+
+    for contact_id in failed:
+        change = changes[contact_id]
+        change['attempts'] += 1
+
+        if change['attempts'] < SYNC_PUSH_MAX_ATTEMPTS:
+            retry_delay = SYNC_PUSH_RETRY_DELAY * 2 ** (change['attempts'] - 1)
+            _queue_outbox_change(keys, contact_id, change, time.time() + retry_delay)
+        else:
+            logger.error("Giving up pushing contact #%d for org #%d" % (contact_id, org.pk))
+
+    _finish_outbox_changes(keys, taken, list(changes.keys()))
+
+    # if there are more changes waiting, make sure there's a flush queued for when the next one is due
+    next_due = r.zrange(keys['due'], 0, 0, withscores=True)
+    if next_due:
+        _queue_outbox_flush(org, contact_class, max(next_due[0][1] - time.time(), 0))
+
+    return len(changes) - len(failed)
+
+
+def get_push_outbox(org, contact_class):
+    """
+    Gets the queued changes for the given org and contact class as a dict of contact ids to changes
+    """
+    values = get_redis_connection().hgetall(_outbox_keys(org, contact_class)['outbox'])
+    return {int(contact_id): json.loads(force_text(value)) for contact_id, value in six.iteritems(values)}
+
+
+def sweep_push_outboxes():
+    """
+    Queues a flush of every outbox with changes which are due, including changes left in flight by a flush which
+    failed. This should be run periodically since otherwise these are only pushed once another change is queued for
+    the same org and contact class. Returns the number of flushes queued.
+    """
+    from dash.orgs.models import Org
+
+    r = get_redis_connection()
+    queued = 0
+
+    for outbox in sorted(r.smembers(SYNC_OUTBOXES_KEY)):
+        org_id, label = force_text(outbox).split(':', 1)
+        org = Org.objects.filter(pk=int(org_id)).first()
+        if not org:
+            continue
+
+        contact_class = apps.get_model(label)
+        keys = _outbox_keys(org, contact_class)
+
+        _recover_outbox_changes(keys)
+
+        next_due = r.zrange(keys['due'], 0, 0, withscores=True)
+        if next_due and next_due[0][1] <= time.time():
+            _queue_outbox_flush(org, contact_class, 0)
+            queued += 1
+
+    return queued
+
+
+def _outbox_keys(org, contact_class):
+    label = _contact_class_label(contact_class)
+    return dict(outbox=SYNC_OUTBOX_KEY % (org.pk, label), due=SYNC_OUTBOX_DUE_KEY % (org.pk, label),
+                inflight=SYNC_OUTBOX_INFLIGHT_KEY % (org.pk, label), taken=SYNC_OUTBOX_TAKEN_KEY % (org.pk, label))
+
+
+def _take_outbox_changes(keys, contact_ids):
+    """
+    Moves changes from the outbox to in flight, so they aren't lost if the flush fails before they've been pushed or
+    queued again. Changes to contacts which already have a change in flight are left in the outbox, and delayed so
+    they aren't taken again until it's likely been cleared. Returns the time the changes were taken and a dict of
+    contact ids to changes.
+    """
+    taken = time.time()
+
+    def take(pipe):
+        in_flight = pipe.hmget(keys['inflight'], contact_ids)
+        takeable_ids = [contact_id for contact_id, value in zip(contact_ids, in_flight) if not value]
+        blocked_ids = [contact_id for contact_id, value in zip(contact_ids, in_flight) if value]
+        values = pipe.hmget(keys['outbox'], takeable_ids) if takeable_ids else []
+        values = {contact_id: value for contact_id, value in zip(takeable_ids, values) if value}
+
+        pipe.multi()
+        if takeable_ids:
+            pipe.hdel(keys['outbox'], *takeable_ids)
+            pipe.zrem(keys['due'], *takeable_ids)
+        for contact_id in blocked_ids:
+            pipe.zadd(keys['due'], taken + SYNC_PUSH_DELAY, contact_id)
+        if values:
+            pairs = []
+            for contact_id in values:
+                pairs += [taken, contact_id]
+
+            pipe.hmset(keys['inflight'], values)
+            pipe.zadd(keys['taken'], *pairs)
+
+        return {contact_id: json.loads(force_text(value)) for contact_id, value in six.iteritems(values)}
+
+    r = get_redis_connection()
+    return taken, r.transaction(take, keys['outbox'], keys['due'], keys['inflight'], value_from_callable=True)
+
+
+def _finish_outbox_changes(keys, taken, contact_ids):
+    """
+    Clears changes which have been pushed or queued again, unless they've since been queued again as lost
+    """
+    def finish(pipe):
+        scores = [pipe.zscore(keys['taken'], contact_id) for contact_id in contact_ids]
+        finished_ids = [contact_id for contact_id, score in zip(contact_ids, scores) if score == taken]
+
+        pipe.multi()
+        if finished_ids:
+            pipe.hdel(keys['inflight'], *finished_ids)
+            pipe.zrem(keys['taken'], *finished_ids)
+
+    if contact_ids:
+        get_redis_connection().transaction(finish, keys['taken'])
+
+
+def _recover_outbox_changes(keys):
+    """
+    Queues again changes which have been in flight too long because the flush pushing them failed. Returns the number
+    of changes queued again.
+    """
+    r = get_redis_connection()
+    contact_ids = [int(i) for i in r.zrangebyscore(keys['taken'], 0, time.time() - SYNC_PUSH_INFLIGHT_TIME)]
+    if not contact_ids:
+        return 0
+
+    # queue them before clearing them, so if we fail in between they're pushed twice rather than not at all
+    values = r.hmget(keys['inflight'], contact_ids)
+    for contact_id, value in zip(contact_ids, values):
+        if value:
+            logger.warning("Queueing again lost change to contact #%d" % contact_id)
+            _queue_outbox_change(keys, contact_id, json.loads(force_text(value)), time.time())
+
+    pipe = r.pipeline()
+    pipe.hdel(keys['inflight'], *contact_ids)
+    pipe.zrem(keys['taken'], *contact_ids)
+    pipe.execute()
+
+    return len(contact_ids)
+
+
+def _queue_outbox_change(keys, contact_id, change, due):
+    """
+    Queues a change in the outbox, coalescing it with any change already queued for the same contact
+    """
+    def coalesce(pipe):
+        existing = pipe.hget(keys['outbox'], contact_id)
+        existing_due = pipe.zscore(keys['due'], contact_id)
+        queued = _coalesce_changes(json.loads(force_text(existing)) if existing else None, change)
+
+        pipe.multi()
+        if queued:
+            pipe.hset(keys['outbox'], contact_id, json.dumps(queued))
+            # don't delay a change which was already due
+            pipe.zadd(keys['due'], min(due, existing_due) if existing_due else due, contact_id)
+        else:
+            pipe.hdel(keys['outbox'], contact_id)
+            pipe.zrem(keys['due'], contact_id)
+
+    get_redis_connection().transaction(coalesce, keys['outbox'], keys['due'])
+
+
+def _coalesce_changes(existing, change):
+    """
+    Combines a queued change with a new change to the same contact, returning None if they cancel each other out
+    """
+    if not existing:
+        return change
+
+    existing_type, change_type = ChangeType(existing['change_type']), ChangeType(change['change_type'])
+
+    if existing_type == ChangeType.created:
+        # a contact created and deleted before it was ever pushed doesn't need pushing, otherwise create it as is
+        if change_type == ChangeType.deleted:
+            return None
+        coalesced_type = ChangeType.created
+    elif existing_type == ChangeType.deleted:
+        coalesced_type = ChangeType.deleted
+    else:
+        coalesced_type = change_type
+
+    return dict(change, change_type=coalesced_type.value, uuid=change['uuid'] or existing['uuid'],
+                attempts=max(existing['attempts'], change['attempts']))
+
+
+def _queue_outbox_flush(org, contact_class, countdown):
+    """
+    Queues a task to flush the outbox, unless one is already queued
+    """
+    from .tasks import flush_push_contacts_task
+
+    label = _contact_class_label(contact_class)
+    if cache.add(SYNC_OUTBOX_FLUSH_QUEUED_KEY % (org.pk, label), True, int(countdown) + 1):
+        flush_push_contacts_task.apply_async((org.pk, label), countdown=countdown)
+
+
+class SyncResults(object):
+    """
+    Tallies the outcome of a sync. Keeps the UUIDs of created, updated, deleted and failed contacts, or just counts of
+    them for syncs too large to hold every UUID in memory.
+    """
+    def __init__(self, counts_only=False):
+        self.counts_only = counts_only
+        self.created = 0 if counts_only else []
+        self.updated = 0 if counts_only else []
+        self.deleted = 0 if counts_only else []
+        self.failed = 0 if counts_only else []
+
+    def add(self, outcome, uuids):
+        if self.counts_only:
+            setattr(self, outcome, getattr(self, outcome) + len(uuids))
+        else:
+            getattr(self, outcome).extend(uuids)
+
+    def as_tuple(self):
+        return self.created, self.updated, self.deleted, self.failed
+
+    def as_counts(self):
+        if self.counts_only:
+            return self.as_tuple()
+        return tuple(len(uuids) for uuids in self.as_tuple())
+
+
+def iter_contact_pages(client, start_page=1, **kwargs):
+    """
+    Iterates over pages of remote contacts matching the given get_contacts arguments, only ever holding one page.
+    Each page is yielded with its page number.
+    """
+    pager = client.pager(start_page)
+    page = start_page
+    while True:
+        contacts = client.get_contacts(pager=pager, **kwargs)
+        if contacts:
+            yield page, contacts
+
+        if not pager.has_more():
+            break
+
+        page += 1
+
+
+def iter_contact_batches(pages, batch_size, checkpoint=None, checkpoint_uuids=()):
+    """
+    Iterates over batches of remote contacts of the given size from the given pages, regardless of how many contacts
+    are in each page. Contacts modified at the checkpoint time whose UUIDs are given have already been processed and
+    are skipped.
+    """
+    checkpoint_uuids = set(checkpoint_uuids)
+    batch = []
+
+    for page, contacts in pages:
+        for contact in contacts:
+            if checkpoint and contact.modified_on == checkpoint and contact.uuid in checkpoint_uuids:
+                continue
+
+            batch.append(contact)
+
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def iter_timed(iterator, timings, *stages):
+    """
+    Iterates over the given iterator, adding the time spent getting each item to the given stages of timings
+    """
+    iterator = iter(iterator)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            for stage in stages:
+                timings[stage] += time.time() - start
+
+        yield item
+
+
+def iter_prefetched(iterator, size, timings):
+    """
+    Iterates over the given iterator from a separate thread which keeps up to size items ahead of the caller, so that
+    fetching the next items overlaps with processing the current one. Time spent fetching is added to the fetch stage
+    of timings and time spent waiting for the thread to the wait stage. Errors in the thread are re-raised here.
+    """
+    items = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(kind, value):
+        # don't block forever if the caller has stopped iterating
+        while not stopped.is_set():
+            try:
+                items.put((kind, value), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iter_timed(iterator, timings, 'fetch'):
+                if not put('item', item):
+                    return
+        except Exception:
+            put('error', sys.exc_info())
+        else:
+            put('end', None)
+
+    thread = threading.Thread(target=produce, name='sync-prefetch')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            start = time.time()
+            kind, value = items.get()
+            timings['wait'] += time.time() - start
+
+            if kind == 'end':
+                break
+            elif kind == 'error':
+                six.reraise(*value)
+
+            yield value
+    finally:
+        stopped.set()
+
+
+def get_sync_status(org, contact_class, shard=None):
+    """
+    Gets the status of the last or current pull of the given contact class for the given org, or None if there
+    hasn't been one. This is a dict with the state (running, complete or failed), the last_time the pull was made
+    with, when it started and finished, the phase (contacts or deleted) and checkpoint it has reached, and counts of
+    created, updated, deleted and failed contacts so far.
+    """
+    return cache.get(_sync_status_key(org, contact_class, shard))
+
+
+def set_sync_status(org, contact_class, status, shard=None):
+    """
+    Replaces the status of the last pull of the given contact class for the given org, e.g. with one saved before
+    running a pull which shouldn't affect the next real pull. A status of None clears it.
+    """
+    if status is None:
+        cache.delete(_sync_status_key(org, contact_class, shard))
+    else:
+        cache.set(_sync_status_key(org, contact_class, shard), status, None)
+
+
+def _contact_class_label(contact_class):
+    return '%s.%s' % (contact_class._meta.app_label, contact_class._meta.model_name)
+
+
+def _sync_status_key(org, contact_class, shard=None):
+    key = SYNC_STATUS_KEY % (org.pk, _contact_class_label(contact_class))
+    return key if shard is None else '%s:%d' % (key, shard)
 
 
 def sync_pull_contacts(org, contact_class, fields=None, groups=None,
-                       last_time=None, delete_blocked=False):
+                       last_time=None, delete_blocked=False, counts_only=False, batch_size=SYNC_BATCH_SIZE,
+                       resume=True, prefetch=SYNC_PREFETCH_PAGES, before=None, shard=None):
     """
     Pulls updated contacts or all contacts from RapidPro and syncs with local contacts.
     Contact class must define a class method called kwargs_from_temba which generates
     field kwargs from a fetched temba contact.
 
+    Remote contacts are fetched a page at a time and written in batches, each in its own transaction, so memory use
+    is bounded by the batch size rather than the number of contacts in the org. Contacts are created with bulk_create
+    so the contact class's save method isn't called for them.
+
+    If the contact class has a sync_fingerprint field (CharField of length 32), incoming contacts whose fingerprint
+    matches the stored one are skipped without being compared. Contact classes should clear it when a contact is
+    changed locally.
+
+    A checkpoint is saved to the sync status after each batch is committed, and if a pull with the same last_time
+    didn't complete, this one resumes from its checkpoint. As RapidPro returns contacts newest first, the checkpoint
+    is the modification time of the oldest contact processed, along with the UUIDs of the processed contacts modified
+    at that time, and resuming fetches only contacts modified at or before it. So contacts deleted or modified before
+    a pull resumes don't shift it past unprocessed contacts, and contacts modified while a pull is running are never
+    missed as they will be pulled again using the status started_on as the next last_time. Contacts without a
+    modification time can't be checkpointed, so a pull of them resumes from the start.
+
+    Time spent fetching pages, processing batches and waiting on fetches is recorded in the status timings. Without
+    prefetching, waiting and fetching are the same. With it, a large wait time means fetching bounds throughput.
+
     :param org: the org
     :param contact_class: the contact class type
     :param fields: the contact field keys used - used to determine if local contact differs
     :param groups: the contact group UUIDs used - used to determine if local contact differs
     :param last_time: the last time we pulled contacts, if None, sync all contacts
     :param delete_blocked: if True, delete the blocked contacts
-    :return: tuple containing list of UUIDs for created, updated, deleted and failed contacts
+    :param counts_only: if True, return counts of contacts rather than lists of UUIDs
+    :param batch_size: the number of contacts to write in each batch
+    :param resume: if True, resume from the checkpoint of an incomplete pull with the same last_time
+    :param prefetch: the number of pages to fetch ahead in a separate thread while batches are written
+    :param before: if provided, only sync contacts modified before this time
+    :param shard: the shard number if this pull is one shard of a sharded pull, which gives it its own status
+    :return: tuple containing list of UUIDs (or counts) for created, updated, deleted and failed contacts
     """
-    # get all remote contacts
     client = org.get_temba_client()
-    updated_incoming_contacts = []
-    if last_time:
-        updated_incoming_contacts = client.get_contacts(after=last_time)
-    else:
-        updated_incoming_contacts = client.get_contacts()
+    results = SyncResults(counts_only)
+
+    status_key = _sync_status_key(org, contact_class, shard)
+    status = cache.get(status_key)
+
+    if not (resume and status and status['state'] != 'complete' and 'checkpoint' in status
+            and status['last_time'] == last_time and status.get('before') == before):
+        status = dict(last_time=last_time, before=before, started_on=timezone.now(), finished_on=None,
+                      phase='contacts', checkpoint=None, checkpoint_uuids=[],
+                      created=0, updated=0, deleted=0, failed=0)
+
+    previous_counts = (status['created'], status['updated'], status['deleted'], status['failed'])
+    status['timings'] = timings = dict(fetch=0.0, process=0.0, wait=0.0)
+
+    def fetch_batches(**kwargs):
+        # contacts come newest first, so those not yet processed were modified at or before the checkpoint
+        pages = iter_contact_pages(client, after=last_time, before=status['checkpoint'] or before, **kwargs)
+        if prefetch:
+            pages = iter_prefetched(pages, prefetch, timings)
+        else:
+            # fetching happens on this thread so all of its time is spent waiting
+            pages = iter_timed(pages, timings, 'fetch', 'wait')
+
+        return iter_contact_batches(pages, batch_size, status['checkpoint'], status['checkpoint_uuids'])
+
+    def save_status(state, **kwargs):
+        status.update(state=state, **kwargs)
+        counts = [prev + count for prev, count in zip(previous_counts, results.as_counts())]
+        status.update(zip(('created', 'updated', 'deleted', 'failed'), counts))
+        cache.set(status_key, status, None)
+
+    def save_checkpoint(batch):
+        oldest = batch[-1].modified_on
+        if oldest is None:
+            save_status('running')
+            return
+
+        uuids = [contact.uuid for contact in batch if contact.modified_on == oldest]
+        if oldest == status['checkpoint']:
+            uuids = status['checkpoint_uuids'] + uuids
+
+        save_status('running', checkpoint=oldest, checkpoint_uuids=uuids)
+
+    save_status('running')
+
+    try:
+        if status['phase'] == 'contacts':
+            for incoming_contacts in fetch_batches():
+                start = time.time()
+                sync_pull_contacts_batch(org, contact_class, incoming_contacts, fields, groups, delete_blocked,
+                                         results)
+                timings['process'] += time.time() - start
+
+                save_checkpoint(incoming_contacts)
+
+            save_status('running', phase='deleted', checkpoint=None, checkpoint_uuids=[])
+
+        # any contact that has been deleted from rapidpro
+        # should also be deleted from dash
+        # if last_time was passed in, just get contacts deleted after the last time we synced
+        for deleted_incoming_contacts in fetch_batches(deleted=True):
+            start = time.time()
+            deleted_uuids = [deleted_incoming.uuid for deleted_incoming in deleted_incoming_contacts]
+
+            deactivate_contacts(org, contact_class, deleted_uuids)
+            results.add('deleted', deleted_uuids)
+            timings['process'] += time.time() - start
+
+            save_checkpoint(deleted_incoming_contacts)
+
+    except Exception:
+        save_status('failed')
+        raise
+
+    save_status('complete', finished_on=timezone.now())
+
+    logger.info("Pulled %s contacts for org #%d (fetch: %.2fs, process: %.2fs, wait: %.2fs)"
+                % (contact_class.__name__, org.pk, timings['fetch'], timings['process'], timings['wait']))
+
+    return results.as_tuple()
+
+
+def get_sync_shard_windows(org, last_time, until, num_shards):
+    """
+    Splits the period from last_time until the given time into num_shards windows of modification time, returned as
+    (after, before) tuples. If last_time is None, the period starts when the org was created, and the first window
+    has no start so that it includes contacts modified before then.
+    """
+    start = last_time or org.created_on
+    if start >= until:
+        return [(last_time, until)]
+
+    step = (until - start) / num_shards
+    windows = []
+    for shard in range(num_shards):
+        after = start + step * shard if shard else last_time
+        before = start + step * (shard + 1) if shard < num_shards - 1 else until
+        windows.append((after, before))
+
+    return windows
+
+
+def sync_pull_contacts_sharded(org, contact_class, fields=None, groups=None, last_time=None, delete_blocked=False,
+                               num_shards=SYNC_SHARDS):
+    """
+    Splits a pull into shards by modification time and queues a task to pull each, so that large orgs can be synced
+    by several workers at once. Each shard has its own lock and checkpoint, and its counts are merged into the
+    sharded status when it completes.
+
+    If the previous sharded pull still has pending shards, a new one isn't started. Instead the previous pull's
+    incomplete shards are queued again, so shards which failed or were lost resume from their checkpoints, and shards
+    which are still running are skipped by their workers.
+
+    :return: the time the pull was made until, which should be the next last_time once all shards are complete, or
+             None if another process is starting a sharded pull for the same org and contact class
+    """
+    from .tasks import sync_pull_contacts_shard_task
+
+    label = _contact_class_label(contact_class)
+    key = SYNC_SHARDS_KEY % (org.pk, label)
+    r = get_redis_connection()
+
+    lock = r.lock(SYNC_SHARDS_LOCK_KEY % (org.pk, label), timeout=SYNC_SHARDS_LOCK_TIME)
+    if not lock.acquire(blocking=False):
+        logger.info("Skipping sharded %s pull for org #%d which is already being started" % (label, org.pk))
+        return None
+
+    try:
+        previous = get_sharded_sync_status(org, contact_class)
+        if previous and previous['pending'] > 0:
+            until = previous['until']
+            shard_args = [json.loads(force_text(value)) for field, value in six.iteritems(r.hgetall(key))
+                          if force_text(field).startswith('args:')
+                          and previous['shards'].get(int(force_text(field)[5:])) != 'complete']
+        else:
+            shard_args = None
+
+        if shard_args:
+            logger.info("Queueing %d incomplete shards of previous %s pull for org #%d"
+                        % (len(shard_args), label, org.pk))
+        else:
+            # windows are passed to tasks as millisecond timestamps so make sure the last one ends exactly at until
+            until = ms_to_datetime(datetime_to_ms(timezone.now()))
+            windows = get_sync_shard_windows(org, last_time, until, num_shards)
+            shard_args = [(org.pk, label, shard, datetime_to_ms(after) if after else None, datetime_to_ms(before),
+                           fields, groups, delete_blocked) for shard, (after, before) in enumerate(windows)]
+
+            # each shard's task arguments are kept so it can be queued again if it doesn't complete
+            values = dict(until=datetime_to_ms(until), pending=len(windows), created=0, updated=0, deleted=0, failed=0)
+            values.update({'args:%d' % args[2]: json.dumps(args) for args in shard_args})
+
+            r.pipeline().delete(key).hmset(key, values).execute()
+    finally:
+        lock.release()
+
+    for args in sorted(shard_args):
+        sync_pull_contacts_shard_task.delay(*args)
+    return until
+
+
+def sync_pull_contacts_shard(org, contact_class, shard, after, before, fields=None, groups=None,
+                             delete_blocked=False):
+    """
+    Pulls one shard of a sharded pull, unless it's already complete or being pulled by another worker
+    """
+    label = _contact_class_label(contact_class)
+    key = SYNC_SHARDS_KEY % (org.pk, label)
+    shard_field = 'shard:%d' % shard
 
-    # get all existing contacts and organize by their UUID
-    existing_contacts = contact_class.objects.filter(org=org)
+    r = get_redis_connection()
+    if r.hget(key, shard_field) == b'complete':
+        return
+
+    lock = r.lock(SYNC_SHARD_LOCK_KEY % (org.pk, label, shard), timeout=SYNC_SHARD_LOCK_TIME)
+    if not lock.acquire(blocking=False):
+        logger.info("Skipping shard %d of %s pull for org #%d which is already running" % (shard, label, org.pk))
+        return
+
+    try:
+        # another worker may have completed the shard before we got the lock
+        if r.hget(key, shard_field) == b'complete':
+            return
+
+        counts = sync_pull_contacts(org, contact_class, fields, groups, last_time=after,
+                                    delete_blocked=delete_blocked, counts_only=True, before=before, shard=shard)
+    except Exception:
+        r.hset(key, shard_field, 'failed')
+        raise
+    finally:
+        lock.release()
+
+    pipe = r.pipeline()
+    for outcome, count in zip(('created', 'updated', 'deleted', 'failed'), counts):
+        pipe.hincrby(key, outcome, count)
+    pipe.hset(key, shard_field, 'complete')
+    pipe.hincrby(key, 'pending', -1)
+    pipe.execute()
+
+
+def get_sharded_sync_status(org, contact_class):
+    """
+    Gets the status of the last or current sharded pull of the given contact class for the given org, or None if
+    there hasn't been one. This is a dict with the time the pull was made until, the number of pending shards, the
+    state of each started shard, and merged counts of created, updated, deleted and failed contacts.
+    """
+    values = get_redis_connection().hgetall(SYNC_SHARDS_KEY % (org.pk, _contact_class_label(contact_class)))
+    if not values:
+        return None
+
+    values = {force_text(k): force_text(v) for k, v in six.iteritems(values)}
+    status = dict(until=ms_to_datetime(int(values.pop('until'))), shards={})
+
+    for field, value in six.iteritems(values):
+        if field.startswith('shard:'):
+            status['shards'][int(field[6:])] = value
+        elif not field.startswith('args:'):
+            status[field] = int(value)
+
+    return status
+
+
+def sync_pull_contacts_batch(org, contact_class, incoming_contacts, fields, groups, delete_blocked, results):
+    """
+    Syncs a batch of fetched remote contacts with the matching local contacts
+    """
+    # get the existing contacts for this batch only and organize by their UUID
+    existing_contacts = contact_class.objects.filter(org=org, uuid__in=[c.uuid for c in incoming_contacts])
     existing_by_uuid = {contact.uuid: contact for contact in existing_contacts}
+    has_fingerprint = _has_fingerprint(contact_class)
 
-    created_uuids = []
-    updated_uuids = []
+    new_contacts = OrderedDict()
+    updated_contacts = OrderedDict()
+    updated_by_fields = defaultdict(list)  # updated contacts organized by which fields changed
     deleted_uuids = []
     failed_uuids = []
 
-    for updated_incoming in updated_incoming_contacts:
+    for updated_incoming in incoming_contacts:
         # delete blocked contacts if deleted_blocked=True
         if updated_incoming.blocked and delete_blocked:
             deleted_uuids.append(updated_incoming.uuid)
@@ -100,22 +888,41 @@ def sync_pull_contacts(org, contact_class, fields=None, groups=None,
         elif updated_incoming.uuid in existing_by_uuid:
             existing = existing_by_uuid[updated_incoming.uuid]
 
-            diff = temba_compare_contacts(updated_incoming, existing.as_temba(), fields, groups)
+            if has_fingerprint:
+                fingerprint = temba_contact_fingerprint(updated_incoming, fields, groups)
 
-            if diff or not existing.is_active:
-                try:
-                    kwargs = contact_class.kwargs_from_temba(org, updated_incoming)
-                except ValueError:
-                    failed_uuids.append(updated_incoming.uuid)
+                # contact hasn't changed since we last synced it so no need to compare
+                if existing.is_active and getattr(existing, FINGERPRINT_FIELD) == fingerprint:
                     continue
 
-                for field, value in six.iteritems(kwargs):
-                    setattr(existing, field, value)
+            diff = temba_compare_contacts(updated_incoming, existing.as_temba(), fields, groups)
 
-                existing.is_active = True
-                existing.save()
+            if not diff and existing.is_active:
+                # only the fingerprint needs saving so that next time we can skip the comparison
+                if has_fingerprint:
+                    setattr(existing, FINGERPRINT_FIELD, fingerprint)
+                    updated_by_fields[(FINGERPRINT_FIELD,)].append(existing)
+                continue
 
-                updated_uuids.append(updated_incoming.uuid)
+            try:
+                kwargs = contact_class.kwargs_from_temba(org, updated_incoming)
+            except ValueError:
+                failed_uuids.append(updated_incoming.uuid)
+                continue
+
+            kwargs['is_active'] = True
+            if has_fingerprint:
+                kwargs[FINGERPRINT_FIELD] = fingerprint
+
+            changed_fields = [f for f, v in six.iteritems(kwargs) if _field_changed(existing, f, v)]
+            if not changed_fields:
+                continue
+
+            for field in changed_fields:
+                setattr(existing, field, kwargs[field])
+
+            updated_contacts[existing.uuid] = existing
+            updated_by_fields[tuple(sorted(changed_fields))].append(existing)
         else:
             try:
                 kwargs = contact_class.kwargs_from_temba(org, updated_incoming)
@@ -123,21 +930,123 @@ def sync_pull_contacts(org, contact_class, fields=None, groups=None,
                 failed_uuids.append(updated_incoming.uuid)
                 continue
 
-            contact_class.objects.create(**kwargs)
-            created_uuids.append(kwargs['uuid'])
+            if has_fingerprint:
+                kwargs[FINGERPRINT_FIELD] = temba_contact_fingerprint(updated_incoming, fields, groups)
+
+            # a contact modified while we were paging may appear twice, in which case the last one wins
+            new_contacts[kwargs['uuid']] = contact_class(**kwargs)
+
+    with transaction.atomic():
+        if new_contacts:
+            contact_class.objects.bulk_create(new_contacts.values())
+
+        for changed_fields, contacts in six.iteritems(updated_by_fields):
+            if changed_fields:
+                bulk_update(contacts, changed_fields)
+
+        if deleted_uuids:
+            deactivate_contacts(org, contact_class, deleted_uuids)
+
+    results.add('created', list(new_contacts.keys()))
+    results.add('updated', list(updated_contacts.keys()))
+    results.add('deleted', deleted_uuids)
+    results.add('failed', failed_uuids)
+
+
+def deactivate_contacts(org, contact_class, uuids, chunk_size=SYNC_DELETE_CHUNK_SIZE):
+    """
+    Deactivates the active local contacts with the given UUIDs in chunks, each in its own transaction so that row
+    locks on the contacts table are only held briefly. Returns the number of contacts deactivated.
+    """
+    deactivated = 0
+    for chunk in chunks(uuids, chunk_size):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql' and len(chunk) >= SYNC_DELETE_VALUES_THRESHOLD:
+                deactivated += _deactivate_contacts_by_values(org, contact_class, chunk)
+            else:
+                contacts = contact_class.objects.filter(org=org, uuid__in=chunk, is_active=True)
+                deactivated += contacts.update(is_active=False)
 
-    # any contact that has been deleted from rapidpro
-    # should also be deleted from dash
-    # if last_time was passed in, just get contacts deleted after the last time we synced
-    if last_time:
-        deleted_incoming_contacts = client.get_contacts(deleted=True, after=last_time)
+    return deactivated
+
+
+def _deactivate_contacts_by_values(org, contact_class, uuids):
+    """
+    Deactivates contacts by joining against a VALUES list, which Postgres plans better than a large IN list
+    """
+    meta = contact_class._meta
+    quote = connection.ops.quote_name
+
+    sql = ('UPDATE {table} SET {active} = false FROM (VALUES {values}) AS deleted(uuid) '
+           'WHERE {table}.{uuid} = deleted.uuid AND {table}.{org} = %s AND {table}.{active}').format(
+        table=quote(meta.db_table),
+        active=quote(meta.get_field('is_active').column),
+        uuid=quote(meta.get_field('uuid').column),
+        org=quote(meta.get_field('org').column),
+        values=', '.join(['(%s)'] * len(uuids)))
+
+    cursor = connection.cursor()
+    cursor.execute(sql, list(uuids) + [org.pk])
+    return cursor.rowcount
+
+
+def _has_fingerprint(contact_class):
+    try:
+        contact_class._meta.get_field(FINGERPRINT_FIELD)
+        return True
+    except FieldDoesNotExist:
+        return False
+
+
+@receiver(pre_save)
+def _clear_fingerprint(sender, instance, update_fields=None, **kwargs):
+    """
+    Clears the fingerprint of a contact saved locally, since it may no longer match the remote contact. Syncs save
+    fingerprints with bulk queries which don't send signals, or with update_fields which include the fingerprint.
+    """
+    if not _has_fingerprint(sender) or getattr(instance, FINGERPRINT_FIELD) is None:
+        return
+
+    if update_fields is None:
+        setattr(instance, FINGERPRINT_FIELD, None)
+    elif FINGERPRINT_FIELD not in update_fields and instance.pk:
+        sender.objects.filter(pk=instance.pk).update(**{FINGERPRINT_FIELD: None})
+        setattr(instance, FINGERPRINT_FIELD, None)
+
+
+def _field_changed(obj, field_name, value):
+    """
+    Checks whether setting the given field to the given value would change the object, without loading related
+    objects
+    """
+    field = obj._meta.get_field(field_name)
+    if getattr(field, 'rel', None) and value is not None and hasattr(value, 'pk'):
+        return getattr(obj, field.attname) != value.pk
+
+    return getattr(obj, field_name) != value
+
+
+def temba_contact_fingerprint(contact, fields=None, groups=None):
+    """
+    Generates a stable hash of the parts of a Temba contact compared by temba_compare_contacts, so that two contacts
+    with the same fingerprint (for the same fields and groups) compare as equal
+    """
+    if groups is None:
+        contact_groups = sorted(contact.groups)
+    elif groups:
+        contact_groups = sorted(intersection(contact.groups, groups))
     else:
-        deleted_incoming_contacts = client.get_contacts(deleted=True)
-    for deleted_incoming in deleted_incoming_contacts:
-        deleted_uuids.append(deleted_incoming.uuid)
-    existing_contacts.filter(uuid__in=deleted_uuids).update(is_active=False)
+        contact_groups = []
 
-    return created_uuids, updated_uuids, deleted_uuids, failed_uuids
+    if fields is None:
+        contact_fields = contact.fields
+    elif fields:
+        contact_fields = filter_dict(contact.fields, fields)
+    else:
+        contact_fields = {}
+
+    projection = [contact.name, sorted(contact.urns), contact_groups, contact_fields]
+    return hashlib.md5(json.dumps(projection, sort_keys=True).encode('utf-8')).hexdigest()
 
 
 def temba_compare_contacts(first, second, fields=None, groups=None):
@@ -151,15 +1060,14 @@ def temba_compare_contacts(first, second, fields=None, groups=None):
     if first.name != second.name:
         return 'name'
 
-    if sorted(first.urns) != sorted(second.urns):
+    if not _same_items(first.urns, second.urns):
         return 'urns'
 
-    if groups is None and (sorted(first.groups) != sorted(second.groups)):
+    if groups is None and not _same_items(first.groups, second.groups):
         return 'groups'
     if groups:
-        a = sorted(intersection(first.groups, groups))
-        b = sorted(intersection(second.groups, groups))
-        if a != b:
+        groups = set(groups)
+        if groups.intersection(first.groups) != groups.intersection(second.groups):
             return 'groups'
 
     if fields is None and (first.fields != second.fields):
@@ -187,27 +1095,50 @@ def temba_merge_contacts(first, second, mutex_group_sets):
     merged_fields = second.fields.copy()
     merged_fields.update(first.fields)
 
-    # first merge mutually exclusive group sets
-    first_groups = list(first.groups)
-    second_groups = list(second.groups)
+    # first merge mutually exclusive group sets, taking the first group from each set that the first contact is in,
+    # or failing that the second contact. A group in more than one set is only used by the first of those sets.
+    first_positions = _first_positions(first.groups)
+    second_positions = _first_positions(second.groups)
+    used_groups = set()
     merged_mutex_groups = []
     for group_set in mutex_group_sets:
-        from_first = intersection(first_groups, group_set)
-        if from_first:
-            merged_mutex_groups.append(from_first[0])
-        else:
-            from_second = intersection(second_groups, group_set)
-            if from_second:
-                merged_mutex_groups.append(from_second[0])
+        available = [g for g in group_set if g not in used_groups]
 
-        for group in group_set:
-            if group in first_groups:
-                first_groups.remove(group)
-            if group in second_groups:
-                second_groups.remove(group)
+        for positions in (first_positions, second_positions):
+            in_contact = [g for g in available if g in positions]
+            if in_contact:
+                merged_mutex_groups.append(min(in_contact, key=positions.get))
+                break
+
+        used_groups.update(available)
 
     # then merge the remaining groups
-    merged_groups = merged_mutex_groups + union(first_groups, second_groups)
+    merged_groups = merged_mutex_groups + [g for g in union(first.groups, second.groups) if g not in used_groups]
 
     return TembaContact.create(uuid=first.uuid, name=first.name,
                                urns=merged_urns, fields=merged_fields, groups=merged_groups)
+
+
+def _same_items(first, second):
+    """
+    Returns whether two lists contain the same items, ignoring order. Equivalent to comparing them sorted but
+    without sorting unless there are duplicates.
+    """
+    if len(first) != len(second):
+        return False
+
+    first_set = set(first)
+    if first_set != set(second):
+        return False
+
+    return len(first_set) == len(first) or sorted(first) == sorted(second)
+
+
+def _first_positions(items):
+    """
+    Maps each item in a list to the position of its first occurrence
+    """
+    positions = {}
+    for position, item in enumerate(items):
+        positions.setdefault(item, position)
+    return positions
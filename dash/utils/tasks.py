@@ -0,0 +1,52 @@
+from __future__ import absolute_import, unicode_literals
+import logging
+
+from celery import shared_task
+
+from django.apps import apps
+
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(name='utils.generate_image_variants')
+def generate_image_variants_task(name):
+    from .images import generate_image_variants
+
+    try:
+        generate_image_variants(name)
+    except Exception as e:
+        logger.exception("Error generating variants of image %s: %s" % (name, str(e)))
+
+
+@shared_task(name='utils.sync_pull_contacts_shard')
+def sync_pull_contacts_shard_task(org_id, contact_class_label, shard, after, before, fields, groups,
+                                  delete_blocked):
+    from dash.orgs.models import Org
+    from . import ms_to_datetime
+    from .sync import sync_pull_contacts_shard
+
+    org = Org.objects.get(pk=org_id)
+    contact_class = apps.get_model(contact_class_label)
+
+    sync_pull_contacts_shard(org, contact_class, shard, ms_to_datetime(after) if after else None,
+                             ms_to_datetime(before), fields, groups, delete_blocked)
+
+
+@shared_task(name='utils.flush_push_contacts')
+def flush_push_contacts_task(org_id, contact_class_label):
+    from dash.orgs.models import Org
+    from .sync import flush_push_contacts
+
+    org = Org.objects.get(pk=org_id)
+    contact_class = apps.get_model(contact_class_label)
+
+    flush_push_contacts(org, contact_class)
+
+
+@shared_task(name='utils.sweep_push_outboxes')
+def sweep_push_outboxes_task():
+    from .sync import sweep_push_outboxes
+
+    queued = sweep_push_outboxes()
+    logger.debug("Task: sweep_push_outboxes queued %d flushes" % queued)
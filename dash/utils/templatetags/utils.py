@@ -2,6 +2,8 @@ from __future__ import absolute_import, unicode_literals
 
 from django import template
 
+from dash.utils.images import get_image_variants
+
 
 register = template.Library()
 
@@ -14,3 +16,30 @@ def if_url(context, url_name, yes, no):
     """
     current = context['request'].resolver_match.url_name
     return yes if url_name == current else no
+
+
+@register.assignment_tag
+def image_variants(image, image_format=None):
+    """
+    Gets the pre-generated variants of an image, optionally only in the given format
+    Example:
+        - image_variants story.get_image 'WEBP' as variants
+    """
+    variants = get_image_variants(image)
+    if image_format:
+        variants = [v for v in variants if v['format'] == image_format]
+    return variants
+
+
+@register.simple_tag()
+def image_srcset(image, image_format='JPEG'):
+    """
+    Builds a srcset from the pre-generated variants of an image, which is empty until they have been generated
+    Example:
+        %img{ src:"{{ image.url }}", srcset:"{% image_srcset image 'JPEG' %}" }
+    """
+    by_width = {}
+    for variant in image_variants(image, image_format):
+        by_width.setdefault(variant['width'], variant['url'])
+
+    return ', '.join(['%s %dw' % (by_width[width], width) for width in sorted(by_width.keys())])
@@ -1,8 +1,11 @@
 from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
 from datetime import datetime
 import json
+import random
 
 import pytz
+import six
 from temba_client.types import Contact as TembaContact
 
 from django.core.cache import cache
@@ -12,7 +15,8 @@ from django.utils import timezone
 from . import (
     intersection, union, random_string, filter_dict, get_cacheable,
     get_obj_cacheable, get_month_range, chunks)
-from .sync import temba_compare_contacts, temba_merge_contacts
+from .search import prefix_tsquery
+from .sync import temba_compare_contacts, temba_contact_fingerprint, temba_merge_contacts
 
 
 class InitTest(TestCase):
@@ -29,6 +33,11 @@ class InitTest(TestCase):
         self.assertEqual(union([2, 1, 1], [1, 2, 3]), [2, 1, 3])  # order is first seen
         self.assertEqual(union([2, 1], [2, 3, 3], [4, 5]), [2, 1, 3, 4, 5])
 
+        # arguments aren't modified
+        first = [1, 2]
+        self.assertEqual(union(first, [3]), [1, 2, 3])
+        self.assertEqual(first, [1, 2])
+
     def test_random_string(self):
         rs = random_string(1000)
         self.assertEqual(1000, len(rs))
@@ -77,6 +86,76 @@ class InitTest(TestCase):
         self.assertEqual(list(chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
 
 
+class SearchTest(TestCase):
+    def test_prefix_tsquery(self):
+        self.assertIsNone(prefix_tsquery(""))
+        self.assertIsNone(prefix_tsquery(" !? "))
+        self.assertEqual(prefix_tsquery("Health"), "health:*")
+        self.assertEqual(prefix_tsquery("  Heal care's&|"), "heal:* & care:* & s:*")
+
+
+def reference_temba_compare_contacts(first, second, fields=None, groups=None):
+    """
+    The original list based implementation of temba_compare_contacts
+    """
+    if first.name != second.name:
+        return 'name'
+
+    if sorted(first.urns) != sorted(second.urns):
+        return 'urns'
+
+    if groups is None and (sorted(first.groups) != sorted(second.groups)):
+        return 'groups'
+    if groups:
+        a = sorted(intersection(first.groups, groups))
+        b = sorted(intersection(second.groups, groups))
+        if a != b:
+            return 'groups'
+
+    if fields is None and (first.fields != second.fields):
+        return 'fields'
+    if fields and (filter_dict(first.fields, fields) != filter_dict(second.fields, fields)):
+        return 'fields'
+
+    return None
+
+
+def reference_temba_merge_contacts(first, second, mutex_group_sets):
+    """
+    The original list based implementation of temba_merge_contacts
+    """
+    first_urns_by_scheme = {u[0]: u[1] for u in [urn.split(':', 1) for urn in first.urns]}
+    urns_by_scheme = {u[0]: u[1] for u in [urn.split(':', 1) for urn in second.urns]}
+    urns_by_scheme.update(first_urns_by_scheme)
+    merged_urns = ['%s:%s' % (scheme, path) for scheme, path in six.iteritems(urns_by_scheme)]
+
+    merged_fields = second.fields.copy()
+    merged_fields.update(first.fields)
+
+    first_groups = list(first.groups)
+    second_groups = list(second.groups)
+    merged_mutex_groups = []
+    for group_set in mutex_group_sets:
+        from_first = intersection(first_groups, group_set)
+        if from_first:
+            merged_mutex_groups.append(from_first[0])
+        else:
+            from_second = intersection(second_groups, group_set)
+            if from_second:
+                merged_mutex_groups.append(from_second[0])
+
+        for group in group_set:
+            if group in first_groups:
+                first_groups.remove(group)
+            if group in second_groups:
+                second_groups.remove(group)
+
+    merged_groups = merged_mutex_groups + list(OrderedDict.fromkeys(first_groups + second_groups))
+
+    return TembaContact.create(uuid=first.uuid, name=first.name,
+                               urns=merged_urns, fields=merged_fields, groups=merged_groups)
+
+
 class SyncTest(TestCase):
     def test_temba_compare_contacts(self):
         # no differences
@@ -129,6 +208,78 @@ class SyncTest(TestCase):
         self.assertIsNone(temba_compare_contacts(first, second, fields=()))
         self.assertIsNone(temba_compare_contacts(first, second, fields=('chat_name',)))
 
+    def test_temba_contact_fingerprint(self):
+        first = TembaContact.create(
+            uuid='000-001', name="Ann", urns=['tel:1234', 'twitter:ann'], groups=['000-001', '000-002'],
+            fields=dict(chat_name="ann", age=18), language='eng', modified_on=timezone.now())
+        fingerprint = temba_contact_fingerprint(first)
+        self.assertEqual(len(fingerprint), 32)
+
+        # order of URNs and groups doesn't matter
+        second = TembaContact.create(
+            uuid='000-001', name="Ann", urns=['twitter:ann', 'tel:1234'], groups=['000-002', '000-001'],
+            fields=dict(age=18, chat_name="ann"), language='fre', modified_on=timezone.now())
+        self.assertEqual(temba_contact_fingerprint(second), fingerprint)
+
+        # but contacts which compare as different have different fingerprints
+        second = TembaContact.create(
+            uuid='000-001', name="Ann", urns=['tel:1234', 'twitter:ann'], groups=['000-001', '000-003'],
+            fields=dict(chat_name="annie", age=18), language='eng', modified_on=timezone.now())
+        self.assertNotEqual(temba_contact_fingerprint(second), fingerprint)
+
+        # unless the differences are in groups or fields which aren't being compared
+        self.assertEqual(temba_contact_fingerprint(second, fields=('age',), groups=('000-001',)),
+                         temba_contact_fingerprint(first, fields=('age',), groups=('000-001',)))
+        self.assertEqual(temba_contact_fingerprint(second, fields=(), groups=()),
+                         temba_contact_fingerprint(first, fields=(), groups=()))
+
+    def random_contact(self, rand, num_groups):
+        """
+        Generates a random contact whose groups are unique, as they are in RapidPro
+        """
+        urns = ['%s:%d' % (rand.choice(('tel', 'twitter', 'email')), rand.randint(1, 5))
+                for u in range(rand.randint(0, 3))]
+        fields = {rand.choice(('age', 'state', 'gender')): rand.choice((None, 'a', 'b'))
+                  for f in range(rand.randint(0, 3))}
+        groups = rand.sample(['G-%03d' % g for g in range(num_groups)], rand.randint(0, num_groups))
+
+        return TembaContact.create(uuid='C-001', name=rand.choice(("Ann", "Bob")), urns=urns, fields=fields,
+                                   groups=groups)
+
+    def random_group_sets(self, rand, num_groups):
+        # sets can overlap and contain groups not in either contact
+        return [rand.sample(['G-%03d' % g for g in range(num_groups + 3)], rand.randint(1, 4))
+                for s in range(rand.randint(0, 5))]
+
+    def test_temba_compare_contacts_matches_reference(self):
+        rand = random.Random(1234)
+
+        for i in range(500):
+            first, second = self.random_contact(rand, 6), self.random_contact(rand, 6)
+            fields = rand.choice((None, (), ('age',), ('age', 'state')))
+            groups = rand.choice((None, (), ('G-001',), ('G-000', 'G-002', 'G-009')))
+
+            self.assertEqual(temba_compare_contacts(first, second, fields, groups),
+                             reference_temba_compare_contacts(first, second, fields, groups))
+
+    def test_temba_merge_contacts_matches_reference(self):
+        rand = random.Random(1234)
+
+        for i in range(500):
+            first, second = self.random_contact(rand, 8), self.random_contact(rand, 8)
+            group_sets = self.random_group_sets(rand, 8)
+
+            first_groups, second_groups = list(first.groups), list(second.groups)
+
+            merged = temba_merge_contacts(first, second, group_sets)
+            expected = reference_temba_merge_contacts(first, second, group_sets)
+
+            self.assertEqual((merged.uuid, merged.name, merged.urns, merged.fields, merged.groups),
+                             (expected.uuid, expected.name, expected.urns, expected.fields, expected.groups))
+
+            # contacts being merged aren't modified
+            self.assertEqual((first.groups, second.groups), (first_groups, second_groups))
+
     def test_temba_merge_contacts(self):
         contact1 = TembaContact.create(uuid="000-001", name="Bob",
                                        urns=['tel:123', 'email:bob@bob.com'],
@@ -0,0 +1,43 @@
+from __future__ import absolute_import, unicode_literals
+import json
+
+from temba_client.types import Contact as TembaContact
+
+from django.db import models
+
+from dash.orgs.models import Org
+
+
+class Contact(models.Model):
+    """
+    Minimal local contact used to test contact syncing
+    """
+    org = models.ForeignKey(Org)
+
+    uuid = models.CharField(max_length=36, unique=True, null=True)
+
+    name = models.CharField(max_length=128, null=True)
+
+    urns = models.TextField(default='[]')
+
+    groups = models.TextField(default='[]')
+
+    fields = models.TextField(default='{}')
+
+    is_active = models.BooleanField(default=True)
+
+    sync_fingerprint = models.CharField(max_length=32, null=True)
+
+    @classmethod
+    def kwargs_from_temba(cls, org, temba_contact):
+        if 'invalid' in temba_contact.fields:
+            raise ValueError("Contact has invalid field")
+
+        return dict(org=org, uuid=temba_contact.uuid, name=temba_contact.name,
+                    urns=json.dumps(sorted(temba_contact.urns)),
+                    groups=json.dumps(sorted(temba_contact.groups)),
+                    fields=json.dumps(temba_contact.fields, sort_keys=True))
+
+    def as_temba(self):
+        return TembaContact.create(uuid=self.uuid, name=self.name, urns=json.loads(self.urns),
+                                   groups=json.loads(self.groups), fields=json.loads(self.fields))
@@ -72,6 +72,7 @@ INSTALLED_APPS = (
     'dash.stories',
     'dash.utils',
 
+    'dash_test_runner',
 )
 
 MIDDLEWARE_CLASSES = (
@@ -1,33 +1,67 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from importlib import import_module
+from io import BytesIO
 import json
+import pytz
 import redis
+import requests
+import threading
+import time
 import urllib
+from unittest import skipUnless
 
-from mock import patch, Mock
+from mock import call, patch, Mock
+from PIL import Image
+from six import StringIO
 from smartmin.tests import SmartminTest
 from temba_client import __version__ as client_version
 from temba_client.client import TembaClient
-from temba_client.types import Geometry, Boundary
+from temba_client.base import TembaPager
+from temba_client.types import Geometry, Boundary, Contact as TembaContact
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
 from django.core.exceptions import DisallowedHost
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse, ResolverMatch
+from django.db import connection
 from django.db.utils import IntegrityError
 from django.http import HttpRequest
+from django.test.utils import CaptureQueriesContext
 from django.utils.encoding import force_text
+from django_redis import get_redis_connection
 
-from dash.api import API
+from dash.api import API, DISTRICT, REQUEST_TIMEOUT, RESULT_CACHE_TIME, get_segment_digest, parse_retry_after
+from dash.api.circuit import CircuitBreaker
+from dash.api.stats import clear_cache_stats, flush_cache_stats, get_cache_specs, get_cache_stats
+from dash.api.throttle import ThrottledError, get_throttle_stats, get_token_digest, throttled
 from dash.categories.models import Category, CategoryImage
 from dash.dashblocks.models import DashBlockType, DashBlock, DashBlockImage
 from dash.dashblocks.templatetags.dashblocks import load_qbs
+from dash.utils.fake import FakeTembaClient
 from dash.orgs.middleware import SetOrgMiddleware
 from dash.orgs.models import Org, OrgBackground, Invitation
+from dash.orgs.tasks import backfill_flow_messages, warm_caches
 from dash.orgs.templatetags.dashorgs import display_time, national_phone
 from dash.orgs.context_processors import GroupPermWrapper
 from dash.stories.models import Story, StoryImage
+from dash.utils import datetime_to_ms
+from dash.utils.images import get_image_variants, generate_image_variants
+from dash.utils.search import full_text_search
+from dash.utils.sync import deactivate_contacts, get_sync_status, get_sync_shard_windows, get_sharded_sync_status
+from dash.utils.sync import sync_pull_contacts, sync_pull_contacts_batch, sync_pull_contacts_sharded
+from dash.utils.sync import ChangeType, flush_push_contacts, get_push_outbox, queue_push_contact, sweep_push_outboxes
+from dash.utils.sync import set_sync_status, temba_contact_fingerprint
+from dash.utils.tasks import sync_pull_contacts_shard_task
+from dash.utils.templatetags.utils import image_srcset
+
+from .models import Contact
 
 
 class UserTest(SmartminTest):
@@ -105,6 +139,8 @@ class DashTest(SmartminTest):
         # Clear DashBlockType from old migrations
         DashBlockType.objects.all().delete()
 
+        self.clear_cache()
+
     def clear_cache(self):
         # hardcoded to localhost
         r = redis.StrictRedis(host='localhost', db=1)
@@ -141,6 +177,11 @@ class DashTest(SmartminTest):
         self.assertEquals(Org.objects.filter(subdomain=subdomain).count(), 1)
         return Org.objects.get(subdomain=subdomain)
 
+    def upload_image(self, name, size=(4, 4)):
+        data = BytesIO()
+        Image.new('RGB', size).save(data, 'JPEG')
+        return SimpleUploadedFile(name, data.getvalue(), content_type='image/jpeg')
+
     def read_json(self, filename):
         from django.conf import settings
         handle = open('%s/test_api/%s.json' % (settings.TESTFILES_DIR, filename))
@@ -503,7 +544,7 @@ class OrgTest(DashTest):
             with patch('django.core.cache.cache.set') as cache_set_mock:
                 cache_set_mock.return_value = "Set"
 
-                with patch('dash.orgs.models.TembaClient.get_boundaries') as mock_client:
+                with patch('temba_client.client.TembaClient.get_boundaries') as mock_client:
                     geometry1 = Geometry.create(type='MultiPolygon', coordinates=[[1, 2], [3, 4]])
                     geometry2 = Geometry.create(type='MultiPolygon', coordinates=[[5, 6], [7, 8]])
                     level_1_boundary = Boundary.create(boundary='R195269', name='Burundi', level=1, parent="",
@@ -1243,9 +1284,10 @@ class OrgBackgroundTest(DashTest):
 
 class MockResponse(object):
 
-    def __init__(self, status_code, content=''):
+    def __init__(self, status_code, content='', headers=None):
         self.content = content
         self.status_code = status_code
+        self.headers = headers or {}
 
     def raise_for_status(self):
         if self.status_code != 200:
@@ -1280,7 +1322,8 @@ class APITest(DashTest):
                                                      params={'name': 'group_name'},
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
@@ -1291,7 +1334,8 @@ class APITest(DashTest):
                                                      params={'name': 'group_name'},
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
@@ -1302,7 +1346,8 @@ class APITest(DashTest):
                                                      params={'name': 'group_name'},
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
@@ -1313,7 +1358,8 @@ class APITest(DashTest):
                                                      params={'name': 'group_name'},
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
@@ -1324,7 +1370,8 @@ class APITest(DashTest):
                                                      params={'name': 'group_name'},
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
     @patch('requests.models.Response', MockResponse)
     def test_get_ruleset_results(self):
@@ -1336,7 +1383,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?ruleset=101&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertIsNone(self.api.get_ruleset_results(101, dict(location='State')))
             mock_request_get.assert_called_with(
@@ -1345,7 +1393,8 @@ class APITest(DashTest):
                                                                        dict(location='LGA'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertIsNone(self.api.get_ruleset_results(101, dict(location='District')))
             mock_request_get.assert_called_with(
@@ -1354,7 +1403,8 @@ class APITest(DashTest):
                                                                        dict(location='Province'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
             self.assertEquals(mock_request_get.call_count, 3)
 
         with patch('requests.get') as mock_request_get:
@@ -1365,7 +1415,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?ruleset=101&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertIsNone(self.api.get_ruleset_results(101, dict(location='State')))
             mock_request_get.assert_called_with(
@@ -1374,7 +1425,8 @@ class APITest(DashTest):
                                                                        dict(location='LGA'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertIsNone(self.api.get_ruleset_results(101, dict(location='District')))
             mock_request_get.assert_called_with(
@@ -1383,7 +1435,8 @@ class APITest(DashTest):
                                                                        dict(location='Province'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(mock_request_get.call_count, 3)
 
@@ -1395,7 +1448,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?ruleset=101&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertIsNone(self.api.get_ruleset_results(101, dict(location='State')))
             mock_request_get.assert_called_with(
@@ -1404,7 +1458,8 @@ class APITest(DashTest):
                                                                        dict(location='LGA'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertIsNone(self.api.get_ruleset_results(101, dict(location='District')))
             mock_request_get.assert_called_with(
@@ -1413,7 +1468,8 @@ class APITest(DashTest):
                                                                        dict(location='Province'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(mock_request_get.call_count, 3)
 
@@ -1425,7 +1481,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?ruleset=101&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(self.api.get_ruleset_results(101, dict(location='State')), ["RULESET_DATA"])
             mock_request_get.assert_called_with(
@@ -1434,7 +1491,8 @@ class APITest(DashTest):
                                                                        dict(location='LGA'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(self.api.get_ruleset_results(101, dict(location='District')), ["RULESET_DATA"])
             mock_request_get.assert_called_with(
@@ -1443,10 +1501,199 @@ class APITest(DashTest):
                                                                        dict(location='Province'))).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(mock_request_get.call_count, 3)
 
+    @patch('requests.models.Response', MockResponse)
+    def test_get_ruleset_results_keys(self):
+        self.assertEqual(get_segment_digest(OrderedDict([('location', 'LGA'), ('contact_field', 'age')])),
+                         get_segment_digest(OrderedDict([('contact_field', 'age'), ('location', 'LGA')])))
+        self.assertNotEqual(get_segment_digest(dict(location='LGA')), get_segment_digest(dict(location='lga')))
+        self.assertEqual(len(get_segment_digest(dict(location='LGA'))), 32)
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=["RULESET_DATA"])))
+
+            # caller's segment isn't modified
+            segment = dict(location='State')
+            self.assertEqual(self.api.get_ruleset_results(101, segment), ["RULESET_DATA"])
+            self.assertEqual(segment, dict(location='State'))
+
+            # and a segment which normalizes to the same thing uses the same cached value
+            self.assertEqual(self.api.get_ruleset_results(101, dict(location='LGA')), ["RULESET_DATA"])
+            self.assertEqual(self.api.get_contact_field_results('Age', dict(location='District')), ["RULESET_DATA"])
+            self.assertEqual(mock_request_get.call_count, 2)
+
+            # invalidating an org's results means they're fetched again, by this or any other API instance
+            API(self.org).invalidate_results()
+
+            api = API(self.org)
+            self.assertEqual(api.get_ruleset_results(101, segment), ["RULESET_DATA"])
+            self.assertEqual(api.get_contact_field_results('Age', dict(location='District')), ["RULESET_DATA"])
+            self.assertEqual(mock_request_get.call_count, 4)
+
+            self.assertEqual(API(self.org).get_ruleset_results(101, segment), ["RULESET_DATA"])
+            self.assertEqual(mock_request_get.call_count, 4)
+
+        # fallbacks survive invalidation
+        self.api.invalidate_results()
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = requests.ConnectionError()
+            self.assertEqual(self.api.get_ruleset_results(101, segment), ["RULESET_DATA"])
+
+    @patch('requests.models.Response', MockResponse)
+    def test_get_ruleset_results_many(self):
+        def get_results(url, **kwargs):
+            ruleset_id = int(urllib.unquote(url).split('ruleset=')[1].split('&')[0])
+            if ruleset_id == 104:
+                return MockResponse(500, "Server error")
+            return MockResponse(200, json.dumps(dict(results=["RULESET_%d" % ruleset_id])))
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = get_results
+
+            # one ruleset is already cached
+            self.assertEqual(self.api.get_ruleset_results(101, dict(location='State')), ["RULESET_101"])
+
+            results = self.api.get_ruleset_results_many([101, 102, 103, 104], dict(location='State'))
+            self.assertEqual(results, {101: ["RULESET_101"], 102: ["RULESET_102"], 103: ["RULESET_103"], 104: None})
+            self.assertEqual(mock_request_get.call_count, 4)
+
+            # results fetched together are cached the same way as results fetched one at a time
+            self.assertEqual(self.api.get_ruleset_results(102, dict(location='LGA')), ["RULESET_102"])
+            self.assertEqual(mock_request_get.call_count, 4)
+
+            # when everything is cached, it's a single cache read
+            with patch('dash.api.cache.get_many', wraps=cache.get_many) as mock_get_many:
+                with patch('dash.api.cache.get', wraps=cache.get) as mock_get:
+                    results = self.api.get_ruleset_results_many([101, 102, 103], dict(location='State'))
+
+            self.assertEqual(results, {101: ["RULESET_101"], 102: ["RULESET_102"], 103: ["RULESET_103"]})
+            self.assertEqual(mock_get_many.call_count, 1)
+            self.assertEqual(mock_get.call_count, 0)
+            self.assertEqual(mock_request_get.call_count, 4)
+
+            # a ruleset being fetched elsewhere falls back to its last value
+            self.api.invalidate_results()
+            r = get_redis_connection()
+
+            with r.lock('lock:%s' % self.api._get_results_key('rs', '101', dict(location='LGA'))):
+                results = self.api.get_ruleset_results_many([101, 102], dict(location='State'))
+
+            self.assertEqual(results, {101: ["RULESET_101"], 102: ["RULESET_102"]})
+            self.assertEqual(mock_request_get.call_count, 5)
+
+    @patch('requests.models.Response', MockResponse)
+    def test_get_ruleset_choropleth(self):
+        def feature(boundary_id):
+            return dict(type='Feature', geometry=None, properties=dict(name=boundary_id, id=boundary_id, level=1))
+
+        geojson = dict(type='FeatureCollection', features=[feature('R1'), feature('R2'), feature('R3')])
+        cache.set('org:%d:boundaries' % self.org.pk, dict(time=0, results={'geojson:%d' % self.org.id: geojson}))
+
+        results = [dict(boundary='R2', label="Two", set=4, unset=1,
+                        categories=[dict(label="Yes", count=3), dict(label="No", count=1)]),
+                   dict(boundary='R1', label="One", set=3, unset=0,
+                        categories=[dict(label="No", count=2), dict(label="Maybe", count=1)]),
+                   dict(boundary='R9', label="Unknown", set=1, unset=0,
+                        categories=[dict(label="Yes", count=1)])]
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=results)))
+
+            choropleth = self.api.get_ruleset_choropleth(101)
+            self.assertEqual(choropleth, dict(
+                categories=["Yes", "No", "Maybe"],
+                boundary_ids=['R1', 'R2', 'R3'],
+                boundaries={'R1': dict(set=3, unset=0, counts=[0, 2, 1], percentages=[0, 67, 33]),
+                            'R2': dict(set=4, unset=1, counts=[3, 1, 0], percentages=[75, 25, 0]),
+                            'R3': dict(set=0, unset=0, counts=[0, 0, 0], percentages=[0, 0, 0])}))
+
+            mock_request_get.assert_called_once_with(
+                '%s/api/v1/results.json?ruleset=101&segment=%s' % (settings.API_ENDPOINT,
+                                                                   urllib.quote(force_text(json.dumps(
+                                                                       dict(location='LGA'))).encode('utf8'))),
+                headers={'Content-type': 'application/json',
+                         'Accept': 'application/json',
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
+
+            # the joined results and the underlying results are both cached
+            self.assertEqual(self.api.get_ruleset_choropleth(101), choropleth)
+            self.assertEqual(self.api.get_ruleset_results(101, dict(location='State')), results)
+            self.assertEqual(mock_request_get.call_count, 1)
+
+            # refreshing fetches new results for every requested choropleth
+            results[0]['categories'][0]['count'] = 7
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=results)))
+
+            self.api.refresh_choropleths()
+            self.assertEqual(mock_request_get.call_count, 2)
+
+            choropleth = self.api.get_ruleset_choropleth(101)
+            self.assertEqual(choropleth['boundaries']['R2']['counts'], [7, 1, 0])
+            self.assertEqual(self.api.get_ruleset_results(101, dict(location='State')), results)
+            self.assertEqual(mock_request_get.call_count, 2)
+
+            # choropleths which haven't been requested for a while are no longer refreshed
+            with patch('dash.api.time.time', return_value=time.time() + 60 * 60 * 25):
+                self.api.refresh_choropleths()
+
+            self.assertEqual(mock_request_get.call_count, 2)
+
+        # no boundaries means no choropleth
+        cache.delete('org:%d:boundaries' % self.org.pk)
+        self.api.invalidate_results()
+
+        with patch('dash.orgs.models.Org.rebuild_org_boundaries_task'):
+            with patch('requests.get') as mock_request_get:
+                mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=results)))
+                self.assertEqual(self.api.get_ruleset_choropleth(101, DISTRICT, 'R1'), None)
+
+    @patch('requests.models.Response', MockResponse)
+    def test_get_ruleset_results_many_concurrently(self):
+        def get_results(url, **kwargs):
+            ruleset_id = int(urllib.unquote(url).split('ruleset=')[1].split('&')[0])
+            time.sleep(0.05)
+            return MockResponse(200, json.dumps(dict(results=["RULESET_%d" % ruleset_id])))
+
+        results = {}
+
+        def get_many(name, ruleset_ids):
+            results[name] = API(self.org).get_ruleset_results_many(ruleset_ids)
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = get_results
+
+            # overlapping rulesets requested in different orders, with no fallbacks to serve while waiting
+            threads = [threading.Thread(target=get_many, args=('a', [8, 1])),
+                       threading.Thread(target=get_many, args=('b', [1, 8, 2, 3, 4, 5]))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+
+            self.assertFalse([thread for thread in threads if thread.is_alive()])
+
+        self.assertEqual(results['a'], {8: ["RULESET_8"], 1: ["RULESET_1"]})
+        self.assertEqual(results['b'], {r_id: ["RULESET_%d" % r_id] for r_id in [1, 8, 2, 3, 4, 5]})
+
+        # and no locks are left behind
+        self.assertEqual(get_redis_connection().keys('*lock:*'), [])
+
+        # waiting for a lock which isn't released is bounded, after which we calculate the value ourselves
+        self.api.invalidate_results()
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = get_results
+
+            with patch('dash.api.LOCK_WAIT_TIME', 0.2):
+                with get_redis_connection().lock('lock:%s' % self.api._get_results_key('rs', '9', None)):
+                    self.assertEqual(self.api.get_ruleset_results_many([9, 10]), {9: ["RULESET_9"], 10: ["RULESET_10"]})
+
     @patch('requests.models.Response', MockResponse)
     def test_get_contact_field_results(self):
         with patch('requests.get') as mock_request_get:
@@ -1457,7 +1704,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?contact_field=contact_field_name&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(self.api.get_contact_field_results('contact_field_name', dict(location='State')),
                               ["CONTACT_FIELD_DATA"])
@@ -1469,7 +1717,8 @@ class APITest(DashTest):
                                                                                             )).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(self.api.get_contact_field_results('contact_field_name', dict(location='District')),
                               ["CONTACT_FIELD_DATA"])
@@ -1483,7 +1732,8 @@ class APITest(DashTest):
                                                                                         ).encode('utf8'))),
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(mock_request_get.call_count, 3)
 
@@ -1497,7 +1747,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?contact_field=contact_field_name&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             mock_request_get.return_value = MockResponse(200, 'invalid_json')
@@ -1507,7 +1758,8 @@ class APITest(DashTest):
                 '%s/api/v1/results.json?contact_field=contact_field_name&segment=null' % settings.API_ENDPOINT,
                 headers={'Content-type': 'application/json',
                          'Accept': 'application/json',
-                         'Authorization': 'Token %s' % self.org.api_token})
+                         'Authorization': 'Token %s' % self.org.api_token},
+                timeout=REQUEST_TIMEOUT)
 
     @patch('requests.models.Response', MockResponse)
     def test_get_flows(self):
@@ -1534,12 +1786,14 @@ class APITest(DashTest):
             mock_request_get.assert_any_call('%s/api/v1/flows.json' % settings.API_ENDPOINT,
                                              headers={'Content-type': 'application/json',
                                                       'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+                                                      'Authorization': 'Token %s' % self.org.api_token},
+                                             timeout=REQUEST_TIMEOUT)
 
             mock_request_get.assert_any_call('NEXT_PAGE',
                                              headers={'Content-type': 'application/json',
                                                       'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+                                                      'Authorization': 'Token %s' % self.org.api_token},
+                                             timeout=REQUEST_TIMEOUT)
 
             self.assertEquals(mock_request_get.call_count, 2)
 
@@ -1563,7 +1817,8 @@ class APITest(DashTest):
             mock_request_get.assert_called_once_with('%s/api/v1/flows.json' % settings.API_ENDPOINT,
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
@@ -1574,80 +1829,545 @@ class APITest(DashTest):
             mock_request_get.assert_called_once_with('%s/api/v1/flows.json' % settings.API_ENDPOINT,
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
     @patch('requests.models.Response', MockResponse)
     def test_get_flow(self):
-        with patch('requests.get') as mock_request_get:
-            mock_request_get.side_effect = [MockResponse(200,
-                                                         self.read_json('flows_page_1')
-                                                         ),
+        flow_1 = dict(flow=5, name="FLOW_1", rulesets=[dict(id=11, label="Age"), dict(id=12, label="Gender")])
+        flow_2 = dict(flow=6, name="FLOW_2", rulesets=[dict(id=13, label="Water")])
 
-                                            MockResponse(200,
-                                                         self.read_json('flows_page_2')
-                                                         )
-                                            ]
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = [MockResponse(200, json.dumps(dict(results=[flow_1], next='NEXT_PAGE'))),
+                                            MockResponse(200, json.dumps(dict(results=[flow_2], next=None)))]
 
-            self.assertEquals(self.api.get_flow(5), dict(name="FLOW_1", rulesets=['FLOW_1_RULESET_DICT']))
+            self.assertEquals(self.api.get_flow(5), flow_1)
 
-            mock_request_get.assert_any_call('%s/api/v1/flows.json?flow=5' % settings.API_ENDPOINT,
+            mock_request_get.assert_any_call('%s/api/v1/flows.json' % settings.API_ENDPOINT,
                                              headers={'Content-type': 'application/json',
                                                       'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+                                                      'Authorization': 'Token %s' % self.org.api_token},
+                                             timeout=REQUEST_TIMEOUT)
 
             mock_request_get.assert_any_call('NEXT_PAGE',
                                              headers={'Content-type': 'application/json',
                                                       'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+                                                      'Authorization': 'Token %s' % self.org.api_token},
+                                             timeout=REQUEST_TIMEOUT)
+
+            self.assertEquals(mock_request_get.call_count, 2)
+
+            # other flows and rulesets come from the same index
+            self.assertEquals(self.api.get_flow(6), flow_2)
+            self.assertIsNone(self.api.get_flow(7))
+            self.assertEquals(self.api.get_ruleset(12), (flow_1, dict(id=12, label="Gender")))
+            self.assertEquals(self.api.get_ruleset(13), (flow_2, dict(id=13, label="Water")))
+            self.assertEquals(self.api.get_ruleset(14), (None, None))
+            self.assertEquals(mock_request_get.call_count, 2)
+
+        # the index is written whenever the full flow list is fetched
+        self.clear_cache()
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = [MockResponse(200, json.dumps(dict(results=[flow_1, flow_2], next=None)))]
+
+            self.assertEquals(self.api.get_flows(), [flow_1, flow_2])
+            self.assertEquals(self.api.get_flow(6), flow_2)
+            self.assertEquals(mock_request_get.call_count, 1)
+
+        # but not when the list is filtered
+        cache.delete('flows_index:%d' % self.org.id)
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = [MockResponse(200, json.dumps(dict(results=[flow_1], next=None))),
+                                            MockResponse(200, json.dumps(dict(results=[flow_1, flow_2], next=None)))]
 
+            self.assertEquals(self.api.get_flows('archived=false'), [flow_1])
+            self.assertEquals(self.api.get_flow(6), flow_2)
             self.assertEquals(mock_request_get.call_count, 2)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
 
-            mock_request_get.side_effect = [MockResponse(404,
-                                                         self.read_json('flows_page_1')
-                                                         ),
+            mock_request_get.side_effect = [MockResponse(404, json.dumps(dict(results=[flow_1], next='NEXT_PAGE')))]
 
-                                            MockResponse(404,
-                                                         self.read_json('flows_page_2')
-                                                         )
-                                            ]
+            self.assertIsNone(self.api.get_flow(5))
+
+            mock_request_get.assert_called_once_with('%s/api/v1/flows.json' % settings.API_ENDPOINT,
+                                                     headers={'Content-type': 'application/json',
+                                                              'Accept': 'application/json',
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
+
+        with patch('requests.get') as mock_request_get:
+            self.clear_cache()
+
+            mock_request_get.side_effect = [MockResponse(200, json.dumps(dict(results=[flow_1], next='NEXT_PAGE'))),
+                                            MockResponse(404, json.dumps(dict(results=[flow_2], next=None)))]
 
             self.assertIsNone(self.api.get_flow(5))
+            self.assertEquals(mock_request_get.call_count, 2)
 
-            mock_request_get.assert_any_call('%s/api/v1/flows.json?flow=5' % settings.API_ENDPOINT,
-                                             headers={'Content-type': 'application/json',
-                                                      'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+    @patch('requests.models.Response', MockResponse)
+    def test_get_flow_messages(self):
+        messages = [dict(id=i, text="Message %d" % i, direction='I') for i in range(40, 0, -1)]
+        pages = []
 
-            self.assertEquals(mock_request_get.call_count, 1)
+        def get_messages(url, params=None, **kwargs):
+            pages.append((url, params))
+            page = 1 if url.endswith('messages.json') else int(url.split('page=')[1])
+            results = messages[(page - 1) * 10:page * 10]
+            next_url = 'NEXT_PAGE?page=%d' % (page + 1) if page * 10 < len(messages) else None
+            return MockResponse(200, json.dumps(dict(results=results, next=next_url)))
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = get_messages
+
+            # first time we only pull the first page, and leave the rest to a background task
+            with patch('dash.orgs.tasks.backfill_flow_messages.delay') as mock_backfill:
+                self.assertEqual(self.api.get_flow_messages(7, direction='I'), messages[:10])
+
+            self.assertEqual(pages, [('%s/api/v1/messages.json' % settings.API_ENDPOINT,
+                                      dict(flow=7, direction='I'))])
+            mock_backfill.assert_called_once_with(self.org.id, 7, 'I')
+
+            # if the background task fails, where it got to is kept
+            del pages[:]
+            mock_request_get.side_effect = requests.ConnectionError()
+            with patch('dash.api.time.sleep'):
+                self.assertRaises(requests.ConnectionError, backfill_flow_messages, self.org.id, 7, 'I')
+
+            mock_request_get.side_effect = get_messages
+
+            # and a later pull doesn't stop at the newest stored message, but where the unfinished pull stops
+            messages[:0] = [dict(id=i, text="Message %d" % i, direction='I') for i in range(45, 40, -1)]
+            cache.delete('flow_messages_pulled:%d:7:I' % self.org.id)
+
+            with patch('dash.orgs.tasks.backfill_flow_messages.delay') as mock_backfill:
+                self.assertEqual(self.api.get_flow_messages(7, direction='I'), messages[:15])
+
+            self.assertEqual(pages, [('%s/api/v1/messages.json' % settings.API_ENDPOINT,
+                                      dict(flow=7, direction='I'))])
+            mock_backfill.assert_called_once_with(self.org.id, 7, 'I')
+
+            # so the background task it queues again still fills the gap
+            del pages[:]
+            backfill_flow_messages(*mock_backfill.call_args[0])
+            self.assertEqual(pages, [('NEXT_PAGE?page=2', None),
+                                     ('NEXT_PAGE?page=3', None),
+                                     ('NEXT_PAGE?page=4', None),
+                                     ('NEXT_PAGE?page=5', None)])
+            self.assertIsNone(get_redis_connection().get('flow_messages_backfill:%d:7:I' % self.org.id))
+
+            # which does nothing when there's nothing left to pull
+            backfill_flow_messages(*mock_backfill.call_args[0])
+            self.assertEqual(len(pages), 4)
+            del pages[:]
+
+            # which pulls every message, and we return pages of 25 rather than RapidPro's page size
+            self.assertEqual(self.api.get_flow_messages(7, direction='I'), messages[:25])
+
+            # pages after the first come from the store
+            self.assertEqual(self.api.get_flow_messages(7, page=1, direction='I'), messages[25:])
+            self.assertEqual(self.api.get_flow_messages(7, page=2, direction='I'), [])
+            self.assertEqual(len(pages), 0)
+
+            # after a while, we only pull the messages which are new
+            messages[:0] = [dict(id=i, text="Message %d" % i, direction='I') for i in range(48, 45, -1)]
+            cache.delete('flow_messages_pulled:%d:7:I' % self.org.id)
+            del pages[:]
+
+            self.assertEqual(self.api.get_flow_messages(7, direction='I'), messages[:25])
+            self.assertEqual(len(pages), 1)
+
+            # the store is bounded
+            with patch('dash.api.FLOW_MESSAGES_MAX', 30):
+                messages[:0] = [dict(id=49, text="Message 49", direction='I')]
+                cache.delete('flow_messages_pulled:%d:7:I' % self.org.id)
+
+                self.assertEqual(self.api.get_flow_messages(7, page=1, direction='I'), messages[25:30])
+
+            # errors pulling new messages still give us what we have
+            mock_request_get.side_effect = requests.ConnectionError()
+            cache.delete('flow_messages_pulled:%d:7:I' % self.org.id)
+
+            with patch('dash.api.time.sleep'):
+                self.assertEqual(self.api.get_flow_messages(7, direction='I'), messages[:25])
+
+    @patch('requests.models.Response', MockResponse)
+    @patch('dash.api.stats.STATS_SAMPLE_RATE', 1)
+    @patch('dash.api.stats.STATS_FLUSH_SIZE', 1000)
+    def test_warm_cache(self):
+        # start with no counts from other tests
+        flush_cache_stats()
+        clear_cache_stats(self.org.id)
+
+        def get_results(url, **kwargs):
+            if 'groups.json' in url:
+                return MockResponse(200, json.dumps(dict(results=["GROUP_%s" % kwargs['params']['name']])))
+            ruleset_id = int(urllib.unquote(url).split('ruleset=')[1].split('&')[0])
+            return MockResponse(200, json.dumps(dict(results=["RULESET_%d" % ruleset_id])))
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.side_effect = get_results
+
+            for i in range(3):
+                self.api.get_ruleset_results(101, dict(location='State'))
+            for i in range(2):
+                self.api.get_group('Reporters')
+            self.api.get_ruleset_results_many([101, 102])
+            self.assertEqual(mock_request_get.call_count, 4)
+
+            # candidates are the most read keys of the cache stats, along with how to calculate them
+            flush_cache_stats()
+            self.assertEqual(get_cache_specs(self.org.id)[:2], [
+                (self.api._get_results_key('rs', '101', dict(location='LGA')), ['rs', [101, dict(location='LGA')]]),
+                ('group:%d:reporters' % self.org.id, ['group', ['Reporters']])])
+
+            # nothing is about to expire
+            self.assertEqual(self.api.warm_cache(), 0)
+            self.assertEqual(mock_request_get.call_count, 4)
+
+            with patch('dash.api.WARM_AHEAD_TIME', 60 * 60 * 2):
+                # the most read values are refreshed first, up to the budget
+                self.assertEqual(self.api.warm_cache(budget=2, concurrency=1), 2)
+                self.assertEqual([c[0][0] for c in mock_request_get.call_args_list[4:]], [
+                    '%s/api/v1/results.json?ruleset=101&segment=%s' % (
+                        settings.API_ENDPOINT, urllib.quote(json.dumps(dict(location='LGA')))),
+                    '%s/api/v1/groups.json' % settings.API_ENDPOINT])
+
+                # and cached as if they'd been read
+                cache.set(self.api._get_results_key('rs', '101', dict(location='LGA')), ["STALE"])
+                self.assertEqual(self.api.warm_cache(budget=1, concurrency=1), 1)
+                self.assertEqual(self.api.get_ruleset_results(101, dict(location='LGA')), ["RULESET_101"])
+
+                # families which aren't warmed are skipped
+                with patch('dash.api.WARM_FAMILIES', ('rs',)):
+                    self.api.warm_cache()
+
+                self.assertFalse([c for c in mock_request_get.call_args_list[7:] if 'groups.json' in c[0][0]])
+
+        # values which are no longer among the most read keys are forgotten
+        with patch('dash.api.stats.STATS_MAX_KEYS', 1):
+            self.api.get_group('Reporters')
+            flush_cache_stats()
+
+        self.assertEqual(get_cache_specs(self.org.id), [
+            (self.api._get_results_key('rs', '101', dict(location='LGA')), ['rs', [101, dict(location='LGA')]])])
+        self.assertEqual(get_redis_connection().hkeys('cache_stats_specs:%d' % self.org.id),
+                         [self.api._get_results_key('rs', '101', dict(location='LGA')).encode('utf-8')])
+
+    @patch('requests.models.Response', MockResponse)
+    @patch('dash.api.stats.STATS_SAMPLE_RATE', 1)
+    @patch('dash.orgs.models.Org.build_boundaries')
+    def test_warm_caches(self, mock_build_boundaries):
+        flush_cache_stats()
+        clear_cache_stats(self.org.id)
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=["RULESET_DATA"])))
+            self.api.get_ruleset_results(101)
+            flush_cache_stats()
+
+            # missing boundaries count towards the budget
+            with patch('dash.api.WARM_AHEAD_TIME', RESULT_CACHE_TIME + 60):
+                with patch('dash.orgs.models.WARM_AHEAD_TIME', RESULT_CACHE_TIME + 60):
+                    self.assertEqual(self.org.warm_caches(budget=1), 1)
+                    self.assertEqual(mock_build_boundaries.call_count, 1)
+                    self.assertEqual(mock_request_get.call_count, 1)
+
+                    self.assertEqual(self.org.warm_caches(budget=2), 2)
+                    self.assertEqual(mock_request_get.call_count, 2)
+
+                    out = StringIO()
+                    call_command('warm_caches', org_id=self.org.pk, stdout=out)
+                    self.assertIn("uganda: refreshed 2 values in", out.getvalue())
+                    self.assertEqual(mock_request_get.call_count, 3)
+
+                    self.assertRaises(CommandError, call_command, 'warm_caches', org_id=12345, stdout=out)
+
+                    # the task warms every active org
+                    with patch('dash.orgs.models.Org.warm_caches') as mock_warm_caches:
+                        mock_warm_caches.return_value = 0
+                        warm_caches()
+                        self.assertEqual(mock_warm_caches.call_count, Org.objects.filter(is_active=True).count())
+
+    @patch('requests.models.Response', MockResponse)
+    @patch('dash.api.stats.STATS_SAMPLE_RATE', 1)
+    @patch('dash.api.stats.STATS_FLUSH_SIZE', 1000)
+    def test_cache_stats(self):
+        # start with no counts from other tests
+        flush_cache_stats()
+        clear_cache_stats(self.org.id)
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=["RULESET_DATA"])))
+
+            self.api.get_ruleset_results(101)
+            self.api.get_ruleset_results(101)
+            self.api.get_ruleset_results(101)
+            self.api.get_ruleset_results_many([101, 102])
+            self.api.get_group('Reporters')
+
+            self.api.invalidate_results()
+            mock_request_get.side_effect = requests.ConnectionError()
+            self.api.get_ruleset_results(101)
+            self.api.get_contact_field_results('Age')
+
+        # nothing is written until the counts are flushed
+        self.assertEqual(get_cache_stats(self.org.id), dict(families={}, top_keys=[]))
+
+        flush_cache_stats()
+        stats = get_cache_stats(self.org.id, num_keys=1)
+
+        self.assertEqual(set(stats['families'].keys()), {'rs', 'group', 'cf'})
+        self.assertGreater(stats['families']['rs'].pop('average_cost'), 0)
+        self.assertEqual(stats['families']['rs'], dict(hit=3, miss=2, fallback=1, error=0, hit_ratio=0.5))
+        self.assertEqual(stats['families']['group']['miss'], 1)
+        self.assertEqual(stats['families']['cf'], dict(hit=0, miss=0, fallback=0, error=1, hit_ratio=0.0,
+                                                       average_cost=None))
+        self.assertEqual(stats['top_keys'], [('rs:%d:g0:101' % self.org.id, 4)])
+
+        out = StringIO()
+        call_command('cache_stats', org_id=self.org.pk, clear=True, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn("Counts are of a 100% sample of reads", output)
+        self.assertIn(" * rs: 3 hits, 2 misses, 1 fallbacks, 0 errors, hit ratio 50.0%, average recompute", output)
+        self.assertIn(" * cf: 0 hits, 0 misses, 0 fallbacks, 1 errors, hit ratio 0.0%, average recompute -", output)
+        self.assertIn("      4 rs:%d:g0:101" % self.org.id, output)
+
+        self.assertEqual(get_cache_stats(self.org.id), dict(families={}, top_keys=[]))
+
+        out = StringIO()
+        call_command('cache_stats', org_id=self.org.pk, stdout=out)
+        self.assertIn(" * no reads recorded", out.getvalue())
+
+        self.assertRaises(CommandError, call_command, 'cache_stats', org_id=12345, stdout=out)
+
+    @patch('requests.models.Response', MockResponse)
+    def test_circuit_breaker(self):
+        r = get_redis_connection()
+
+        with patch('requests.get') as mock_request_get:
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=["RULESET_DATA"])))
+            self.assertEqual(self.api.get_ruleset_results(101), ["RULESET_DATA"])
+
+            # failures and server errors both count towards opening the circuit
+            mock_request_get.side_effect = [requests.Timeout(), requests.ConnectionError(),
+                                            MockResponse(500, "Server error"), MockResponse(502, "Bad gateway"),
+                                            requests.Timeout()]
+            self.api.invalidate_results()
+
+            for ruleset_id in range(101, 106):
+                self.api.get_ruleset_results(ruleset_id)
+
+            self.assertEqual(mock_request_get.call_count, 6)
+            self.assertEqual(CircuitBreaker(self.org.id, 'results').get_state(), 'open')
+
+            # now we don't even try, and serve fallbacks where we have them
+            self.assertEqual(self.api.get_ruleset_results(101), ["RULESET_DATA"])
+            self.assertIsNone(self.api.get_ruleset_results(106))
+            self.assertEqual(self.api.get_ruleset_results_many([101, 106]), {101: ["RULESET_DATA"], 106: None})
+            self.assertEqual(mock_request_get.call_count, 6)
+
+            # other endpoints and orgs have their own circuits
+            mock_request_get.side_effect = None
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=["GROUP_DICT"])))
+            self.assertEqual(self.api.get_group('Reporters'), "GROUP_DICT")
+            self.assertEqual(mock_request_get.call_count, 7)
+
+            self.assertEqual(CircuitBreaker(self.org.id + 1, 'results').get_state(), 'closed')
+
+            # after the cool down, a single probe is let through, which re-opens the circuit if it fails
+            r.set('circuit_opened:%d:results' % self.org.id, time.time() - 60)
+            self.assertEqual(CircuitBreaker(self.org.id, 'results').get_state(), 'half_open')
+
+            mock_request_get.side_effect = requests.ConnectionError()
+            self.assertIsNone(self.api.get_ruleset_results(106))
+            self.assertEqual(mock_request_get.call_count, 8)
+            self.assertEqual(CircuitBreaker(self.org.id, 'results').get_state(), 'open')
+
+            # only one probe at a time
+            r.set('circuit_opened:%d:results' % self.org.id, time.time() - 60)
+            r.set('circuit_probe:%d:results' % self.org.id, 1)
+            self.assertIsNone(self.api.get_ruleset_results(106))
+            self.assertEqual(mock_request_get.call_count, 8)
+            r.delete('circuit_probe:%d:results' % self.org.id)
+
+            # and the circuit closes if the probe succeeds
+            mock_request_get.side_effect = None
+            mock_request_get.return_value = MockResponse(200, json.dumps(dict(results=["RULESET_106"])))
+            self.assertEqual(self.api.get_ruleset_results(106), ["RULESET_106"])
+            self.assertEqual(CircuitBreaker(self.org.id, 'results').get_state(), 'closed')
+
+            mock_request_get.side_effect = requests.ConnectionError()
+            self.assertIsNone(self.api.get_ruleset_results(107))
+            self.assertEqual(CircuitBreaker(self.org.id, 'results').get_state(), 'closed')
+
+    @patch('requests.models.Response', MockResponse)
+    @patch('dash.api.time.sleep')
+    def test_get_page_retries(self, mock_sleep):
+        url = '%s/api/v1/contacts.json' % settings.API_ENDPOINT
+        page_1 = MockResponse(200, json.dumps(dict(results=["CONTACT_1"], next='NEXT_PAGE')))
+        page_2 = MockResponse(200, json.dumps(dict(results=["CONTACT_2"], next=None)))
+
+        with patch('requests.get') as mock_request_get:
+            # server errors and throttling are retried, waiting as long as we're asked to
+            mock_request_get.side_effect = [page_1, MockResponse(503, "Unavailable"),
+                                            MockResponse(429, "Slow down", headers={'Retry-After': '2'}), page_2]
+
+            self.assertEqual(self.api.get_contacts('Reporters'), ["CONTACT_1", "CONTACT_2"])
+            self.assertEqual([c[0][0] for c in mock_request_get.call_args_list],
+                             [url, 'NEXT_PAGE', 'NEXT_PAGE', 'NEXT_PAGE'])
+            self.assertEqual(mock_request_get.call_args_list[0][1]['params'], {'group': 'Reporters'})
+            self.assertNotIn('params', mock_request_get.call_args_list[1][1])
+
+            self.assertEqual(mock_sleep.call_count, 2)
+            self.assertTrue(0 <= mock_sleep.call_args_list[0][0][0] <= 1)
+            self.assertEqual(mock_sleep.call_args_list[1][0][0], 2)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
+            mock_sleep.reset_mock()
 
-            mock_request_get.side_effect = [MockResponse(200,
-                                                         self.read_json('flows_page_1')
-                                                         ),
+            # a page which keeps failing fails the fetch, after backing off exponentially, and counts as a single
+            # failure towards opening the circuit
+            mock_request_get.side_effect = [page_1] + [requests.ConnectionError()] * 4
 
-                                            MockResponse(404,
-                                                         self.read_json('flows_page_2')
-                                                         )
-                                            ]
+            self.assertIsNone(API(self.org, background=True).get_contacts('Reporters'))
+            self.assertEqual(mock_request_get.call_count, 5)
+            self.assertEqual(mock_sleep.call_count, 3)
+            self.assertTrue(0 <= mock_sleep.call_args_list[2][0][0] <= 4)
+            self.assertEqual(int(get_redis_connection().get('circuit_failures:%d:contacts' % self.org.id)), 1)
 
-            self.assertIsNone(self.api.get_flow(5))
+            # but the next fetch resumes from the failing page
+            mock_request_get.reset_mock()
+            mock_request_get.side_effect = [page_2]
 
-            mock_request_get.assert_any_call('%s/api/v1/flows.json?flow=5' % settings.API_ENDPOINT,
-                                             headers={'Content-type': 'application/json',
-                                                      'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+            self.assertEqual(self.api.get_contacts('Reporters'), ["CONTACT_1", "CONTACT_2"])
+            self.assertEqual(mock_request_get.call_args_list[0][0][0], 'NEXT_PAGE')
 
-            mock_request_get.assert_any_call('NEXT_PAGE',
-                                             headers={'Content-type': 'application/json',
-                                                      'Accept': 'application/json',
-                                                      'Authorization': 'Token %s' % self.org.api_token})
+            # and after that starts from the beginning again
+            cache.delete('contacts:%d:reporters' % self.org.id)
+            mock_request_get.reset_mock()
+            mock_request_get.side_effect = [page_1, page_2]
 
-            self.assertEquals(mock_request_get.call_count, 2)
+            self.assertEqual(self.api.get_contacts('Reporters'), ["CONTACT_1", "CONTACT_2"])
+            self.assertEqual(mock_request_get.call_args_list[0][0][0], url)
+
+        with patch('requests.get') as mock_request_get:
+            self.clear_cache()
+            mock_sleep.reset_mock()
+
+            # other errors aren't retried, and neither is throttling which would take too long
+            mock_request_get.side_effect = [MockResponse(404, "Not found")]
+            self.assertIsNone(self.api.get_contacts('Reporters'))
+
+            mock_request_get.side_effect = [MockResponse(429, "Slow down", headers={'Retry-After': '3600'})]
+            self.assertIsNone(self.api.get_contacts('Reporters'))
+
+            self.assertEqual(mock_request_get.call_count, 2)
+            self.assertEqual(mock_sleep.call_count, 0)
+
+        with patch('requests.get') as mock_request_get:
+            self.clear_cache()
+            mock_sleep.reset_mock()
+
+            # while serving a request, retries stop once they'd take longer than the retry budget
+            mock_request_get.side_effect = [MockResponse(503, "Unavailable", headers={'Retry-After': '5'}), page_2]
+            self.assertIsNone(self.api.get_contacts('Reporters'))
+            self.assertEqual(mock_request_get.call_count, 1)
+            self.assertEqual(mock_sleep.call_count, 0)
+
+            # but not in the background
+            mock_request_get.reset_mock()
+            mock_request_get.side_effect = [MockResponse(503, "Unavailable", headers={'Retry-After': '5'}), page_2]
+            self.assertEqual(API(self.org, background=True).get_contacts('Reporters'), ["CONTACT_2"])
+            self.assertEqual(mock_sleep.call_args_list, [call(5)])
+
+            # and in the background they stop once the circuit has been opened by other requests
+            self.clear_cache()
+            mock_sleep.reset_mock()
+            mock_request_get.reset_mock()
+            mock_request_get.side_effect = [requests.ConnectionError()] * 4
+
+            def open_circuit(delay):
+                get_redis_connection().set('circuit_opened:%d:contacts' % self.org.id, time.time())
+
+            mock_sleep.side_effect = open_circuit
+
+            self.assertIsNone(API(self.org, background=True).get_contacts('Reporters'))
+            self.assertEqual(mock_request_get.call_count, 2)
+            self.assertEqual(mock_sleep.call_count, 1)
+
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('-5'), 0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT'), 0)
+
+    @patch('requests.models.Response', MockResponse)
+    @patch('dash.api.throttle.THROTTLE_RATE', 2)
+    @patch('dash.api.throttle.THROTTLE_BURST', 2)
+    @patch('dash.api.throttle.THROTTLE_MAX_WAIT', 1.2)
+    def test_throttling(self):
+        r = get_redis_connection()
+
+        with patch('dash.api.throttle.time.sleep') as mock_sleep:
+            with patch('dash.api.throttle.time.time', return_value=1000.0):
+                # a burst is let through, then requests are spaced out until they'd have to wait too long
+                for i in range(4):
+                    with throttled('TOKEN_1'):
+                        pass
+
+                self.assertRaises(ThrottledError, throttled('TOKEN_1').__enter__)
+
+                self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [0.5, 1.0])
+                self.assertEqual(get_throttle_stats('TOKEN_1'), dict(requests=4, rejected=1, average_wait=0.0))
+
+                # other tokens have their own limits
+                with throttled('TOKEN_2'):
+                    pass
+
+            # and the bucket refills over time
+            with patch('dash.api.throttle.time.time', return_value=1002.0):
+                with throttled('TOKEN_1'):
+                    pass
+
+            self.assertEqual(mock_sleep.call_count, 2)
+
+        with patch('dash.api.throttle.THROTTLE_RATE', None):
+            with patch('dash.api.throttle.THROTTLE_CONCURRENCY', 1):
+                with patch('dash.api.throttle.THROTTLE_MAX_WAIT', 0.1):
+                    with throttled('TOKEN_1'):
+                        # no more slots
+                        self.assertRaises(ThrottledError, throttled('TOKEN_1').__enter__)
+
+                        with throttled('TOKEN_2'):
+                            pass
+
+                    # until the slot is released
+                    with throttled('TOKEN_1'):
+                        pass
+
+                    # slots held for too long are reclaimed
+                    r.zadd('throttle_slots:%s' % get_token_digest('TOKEN_1'), time.time() - 120, 'CRASHED')
+                    with throttled('TOKEN_1'):
+                        pass
+
+                    # requests by the API and Temba client are throttled by the org's token
+                    with throttled(self.org.api_token):
+                        with patch('requests.get') as mock_request_get:
+                            self.assertIsNone(self.api.get_group('Reporters'))
+                            self.assertEqual(mock_request_get.call_count, 0)
+
+                        with patch('temba_client.base.request') as mock_request:
+                            self.assertRaises(ThrottledError, self.org.get_temba_client().get_boundaries)
+                            self.assertEqual(mock_request.call_count, 0)
+
+        stats = get_throttle_stats(self.org.api_token)
+        self.assertEqual((stats['requests'], stats['rejected']), (1, 2))
 
     @patch('requests.models.Response', MockResponse)
     def test_build_boundaries(self):
@@ -1719,7 +2439,8 @@ class APITest(DashTest):
             mock_request_get.assert_called_once_with('%s/api/v1/boundaries.json' % settings.API_ENDPOINT,
                                                      headers={'Content-type': 'application/json',
                                                               'Accept': 'application/json',
-                                                              'Authorization': 'Token %s' % self.org.api_token})
+                                                              'Authorization': 'Token %s' % self.org.api_token},
+                                                     timeout=REQUEST_TIMEOUT)
 
         with patch('requests.get') as mock_request_get:
             self.clear_cache()
@@ -1837,6 +2558,66 @@ class CategoryTest(DashTest):
         self.assertTrue(category1.get_first_image())
         self.assertEquals(category1.get_first_image(), category_image1.image)
 
+        # subsequent lookups come from the cache
+        with self.assertNumQueries(0):
+            self.assertEquals(category1.get_first_image(), category_image1.image)
+
+        category2 = Category.objects.create(name='category 2',
+                                            org=self.uganda,
+                                            created_by=self.admin,
+                                            modified_by=self.admin)
+        category3 = Category.objects.create(name='category 3',
+                                            org=self.uganda,
+                                            created_by=self.admin,
+                                            modified_by=self.admin)
+        category_image2 = CategoryImage.objects.create(category=category2,
+                                                       name='image 2',
+                                                       image='categories/image2.jpg',
+                                                       created_by=self.admin,
+                                                       modified_by=self.admin)
+        CategoryImage.objects.create(category=category2,
+                                     name='image 3',
+                                     image='categories/image3.jpg',
+                                     created_by=self.admin,
+                                     modified_by=self.admin)
+
+        # bulk lookup fetches all missing categories in one query
+        with self.assertNumQueries(1):
+            first_images = Category.get_first_images([category1, category2, category3])
+        self.assertEquals(first_images, {category1.pk: category_image1.image,
+                                         category2.pk: category_image2.image,
+                                         category3.pk: None})
+
+        with self.assertNumQueries(0):
+            Category.get_first_images([category1, category2, category3])
+
+        # changing or deleting an image clears the cached value
+        category_image2.is_active = False
+        category_image2.save()
+        self.assertEquals(category2.get_first_image(), 'categories/image3.jpg')
+
+        category_image1.delete()
+        self.assertIsNone(category1.get_first_image())
+
+        # moving an image to another category clears the cached values of both
+        self.assertIsNone(category3.get_first_image())
+
+        category_image2 = CategoryImage.objects.get(pk=category_image2.pk)
+        category_image2.category = category3
+        category_image2.is_active = True
+        category_image2.save()
+        self.assertEquals(category3.get_first_image(), 'categories/image2.jpg')
+
+        image3 = CategoryImage.objects.get(category=category2)
+        image3.category = category1
+        image3.save()
+        self.assertIsNone(category2.get_first_image())
+        self.assertEquals(category1.get_first_image(), 'categories/image3.jpg')
+
+        # as does deleting images with a queryset
+        CategoryImage.objects.filter(category=category3).delete()
+        self.assertIsNone(category3.get_first_image())
+
     def test_create_category(self):
         create_url = reverse('categories.category_create')
 
@@ -2301,6 +3082,56 @@ class StoryTest(DashTest):
 
         self.assertTrue(reverse('stories.story_images', args=[story1.pk]) in response.content)
 
+        story3 = Story.objects.create(title='Health workers',
+                                      content='Clinics are opening',
+                                      org=self.uganda,
+                                      created_by=self.admin,
+                                      modified_by=self.admin)
+
+        response = self.client.get(list_url + '?search=health', SERVER_NAME='uganda.ureport.io')
+        self.assertEquals(list(response.context['object_list']), [story3])
+
+        response = self.client.get(list_url + '?search=foo', SERVER_NAME='uganda.ureport.io')
+        self.assertEquals(list(response.context['object_list']), [story1])
+
+        response = self.client.get(list_url + '?search=xyz', SERVER_NAME='uganda.ureport.io')
+        self.assertFalse(response.context['object_list'])
+
+    def test_list_stories_queries(self):
+        list_url = reverse('stories.story_list')
+        self.login(self.admin)
+
+        def create_story(title):
+            story = Story.objects.create(title=title,
+                                         content='bar',
+                                         category=self.health_uganda,
+                                         org=self.uganda,
+                                         created_by=self.admin,
+                                         modified_by=self.admin)
+            for idx in range(2):
+                StoryImage.objects.create(name='image %d' % idx,
+                                          story=story,
+                                          image='stories/someimage.jpg',
+                                          created_by=self.admin,
+                                          modified_by=self.admin)
+            return story
+
+        create_story('story 1')
+
+        with CaptureQueriesContext(connection) as single_queries:
+            response = self.client.get(list_url, SERVER_NAME='uganda.ureport.io')
+        self.assertEquals(response.context['object_list'][0].image_count, 2)
+
+        for idx in range(2, 11):
+            create_story('story %d' % idx)
+
+        # rendering more rows doesn't issue more queries
+        with CaptureQueriesContext(connection) as many_queries:
+            response = self.client.get(list_url, SERVER_NAME='uganda.ureport.io')
+        self.assertEquals(len(response.context['object_list']), 10)
+        self.assertEquals(len(many_queries), len(single_queries))
+        self.assertEquals([s.image_count for s in response.context['object_list']], [2] * 10)
+
     def test_images_story(self):
         story1 = Story.objects.create(title='foo',
                                       content='bar',
@@ -2368,6 +3199,183 @@ class StoryTest(DashTest):
 
         self.clear_uploads()
 
+    def test_images_story_diff(self):
+        story1 = Story.objects.create(title='foo',
+                                      content='bar',
+                                      category=self.health_uganda,
+                                      org=self.uganda,
+                                      created_by=self.admin,
+                                      modified_by=self.admin)
+
+        images_url = reverse('stories.story_images', args=[story1.pk])
+        self.login(self.admin)
+
+        self.client.post(images_url, dict(image_1=self.upload_image('one.jpg')), SERVER_NAME='uganda.ureport.io')
+        image1 = StoryImage.objects.get(story=story1)
+
+        # adding a second image leaves the first untouched
+        self.client.post(images_url, dict(image_2=self.upload_image('two.jpg')), SERVER_NAME='uganda.ureport.io')
+        image1_refreshed, image2 = StoryImage.objects.filter(story=story1).order_by('pk')
+        self.assertEquals(image1_refreshed.pk, image1.pk)
+        self.assertEquals(image1_refreshed.image.name, image1.image.name)
+        self.assertEquals(image1_refreshed.modified_on, image1.modified_on)
+        self.assertTrue(image2.image.name.startswith('stories/two'))
+
+        # replacing the first image updates it in place
+        self.client.post(images_url, dict(image_1=self.upload_image('three.jpg')), SERVER_NAME='uganda.ureport.io')
+        image1_replaced, image2_refreshed = StoryImage.objects.filter(story=story1).order_by('pk')
+        self.assertEquals(image1_replaced.pk, image1.pk)
+        self.assertTrue(image1_replaced.image.name.startswith('stories/three'))
+        self.assertEquals(image2_refreshed.modified_on, image2.modified_on)
+
+        # clearing the second image removes it
+        self.client.post(images_url, {'image_2-clear': 'on'}, SERVER_NAME='uganda.ureport.io')
+        self.assertEquals(list(StoryImage.objects.filter(story=story1)), [image1_replaced])
+
+        self.clear_uploads()
+
+
+class SearchTest(DashTest):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.uganda = self.create_org('uganda', self.admin)
+
+    def test_full_text_search_sql(self):
+        stories = Story.objects.filter(org=self.uganda)
+
+        # text without searchable terms doesn't filter
+        self.assertIs(full_text_search(stories, " !? "), stories)
+
+        sql, params = full_text_search(stories, "Heal care").query.sql_with_params()
+
+        self.assertIn('(ts_rank("stories_story"."search_vector", to_tsquery(\'simple\', %s))) AS "search_rank"', sql)
+        self.assertIn('("stories_story"."search_vector" @@ to_tsquery(\'simple\', %s))', sql)
+        self.assertTrue(sql.endswith('ORDER BY "search_rank" DESC'))
+        self.assertEqual(params.count("heal:* & care:*"), 2)
+
+        # trigram fallback is only used when enabled and nothing matches
+        with patch('dash.utils.search.SEARCH_TRIGRAM', True):
+            with patch('django.db.models.query.QuerySet.exists', return_value=True):
+                sql, params = full_text_search(stories, "Heal care", 'title').query.sql_with_params()
+                self.assertIn('@@ to_tsquery', sql)
+                self.assertNotIn('similarity', sql)
+
+            with patch('django.db.models.query.QuerySet.exists', return_value=False) as mock_exists:
+                sql, params = full_text_search(stories, "Heal care", 'title').query.sql_with_params()
+                self.assertIn('(similarity("stories_story"."title", %s)) AS "search_rank"', sql)
+                self.assertIn('(similarity("stories_story"."title", %s) > %s)', sql)
+                self.assertNotIn('@@ to_tsquery', sql)
+                self.assertEqual(params[0], "Heal care")
+                self.assertEqual(params[-2:], ("Heal care", 0.3))
+
+                mock_exists.reset_mock()
+                full_text_search(stories, "Heal care")
+                self.assertFalse(mock_exists.called)
+
+    def test_search_vector_migrations(self):
+        for migration, table in (('dash.stories.migrations.0013_story_search_vector', 'stories_story'),
+                                 ('dash.dashblocks.migrations.0007_dashblock_search_vector', 'dashblocks_dashblock')):
+            operation = import_module(migration).Migration.operations[0]
+
+            def run(code, vendor='postgresql', has_trigram=True):
+                schema_editor = Mock()
+                schema_editor.connection.vendor = vendor
+                schema_editor.connection.cursor.return_value.fetchone.return_value = (1,) if has_trigram else None
+                code(None, schema_editor)
+                return [c[0][0] for c in schema_editor.execute.call_args_list]
+
+            vector = ("setweight(to_tsvector('simple', coalesce(%stitle, '')), 'A') || "
+                      "setweight(to_tsvector('simple', coalesce(%ssummary, '')), 'B') || "
+                      "setweight(to_tsvector('simple', coalesce(%scontent, '')), 'C') || "
+                      "setweight(to_tsvector('simple', coalesce(%stags, '')), 'D')")
+
+            self.assertEqual(run(operation.code), [
+                'ALTER TABLE %s ADD COLUMN search_vector tsvector' % table,
+                'CREATE FUNCTION %s_search_vector_update() RETURNS trigger AS $$ BEGIN NEW.search_vector := %s; '
+                'RETURN NEW; END $$ LANGUAGE plpgsql' % (table, vector % (('NEW.',) * 4)),
+                'CREATE TRIGGER %s_search_vector_trigger BEFORE INSERT OR UPDATE OF title, summary, content, tags '
+                'ON %s FOR EACH ROW EXECUTE PROCEDURE %s_search_vector_update()' % (table, table, table),
+                'UPDATE %s SET search_vector = %s' % (table, vector % (('',) * 4)),
+                'CREATE INDEX %s_search_vector_idx ON %s USING gin(search_vector)' % (table, table),
+                'CREATE INDEX %s_title_trgm_idx ON %s USING gin(title gin_trgm_ops)' % (table, table),
+            ])
+
+            # the trigram index needs pg_trgm
+            self.assertNotIn('trgm', ' '.join(run(operation.code, has_trigram=False)))
+
+            self.assertEqual(run(operation.reverse_code), [
+                'DROP INDEX IF EXISTS %s_title_trgm_idx' % table,
+                'DROP TRIGGER %s_search_vector_trigger ON %s' % (table, table),
+                'DROP FUNCTION %s_search_vector_update()' % table,
+                'ALTER TABLE %s DROP COLUMN search_vector' % table,
+            ])
+
+            # and other databases are left alone
+            self.assertEqual(run(operation.code, vendor='sqlite'), [])
+            self.assertEqual(run(operation.reverse_code, vendor='sqlite'), [])
+
+    @skipUnless(connection.vendor == 'postgresql', "Full text search needs Postgres")
+    def test_full_text_search(self):
+        def create_story(title, content):
+            return Story.objects.create(title=title, content=content, org=self.uganda,
+                                        created_by=self.admin, modified_by=self.admin)
+
+        clinics = create_story("Clinics", "Health workers are needed")
+        health = create_story("Health workers", "Clinics are opening")
+        create_story("Roads", "Nothing to see here")
+
+        # matches in titles rank above matches in content
+        self.assertEqual(list(full_text_search(Story.objects.all(), "heal")), [health, clinics])
+        self.assertEqual(list(full_text_search(Story.objects.all(), "xyz")), [])
+
+        # search vectors are kept up to date as stories change
+        clinics.title = "Healthy clinics"
+        clinics.save()
+        self.assertEqual(set(full_text_search(Story.objects.all(), "healthy")), {clinics})
+
+
+class ImageVariantsTest(DashTest):
+    def setUp(self):
+        super(ImageVariantsTest, self).setUp()
+        self.uganda = self.create_org('uganda', self.admin)
+        self.story = Story.objects.create(title="Story 1", content="content", org=self.uganda,
+                                          created_by=self.admin, modified_by=self.admin)
+        self.clear_cache()
+
+    @patch('dash.utils.images.IMAGE_VARIANT_FORMATS', ('JPEG',))
+    @patch('dash.utils.images.IMAGE_VARIANT_WIDTHS', (20, 40, 80))
+    def test_variants(self):
+        with patch('dash.utils.tasks.generate_image_variants_task.delay') as mock_delay:
+            story_image = StoryImage.objects.create(name='image 1', story=self.story,
+                                                    image=self.upload_image('image.jpg', size=(60, 30)),
+                                                    created_by=self.admin, modified_by=self.admin)
+
+            # uploading queues generation
+            mock_delay.assert_called_once_with(story_image.image.name)
+
+            # but saving again without a new file doesn't
+            story_image.name = 'image 2'
+            story_image.save()
+            self.assertEquals(mock_delay.call_count, 1)
+
+            # nothing generated yet so nothing to render, and generation is only queued once
+            self.assertEquals(get_image_variants(story_image.image), [])
+            self.assertEquals(get_image_variants(story_image.image), [])
+            self.assertEquals(image_srcset(story_image.image), '')
+            self.assertEquals(mock_delay.call_count, 2)
+
+        variants = generate_image_variants(story_image.image.name)
+
+        # images aren't upscaled
+        self.assertEquals([(v['width'], v['height'], v['format']) for v in variants],
+                          [(20, 10, 'JPEG'), (40, 20, 'JPEG'), (60, 30, 'JPEG')])
+        self.assertEquals(get_image_variants(story_image.image), variants)
+        self.assertEquals(image_srcset(story_image.image, 'JPEG'),
+                          '%s 20w, %s 40w, %s 60w' % tuple(v['url'] for v in variants))
+        self.assertEquals(image_srcset(story_image.image, 'WEBP'), '')
+
+        self.clear_uploads()
+
 
 class DashBlockTypeTest(DashTest):
     def setUp(self):
@@ -2971,3 +3979,596 @@ class DashBlockTest(DashTest):
         self.assertFalse(dashblock2 in context['foo'])
         self.assertFalse(dashblock3 in context['foo'])
         self.assertFalse(dashblock4 in context['foo'])
+
+
+class ContactSyncTest(DashTest):
+    def setUp(self):
+        super(ContactSyncTest, self).setUp()
+        self.uganda = self.create_org('uganda', self.admin)
+
+    def temba_contact(self, uuid, name, blocked=False, fields=None, modified_on=None):
+        return TembaContact.create(uuid=uuid, name=name, urns=['tel:%s' % uuid], groups=['G-001'],
+                                   fields=fields or {}, blocked=blocked, modified_on=modified_on)
+
+    def create_contact(self, uuid, name):
+        return Contact.objects.create(**Contact.kwargs_from_temba(self.uganda, self.temba_contact(uuid, name)))
+
+    def mock_client(self, pages, deleted_pages=()):
+        """
+        Mocks a Temba client which returns the given pages of contacts and deleted contacts
+        """
+        def get_contacts(pager=None, deleted=None, after=None, before=None):
+            source = deleted_pages if deleted else pages
+            if before:
+                source = [[c for c in page if not c.modified_on or c.modified_on <= before] for page in source]
+            page_num = int(pager.next_url) if pager.next_url else pager.start_page - 1
+            has_next = page_num + 1 < len(source)
+            pager.update(dict(count=None, next=str(page_num + 1) if has_next else None))
+            return source[page_num] if source else []
+
+        client = Mock()
+        client.pager.side_effect = lambda start_page=1: TembaPager(start_page)
+        client.get_contacts.side_effect = get_contacts
+        return client
+
+    def test_sync_pull_contacts(self):
+        self.create_contact('C-001', "Ann")
+        self.create_contact('C-002', "Bob")
+        self.create_contact('C-003', "Cat")
+
+        client = self.mock_client(
+            pages=[
+                [self.temba_contact('C-001', "Ann"), self.temba_contact('C-002', "Bobby")],
+                [self.temba_contact('C-004', "Dan"), self.temba_contact('C-005', "Eve", blocked=True)],
+                [self.temba_contact('C-006', "Fay", fields=dict(invalid=True))],
+            ],
+            deleted_pages=[[self.temba_contact('C-003', None)]])
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            # each batch only loads the local contacts it needs
+            with CaptureQueriesContext(connection) as queries:
+                results = sync_pull_contacts(self.uganda, Contact, delete_blocked=True, batch_size=2)
+
+        self.assertEqual(results, (['C-004'], ['C-002'], ['C-005', 'C-003'], ['C-006']))
+        self.assertEqual(client.get_contacts.call_count, 4)
+        self.assertEqual(len([q for q in queries if 'SELECT' in q['sql'] and ' IN (' in q['sql']]), 3)
+
+        # and only updates the fields which have changed
+        updates = [q['sql'] for q in queries if q['sql'].startswith('QUERY = u\'UPDATE')]
+        self.assertEqual(len(updates), 4)  # updated contact, unchanged contact fingerprint, blocked, deleted
+        name_updates = [u for u in updates if '"name" = CASE' in u]
+        self.assertEqual(len(name_updates), 1)
+        self.assertNotIn('"urns"', name_updates[0])
+
+        self.assertEqual(Contact.objects.get(uuid='C-002').name, "Bobby")
+        self.assertEqual(Contact.objects.get(uuid='C-004').name, "Dan")
+        self.assertFalse(Contact.objects.get(uuid='C-003').is_active)
+        self.assertFalse(Contact.objects.filter(uuid__in=['C-005', 'C-006']).exists())
+
+        # same sync but only counting
+        client = self.mock_client(pages=[[self.temba_contact('C-001', "Annie"), self.temba_contact('C-007', "Gus")]],
+                                  deleted_pages=[[self.temba_contact('C-002', None)]])
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            self.assertEqual(sync_pull_contacts(self.uganda, Contact, counts_only=True), (1, 1, 1, 0))
+
+        self.assertEqual(Contact.objects.get(uuid='C-001').name, "Annie")
+        self.assertFalse(Contact.objects.get(uuid='C-002').is_active)
+
+    def test_sync_pull_contacts_fingerprint(self):
+        self.create_contact('C-001', "Ann")
+
+        ann = self.temba_contact('C-001', "Ann")
+        bob = self.temba_contact('C-002', "Bob")
+
+        # contacts created by a sync have their fingerprint stored, existing contacts get one on first compare
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = self.mock_client(pages=[[ann, bob]])
+            results = sync_pull_contacts(self.uganda, Contact)
+
+        self.assertEqual(results, (['C-002'], [], [], []))
+        self.assertEqual(Contact.objects.get(uuid='C-001').sync_fingerprint, temba_contact_fingerprint(ann))
+        self.assertEqual(Contact.objects.get(uuid='C-002').sync_fingerprint, temba_contact_fingerprint(bob))
+
+        # unchanged contacts are now skipped without being compared
+        bobby = self.temba_contact('C-002', "Bobby")
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = self.mock_client(pages=[[ann, bobby]])
+
+            with patch('dash_test_runner.models.Contact.as_temba') as mock_as_temba:
+                mock_as_temba.return_value = bob
+                results = sync_pull_contacts(self.uganda, Contact)
+
+        self.assertEqual(results, ([], ['C-002'], [], []))
+        self.assertEqual(mock_as_temba.call_count, 1)
+        self.assertEqual(Contact.objects.get(uuid='C-002').sync_fingerprint, temba_contact_fingerprint(bobby))
+
+        # contacts edited locally have their fingerprint cleared, so they're compared and corrected by the next pull
+        local_ann = Contact.objects.get(uuid='C-001')
+        local_ann.name = "Annie"
+        local_ann.save()
+        self.assertIsNone(Contact.objects.get(uuid='C-001').sync_fingerprint)
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = self.mock_client(pages=[[ann, bobby]])
+            results = sync_pull_contacts(self.uganda, Contact)
+
+        self.assertEqual(results, ([], ['C-001'], [], []))
+        self.assertEqual(Contact.objects.get(uuid='C-001').name, "Ann")
+        self.assertEqual(Contact.objects.get(uuid='C-001').sync_fingerprint, temba_contact_fingerprint(ann))
+
+        # as are contacts queued to be pushed
+        with patch('dash.utils.tasks.flush_push_contacts_task.apply_async'):
+            queue_push_contact(self.uganda, Contact.objects.get(uuid='C-002'), ChangeType.updated)
+
+        self.assertIsNone(Contact.objects.get(uuid='C-002').sync_fingerprint)
+
+        # contacts which differ but have no fields to change aren't reported as updated
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = self.mock_client(pages=[[bobby]])
+
+            with patch('dash.utils.sync._has_fingerprint', return_value=False):
+                with patch('dash_test_runner.models.Contact.as_temba') as mock_as_temba:
+                    mock_as_temba.return_value = bob
+                    results = sync_pull_contacts(self.uganda, Contact)
+
+        self.assertEqual(results, ([], [], [], []))
+
+    def test_sync_pull_contacts_resume(self):
+        last_time = datetime(2015, 1, 1, 0, 0, 0, 0, pytz.UTC)
+
+        def modified(minutes):
+            return last_time + timedelta(minutes=minutes)
+
+        # contacts come newest first, and C-006 was modified at the same time as C-003
+        ann, bob, cat, dan, eve, fay = [
+            self.temba_contact('C-00%d' % (i + 1), name, modified_on=modified(m))
+            for i, (name, m) in enumerate([("Ann", 6), ("Bob", 5), ("Cat", 4), ("Dan", 3), ("Eve", 2), ("Fay", 4)])]
+        deleted_pages = [[self.temba_contact('C-001', None, modified_on=modified(7))]]
+
+        self.assertIsNone(get_sync_status(self.uganda, Contact))
+
+        # simulate the worker dying during the second batch
+        client = self.mock_client(pages=[[ann, bob], [cat, fay], [dan, eve]], deleted_pages=deleted_pages)
+
+        def sync_batch(org, contact_class, incoming_contacts, *args):
+            if incoming_contacts[0].uuid == 'C-006':
+                raise ValueError("Worker killed")
+            sync_pull_contacts_batch(org, contact_class, incoming_contacts, *args)
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            with patch('dash.utils.sync.sync_pull_contacts_batch', side_effect=sync_batch):
+                self.assertRaises(ValueError, sync_pull_contacts, self.uganda, Contact, last_time=last_time,
+                                  batch_size=3)
+
+        status = get_sync_status(self.uganda, Contact)
+        self.assertEqual(status['state'], 'failed')
+        self.assertEqual((status['phase'], status['checkpoint'], status['checkpoint_uuids']),
+                         ('contacts', modified(4), ['C-003']))
+        self.assertEqual(status['created'], 3)
+        self.assertEqual(set(Contact.objects.values_list('uuid', flat=True)), {'C-001', 'C-002', 'C-003'})
+
+        # next pull with the same last time resumes from the checkpoint, even though remote contacts have since been
+        # deleted which would have shifted a page based checkpoint past unprocessed contacts
+        client = self.mock_client(pages=[[ann, cat], [fay, dan], [eve]], deleted_pages=deleted_pages)
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            results = sync_pull_contacts(self.uganda, Contact, last_time=last_time, batch_size=3)
+
+        self.assertEqual(results, (['C-006', 'C-004', 'C-005'], [], ['C-001'], []))
+        self.assertEqual(client.get_contacts.call_args_list[0][1]['before'], modified(4))
+        self.assertIsNone(client.get_contacts.call_args_list[-1][1]['before'])
+
+        status = get_sync_status(self.uganda, Contact)
+        self.assertEqual(status['state'], 'complete')
+        self.assertEqual(status['phase'], 'deleted')
+        self.assertEqual((status['created'], status['updated'], status['deleted'], status['failed']), (6, 0, 1, 0))
+        self.assertIsNotNone(status['finished_on'])
+
+        # a completed pull isn't resumed (and C-001 is reactivated as it's back in the contacts feed)
+        client = self.mock_client(pages=[[ann, bob], [cat, fay], [dan, eve]])
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            results = sync_pull_contacts(self.uganda, Contact, last_time=last_time, batch_size=3)
+
+        self.assertEqual(results, ([], ['C-001'], [], []))
+        self.assertIsNone(client.get_contacts.call_args_list[0][1]['before'])
+        self.assertEqual(get_sync_status(self.uganda, Contact)['created'], 0)
+
+    def test_sync_pull_contacts_prefetch(self):
+        self.create_contact('C-001', "Ann")
+
+        client = self.mock_client(
+            pages=[
+                [self.temba_contact('C-001', "Annie"), self.temba_contact('C-002', "Bob")],
+                [self.temba_contact('C-003', "Cat")],
+                [self.temba_contact('C-004', "Dan")],
+            ],
+            deleted_pages=[[self.temba_contact('C-002', None)], [self.temba_contact('C-003', None)]])
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            results = sync_pull_contacts(self.uganda, Contact, batch_size=2, prefetch=1)
+
+        self.assertEqual(results, (['C-002', 'C-003', 'C-004'], ['C-001'], ['C-002', 'C-003'], []))
+        self.assertEqual(client.get_contacts.call_count, 5)
+        self.assertEqual(Contact.objects.filter(is_active=True).count(), 2)
+
+        status = get_sync_status(self.uganda, Contact)
+        self.assertEqual(status['state'], 'complete')
+        self.assertEqual(set(status['timings'].keys()), {'fetch', 'process', 'wait'})
+        self.assertTrue(status['timings']['process'] > 0)
+
+        # errors fetching pages are raised in the calling thread
+        client = self.mock_client(pages=[[self.temba_contact('C-005', "Eve")]])
+        client.get_contacts.side_effect = ValueError("Connection lost")
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+
+            self.assertRaises(ValueError, sync_pull_contacts, self.uganda, Contact, prefetch=1)
+
+        self.assertEqual(get_sync_status(self.uganda, Contact)['state'], 'failed')
+
+    def test_deactivate_contacts(self):
+        for uuid in ('C-001', 'C-002', 'C-003', 'C-004', 'C-005'):
+            self.create_contact(uuid, "Ann")
+
+        Contact.objects.filter(uuid='C-001').update(is_active=False)
+
+        # only active contacts are updated, a chunk at a time
+        with CaptureQueriesContext(connection) as queries:
+            deactivated = deactivate_contacts(self.uganda, Contact, ['C-001', 'C-002', 'C-003', 'C-004', 'C-999'],
+                                              chunk_size=2)
+
+        self.assertEqual(deactivated, 3)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('QUERY = u\'UPDATE')]), 3)
+        self.assertEqual(list(Contact.objects.filter(is_active=True).values_list('uuid', flat=True)), ['C-005'])
+
+        self.assertEqual(deactivate_contacts(self.uganda, Contact, []), 0)
+
+    @patch('dash.utils.tasks.flush_push_contacts_task.apply_async')
+    def test_push_outbox(self, mock_apply_async):
+        ann = self.create_contact('C-001', "Ann")
+        bob = self.create_contact('C-002', "Bob")
+        cat = Contact.objects.create(org=self.uganda, uuid=None, name="Cat")
+        dan = Contact.objects.create(org=self.uganda, uuid=None, name="Dan")
+
+        # many changes to the same contact are coalesced into one
+        queue_push_contact(self.uganda, ann, ChangeType.updated)
+        queue_push_contact(self.uganda, ann, ChangeType.updated, mutex_group_sets=[{'G-002', 'G-001'}])
+        queue_push_contact(self.uganda, bob, ChangeType.updated)
+        queue_push_contact(self.uganda, bob, ChangeType.deleted)
+        queue_push_contact(self.uganda, cat, ChangeType.created)
+        queue_push_contact(self.uganda, cat, ChangeType.updated)
+        queue_push_contact(self.uganda, dan, ChangeType.created)
+        queue_push_contact(self.uganda, dan, ChangeType.deleted)
+
+        outbox = get_push_outbox(self.uganda, Contact)
+        self.assertEqual(set(outbox.keys()), {ann.pk, bob.pk, cat.pk})
+        self.assertEqual(outbox[ann.pk]['change_type'], ChangeType.updated.value)
+        self.assertEqual(outbox[ann.pk]['mutex_group_sets'], [['G-001', 'G-002']])  # sets are queued as lists
+        self.assertEqual(outbox[bob.pk]['change_type'], ChangeType.deleted.value)
+        self.assertEqual(outbox[cat.pk]['change_type'], ChangeType.created.value)
+
+        # and only one flush is queued
+        self.assertEqual(mock_apply_async.call_count, 1)
+        self.assertEqual(mock_apply_async.call_args[0][0], (self.uganda.pk, 'dash_test_runner.contact'))
+
+        # nothing is due yet
+        client = Mock()
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+            self.assertEqual(flush_push_contacts(self.uganda, Contact), 0)
+
+        Contact.objects.filter(pk=ann.pk).update(name="Annie")
+        client.get_contacts.return_value = [self.temba_contact('C-001', "Ann")]
+        client.create_contact.return_value = self.temba_contact('C-003', "Cat")
+
+        now = time.time()
+
+        with patch('dash.utils.sync.time.time') as mock_time:
+            mock_time.return_value = now + 60
+
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.return_value = client
+                self.assertEqual(flush_push_contacts(self.uganda, Contact), 3)
+
+        # updated contacts are fetched together and merged before being pushed
+        client.get_contacts.assert_called_once_with(uuids=['C-001'])
+        client.update_contact.assert_called_once_with('C-001', "Annie", ['tel:C-001'], {}, ['G-001'])
+        client.delete_contact.assert_called_once_with('C-002')
+        self.assertEqual(client.create_contact.call_count, 1)
+        self.assertEqual(Contact.objects.get(pk=cat.pk).uuid, 'C-003')
+        self.assertEqual(get_push_outbox(self.uganda, Contact), {})
+
+    @patch('dash.utils.tasks.flush_push_contacts_task.apply_async')
+    def test_push_outbox_retry(self, mock_apply_async):
+        ann = self.create_contact('C-001', "Ann")
+        queue_push_contact(self.uganda, ann, ChangeType.deleted)
+
+        client = Mock()
+        client.delete_contact.side_effect = ValueError("Server error")
+        now = time.time()
+
+        with patch('dash.utils.sync.time.time') as mock_time:
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.return_value = client
+
+                # each failure is retried with exponential backoff until we give up
+                for attempt, delay in enumerate((60, 60 + 60, 60 + 60 + 120, 60 + 60 + 120 + 240), start=1):
+                    mock_time.return_value = now + delay
+                    self.assertEqual(flush_push_contacts(self.uganda, Contact), 0)
+                    self.assertEqual(client.delete_contact.call_count, attempt)
+
+                    # not due again until the backoff has passed
+                    self.assertEqual(flush_push_contacts(self.uganda, Contact), 0)
+                    self.assertEqual(client.delete_contact.call_count, attempt)
+
+                    self.assertEqual(get_push_outbox(self.uganda, Contact)[ann.pk]['attempts'], attempt)
+
+                mock_time.return_value = now + 1000
+                flush_push_contacts(self.uganda, Contact)
+
+        self.assertEqual(client.delete_contact.call_count, 5)
+        self.assertEqual(get_push_outbox(self.uganda, Contact), {})
+
+    @patch('dash.utils.tasks.flush_push_contacts_task.apply_async')
+    def test_push_outbox_lost(self, mock_apply_async):
+        ann = self.create_contact('C-001', "Ann")
+        bob = self.create_contact('C-002', "Bob")
+        queue_push_contact(self.uganda, ann, ChangeType.deleted)
+
+        client = Mock()
+        now = time.time()
+
+        with patch('dash.utils.sync.time.time') as mock_time:
+            mock_time.return_value = now + 60
+
+            # a flush which fails after taking changes off the outbox leaves them in flight
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.side_effect = KeyboardInterrupt()
+                self.assertRaises(KeyboardInterrupt, flush_push_contacts, self.uganda, Contact)
+
+            self.assertEqual(get_push_outbox(self.uganda, Contact), {})
+
+            # changes to contacts with a change in flight aren't taken until it's cleared
+            queue_push_contact(self.uganda, ann, ChangeType.deleted)
+            queue_push_contact(self.uganda, bob, ChangeType.deleted)
+            mock_time.return_value = now + 120
+
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.return_value = client
+                self.assertEqual(flush_push_contacts(self.uganda, Contact), 1)
+
+            client.delete_contact.assert_called_once_with('C-002')
+            self.assertEqual(set(get_push_outbox(self.uganda, Contact).keys()), {ann.pk})
+
+            # and are put off, so there's nothing to sweep until the changes in flight are assumed lost
+            mock_apply_async.reset_mock()
+            self.assertEqual(sweep_push_outboxes(), 0)
+
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.return_value = client
+                self.assertEqual(flush_push_contacts(self.uganda, Contact), 0)
+            self.assertEqual(get_push_outbox(self.uganda, Contact)[ann.pk]['change_type'], ChangeType.deleted.value)
+
+            mock_time.return_value = now + 60 + 60 * 15
+            cache.delete('sync:%d:dash_test_runner.contact:outbox:queued' % self.uganda.pk)
+
+            # then they're queued again and a flush is queued to push them
+            self.assertEqual(sweep_push_outboxes(), 1)
+            mock_apply_async.assert_called_once_with((self.uganda.pk, 'dash_test_runner.contact'), countdown=0)
+
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.return_value = client
+                self.assertEqual(flush_push_contacts(self.uganda, Contact), 1)
+
+            self.assertEqual(client.delete_contact.call_count, 2)
+            client.delete_contact.assert_called_with('C-001')
+            self.assertEqual(get_push_outbox(self.uganda, Contact), {})
+
+            # and nothing is left to sweep
+            self.assertEqual(sweep_push_outboxes(), 0)
+
+    def test_fake_temba_client(self):
+        client = FakeTembaClient(10, page_size=4, changed_ratio=0.2, deleted_ratio=0.2, blocked_ratio=0.1, seed=1)
+
+        pager = client.pager()
+        page1 = client.get_contacts(pager=pager)
+        self.assertEqual([c.uuid for c in page1], ['C-00000009', 'C-00000008', 'C-00000007', 'C-00000006'])
+        self.assertEqual(pager.total, 10)
+        self.assertTrue(pager.has_more())
+        self.assertEqual(len(client.get_contacts(pager=pager)), 4)
+        self.assertEqual(len(client.get_contacts(pager=pager)), 2)
+        self.assertFalse(pager.has_more())
+
+        self.assertEqual(len([c for c in client.get_contacts() if c.blocked]), 1)
+        self.assertEqual(client.get_contact('C-00000003').name, "Contact 3")
+
+        # a full pull creates every contact except blocked ones
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+            created, updated, deleted, failed = sync_pull_contacts(self.uganda, Contact, delete_blocked=True,
+                                                                   counts_only=True)
+
+        self.assertEqual((created, updated, deleted, failed), (9, 0, 1, 0))
+
+        last_time = get_sync_status(self.uganda, Contact)['started_on']
+        changed, deleted = client.apply_changes()
+        self.assertEqual((len(changed), len(deleted)), (2, 1))
+        self.assertEqual(client.count_contacts(after=last_time), 2)
+        self.assertEqual(client.count_contacts(after=last_time, deleted=True), 1)
+        self.assertEqual(client.count_contacts(), 9)
+
+        # an incremental pull only sees what changed
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = client
+            results = sync_pull_contacts(self.uganda, Contact, last_time=last_time, delete_blocked=True)
+
+        updated_uuids = sorted(['C-%08d' % i for i in changed if i not in client.blocked])
+        self.assertEqual(sorted(results[1] + results[2]), sorted(['C-%08d' % i for i in changed + deleted]))
+        self.assertEqual(sorted(results[1]), updated_uuids)
+        self.assertEqual(Contact.objects.get(uuid=updated_uuids[0]).name,
+                         "Contact %d v1" % int(updated_uuids[0][2:]))
+
+    def test_benchmark_sync_command(self):
+        ann = self.create_contact('C-00000001', "Ann")
+        status = dict(state='running', last_time=None, checkpoint=datetime(2015, 1, 1, 0, 0, 0, 0, pytz.UTC),
+                      checkpoint_uuids=['C-001'])
+        set_sync_status(self.uganda, Contact, status)
+
+        out = StringIO()
+        call_command('benchmark_sync', 'dash_test_runner.Contact', contacts=50, page_size=20, batch_size=15,
+                     stdout=out)
+
+        output = out.getvalue()
+        self.assertIn("Full pull: 50 contacts in", output)
+        self.assertIn("Incremental pull: 5 contacts in", output)
+        self.assertIn("queries, process peak RSS so far", output)
+        self.assertIn(" * timings: fetch", output)
+        self.assertIn("Contacts with 400 groups: merge", output)
+
+        # contacts are pulled into a throwaway org which is removed afterwards, leaving real orgs untouched
+        self.assertEqual(list(Org.objects.all()), [self.uganda])
+        self.assertEqual(list(Contact.objects.all()), [ann])
+        self.assertEqual(Contact.objects.get(pk=ann.pk).name, "Ann")
+        self.assertEqual(get_sync_status(self.uganda, Contact), status)
+
+        # unless we want to keep it
+        call_command('benchmark_sync', 'dash_test_runner.Contact', contacts=5, keep=True, stdout=out)
+        org = Org.objects.exclude(pk=self.uganda.pk).get()
+        self.assertEqual(Contact.objects.filter(org=org).count(), 5)
+        self.assertIsNotNone(get_sync_status(org, Contact))
+
+        self.assertRaises(CommandError, call_command, 'benchmark_sync', 'dash_test_runner.Nope', stdout=out)
+
+    def test_get_sync_shard_windows(self):
+        self.uganda.created_on = datetime(2015, 1, 1, 0, 0, 0, 0, pytz.UTC)
+        last_time = datetime(2015, 1, 2, 0, 0, 0, 0, pytz.UTC)
+        until = datetime(2015, 1, 3, 0, 0, 0, 0, pytz.UTC)
+
+        self.assertEqual(get_sync_shard_windows(self.uganda, last_time, until, 2), [
+            (last_time, datetime(2015, 1, 2, 12, 0, 0, 0, pytz.UTC)),
+            (datetime(2015, 1, 2, 12, 0, 0, 0, pytz.UTC), until),
+        ])
+
+        # a full pull is split from when the org was created, with the first window including anything older
+        self.assertEqual(get_sync_shard_windows(self.uganda, None, until, 2), [
+            (None, last_time),
+            (last_time, until),
+        ])
+
+        # nothing to split
+        self.assertEqual(get_sync_shard_windows(self.uganda, until, until, 2), [(until, until)])
+
+    def test_sync_pull_contacts_sharded(self):
+        self.create_contact('C-001', "Ann")
+
+        with patch('dash.utils.tasks.sync_pull_contacts_shard_task.delay') as mock_delay:
+            until = sync_pull_contacts_sharded(self.uganda, Contact, last_time=self.uganda.created_on, num_shards=2)
+
+        self.assertEqual(mock_delay.call_count, 2)
+        self.assertEqual(mock_delay.call_args_list[0][0][:3], (self.uganda.pk, 'dash_test_runner.contact', 0))
+        self.assertEqual(mock_delay.call_args_list[1][0][:3], (self.uganda.pk, 'dash_test_runner.contact', 1))
+
+        status = get_sharded_sync_status(self.uganda, Contact)
+        self.assertEqual(status, dict(until=until, pending=2, created=0, updated=0, deleted=0, failed=0, shards={}))
+
+        # run each shard task as a worker would, against its own window of contacts
+        shard_pages = [
+            dict(pages=[[self.temba_contact('C-001', "Annie"), self.temba_contact('C-002', "Bob")]]),
+            dict(pages=[[self.temba_contact('C-003', "Cat")]], deleted_pages=[[self.temba_contact('C-002', None)]]),
+        ]
+
+        for (args, kwargs), pages in zip(mock_delay.call_args_list, shard_pages):
+            client = self.mock_client(**pages)
+
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                mock_get_client.return_value = client
+                sync_pull_contacts_shard_task(*args)
+
+            # each shard only fetches its own window
+            get_kwargs = client.get_contacts.call_args_list[0][1]
+            self.assertEqual(datetime_to_ms(get_kwargs['before']), args[4])
+
+            shard_status = get_sync_status(self.uganda, Contact, shard=args[2])
+            self.assertEqual(shard_status['state'], 'complete')
+
+        status = get_sharded_sync_status(self.uganda, Contact)
+        self.assertEqual(status, dict(until=until, pending=0, created=2, updated=1, deleted=1, failed=0,
+                                      shards={0: 'complete', 1: 'complete'}))
+
+        # running a completed shard again does nothing
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            sync_pull_contacts_shard_task(*mock_delay.call_args_list[0][0])
+            self.assertFalse(mock_get_client.called)
+
+        # a shard locked by another worker is skipped
+        r = get_redis_connection()
+        r.hset('sync:%d:dash_test_runner.contact:shards' % self.uganda.pk, 'shard:0', 'failed')
+
+        with r.lock('lock:sync:%d:dash_test_runner.contact:shard:0' % self.uganda.pk):
+            with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+                sync_pull_contacts_shard_task(*mock_delay.call_args_list[0][0])
+                self.assertFalse(mock_get_client.called)
+
+    def test_sync_pull_contacts_sharded_incomplete(self):
+        with patch('dash.utils.tasks.sync_pull_contacts_shard_task.delay') as mock_delay:
+            until = sync_pull_contacts_sharded(self.uganda, Contact, last_time=self.uganda.created_on, num_shards=2)
+
+        shard_args = [c[0] for c in mock_delay.call_args_list]
+
+        # first shard completes but the second fails
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = self.mock_client(pages=[[self.temba_contact('C-001', "Ann")]])
+            sync_pull_contacts_shard_task(*shard_args[0])
+
+            mock_get_client.return_value.get_contacts.side_effect = ValueError("Unavailable")
+            self.assertRaises(ValueError, sync_pull_contacts_shard_task, *shard_args[1])
+
+        status = get_sharded_sync_status(self.uganda, Contact)
+        self.assertEqual(status, dict(until=until, pending=1, created=1, updated=0, deleted=0, failed=0,
+                                      shards={0: 'complete', 1: 'failed'}))
+
+        # starting another sharded pull doesn't reset the previous one, but queues its failed shard again
+        with patch('dash.utils.tasks.sync_pull_contacts_shard_task.delay') as mock_delay:
+            self.assertEqual(sync_pull_contacts_sharded(self.uganda, Contact, last_time=until, num_shards=2), until)
+
+        self.assertEqual(mock_delay.call_args_list, [call(*shard_args[1])])
+        self.assertEqual(get_sharded_sync_status(self.uganda, Contact), status)
+
+        with patch('dash.orgs.models.Org.get_temba_client') as mock_get_client:
+            mock_get_client.return_value = self.mock_client(pages=[[self.temba_contact('C-002', "Bob")]])
+            sync_pull_contacts_shard_task(*mock_delay.call_args[0])
+
+        status = get_sharded_sync_status(self.uganda, Contact)
+        self.assertEqual(status, dict(until=until, pending=0, created=2, updated=0, deleted=0, failed=0,
+                                      shards={0: 'complete', 1: 'complete'}))
+
+        # now a new sharded pull can start
+        with patch('dash.utils.tasks.sync_pull_contacts_shard_task.delay') as mock_delay:
+            next_until = sync_pull_contacts_sharded(self.uganda, Contact, last_time=until, num_shards=2)
+
+        self.assertEqual(mock_delay.call_count, 2)
+        self.assertEqual(get_sharded_sync_status(self.uganda, Contact),
+                         dict(until=next_until, pending=2, created=0, updated=0, deleted=0, failed=0, shards={}))
+
+        # but not while another process is starting one
+        r = get_redis_connection()
+        with r.lock('lock:sync:%d:dash_test_runner.contact:shards' % self.uganda.pk):
+            with patch('dash.utils.tasks.sync_pull_contacts_shard_task.delay') as mock_delay:
+                self.assertIsNone(sync_pull_contacts_sharded(self.uganda, Contact, last_time=until, num_shards=2))
+                self.assertFalse(mock_delay.called)